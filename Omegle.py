@@ -1,150 +1,2360 @@
 # --- START OF FILE OmegleBot [v5.3_EN].py ---
 
+import asyncio
+import bisect
+import cProfile
+import functools
+import gzip
+import itertools
+import json
 import logging
+import logging.handlers
+import os
+import pstats
+import queue
+import random
+import signal
+import socket
 import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
-from datetime import datetime
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup,
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo,
+)
+from telegram.error import Forbidden, RetryAfter
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from datetime import datetime, timedelta, timezone
 
 # --- Configuration ---
 BOT_TOKEN = "YOUR_TOKEN_HERE"  # IMPORTANT: Paste your bot token here
 BOT_OWNER_ID = 123456789      # Replace with the bot owner's Telegram user ID
 ADMIN_GROUP_ID = -1001234567890 # Replace with the admin group chat ID
 
-# --- Logging Setup ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("telegram.ext").setLevel(logging.WARNING)
+# Serving mode: "polling" (default) or "webhook"
+RUN_MODE = "polling"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_URL_PATH = "telegram"
+WEBHOOK_URL = ""               # Public HTTPS URL that reaches WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_URL_PATH
+WEBHOOK_SECRET_TOKEN = ""      # Required in webhook mode; requests without it are rejected
+WEBHOOK_MAX_CONNECTIONS = 100  # Simultaneous HTTPS connections Telegram may open to the webhook
+UPDATE_QUEUE_SIZE = 2000       # Incoming updates buffered before the webhook/poller waits for handlers
+
+# Matchmaking
+RECENT_PARTNER_WINDOW = 60  # Seconds during which two users who just split up won't be paired again
+MATCH_SCAN_LIMIT = 16       # How many waiting users to look past when skipping recent partners
+INTEREST_MATCH_WAIT = 30    # Seconds a user with /interests waits for someone sharing one before anyone will do
+INTEREST_FALLBACK_INTERVAL = 5  # Seconds between passes that pair users whose INTEREST_MATCH_WAIT is over
+MAX_INTERESTS = 5           # Interest tags per user
+MAX_INTEREST_LENGTH = 32    # Characters per interest tag
+
+# Shared state: "memory" keeps the waiting queue, open chats and ban/sudo sets in this process;
+# "sqlite" keeps them in DB_FILE so several webhook worker processes can share one pairing pool
+STATE_BACKEND = "memory"
+STATE_SNAPSHOT_FILE = "omegle_state.json"  # The "memory" backend's waiting queue and open chats, for warm restarts
+STATE_SNAPSHOT_INTERVAL = 30               # Seconds between snapshots; one is also written on shutdown
+
+# Update processing
+MAX_CONCURRENT_UPDATES = 256  # Updates from different users handled in parallel
+
+# Outbound sending (Telegram allows ~30 messages/s overall, ~1/s per private chat, 20/min per group)
+GLOBAL_SEND_RATE = 30          # Messages per second across all chats
+PRIVATE_CHAT_SEND_RATE = 1.0   # Sustained messages per second to one private chat
+PRIVATE_CHAT_SEND_BURST = 5    # Short bursts allowed on top of that, e.g. a quick exchange of messages
+GROUP_CHAT_SEND_RATE = 20 / 60 # Messages per second to one group, e.g. the admin group
+SEND_WORKERS = 32              # API calls that may be in flight at once
+SEND_QUEUE_SIZE = 10000        # Callers wait for room once this many calls are queued
+SEND_MAX_RETRIES = 3           # RetryAfter retries before a call is given up
+SEND_CHAT_STATE_LIMIT = 5000   # Idle per-chat buckets are evicted once more than this many exist
+
+# Outbound priority lanes, lowest value is sent first
+PRIORITY_RELAY = 0   # Messages between chat partners
+PRIORITY_NOTICE = 1  # Bot replies and notices to users
+PRIORITY_ADMIN = 2   # Admin group traffic
+PRIORITY_BROADCAST = 3  # /broadcast, sent only when nothing else is waiting
+
+# Broadcasts
+BROADCAST_RATE = 20        # Messages per second, leaving room under GLOBAL_SEND_RATE for chats
+BROADCAST_CONCURRENCY = 10 # Broadcast messages in flight at once
+BROADCAST_PAGE_SIZE = 100  # Users read, sent to and checkpointed per batch
+BROADCAST_LEASE_SECONDS = 60  # A worker's claim on a broadcast, renewed every page; another takes over once it lapses
+
+# Retention: messages and closed chats older than RETENTION_DAYS move to gzip-compressed JSONL
+# files under ARCHIVE_DIR. Messages of chats with a pending report are kept until it is resolved.
+RETENTION_DAYS = 30              # 0 keeps everything in the live database
+RETENTION_INTERVAL = 3600        # Seconds between retention runs
+RETENTION_BATCH_SIZE = 500       # Rows archived and deleted per transaction
+ARCHIVE_DIR = "archive"
+INCREMENTAL_VACUUM_PAGES = 5000  # Free pages handed back to the filesystem per retention run
+
+# Reaper: chats and searches that were abandoned
+IDLE_CHAT_TIMEOUT = 1800  # End chats with no messages for this many seconds (0 = never)
+MAX_WAIT_SECONDS = 900    # Stop searching for users who waited this long (0 = never)
+REAPER_INTERVAL = 60      # Seconds between reaper runs
+REAPER_BATCH_SIZE = 200   # Idle chats closed per transaction
+
+# Relaying
+ALBUM_WINDOW = 0.5  # Seconds to collect the items of an album before relaying them together
+
+# Flood control for relayed messages
+FLOOD_RATE = 1.0                       # Messages per second a user can keep up
+FLOOD_BURST = 10                       # Messages a user can send at once, e.g. an album
+FLOOD_COOLDOWNS = (10, 60, 300, 1800)  # Seconds muted after the 1st, 2nd, 3rd, ... time the limit is hit
+FLOOD_STRIKE_RESET = 3600              # Seconds without hitting the limit before the cooldowns start over
+FLOOD_REPORT_STRIKES = 3               # Report the user to ADMIN_GROUP_ID at this many strikes (0 = never)
+FLOOD_STATE_LIMIT = 10000              # Idle users are evicted once more than this many are tracked
+
+# Usage statistics for /stats, counted per hour as events happen
+STATS_SNAPSHOT_INTERVAL = 60  # Seconds between writes of the new counts to the stats table
+STATS_HISTORY_DAYS = 90       # Hourly rows older than this are pruned; all-time totals are kept
+
+# Metrics, served in Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+# On-demand profiling with /profile <seconds> (owner only) or `kill -USR1 <pid>`
+PROFILE_DIR = "profiles"
+PROFILE_MAX_SECONDS = 300
+PROFILE_SIGNAL_SECONDS = 30  # How long SIGUSR1 profiles for
+SLOW_CALLBACK_MS = 100       # Loop callbacks that block longer than this are listed while profiling
+
+# Logging: records are written by a background thread, as JSON lines to LOG_FILE;
+# warnings and errors also go to stderr
+LOG_LEVEL = "INFO"
+LOG_FILE = "omegle_bot.log"       # "" writes everything to stderr instead
+LOG_FORMAT = "json"               # "json" or "text"
+LOG_MAX_BYTES = 50 * 1024 * 1024  # Rotate the log file at this size...
+LOG_ROTATE_WHEN = ""              # ...or by time instead, e.g. "midnight" or "H"
+LOG_BACKUP_COUNT = 5              # Rotated log files kept
+LOG_QUEUE_SIZE = 10000            # Records waiting for the writer; more are dropped rather than waited for
+LOG_SAMPLE_RATE = 0.01            # Share of per-update and per-message events logged (warnings always are)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+
+# Handler and user of the update being handled; added to every record logged meanwhile
+log_context: ContextVar[dict] = ContextVar("log_context", default={})
+# Events logged for every update or relayed message; only LOG_SAMPLE_RATE of them are kept
+SAMPLED_EVENTS = {"update", "relay"}
+# Attributes every LogRecord has; anything else was passed with extra= and goes into the JSON
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+class ContextFilter(logging.Filter):
+    """Samples the high-volume events and adds the log_context fields to the rest."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and getattr(record, "event", None) in SAMPLED_EVENTS:
+            if random.random() >= LOG_SAMPLE_RATE:
+                return False
+            record.sample_rate = LOG_SAMPLE_RATE
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are; formatting and I/O happen there.
+
+    A full queue means the writer can't keep up, and the record is dropped and counted
+    rather than holding up the event loop.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class LogWriter(logging.handlers.QueueListener):
+    """Writes the queued records to the real handlers on its own thread."""
+    def enqueue_sentinel(self):
+        # The queue may be full when shutting down; wait for room so the records in it still get written
+        self.queue.put(self._sentinel)
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message, its extra= fields and the log_context fields."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+def setup_logging() -> LogWriter:
+    """Routes all logging through a queue to a writer thread. Stop the returned writer on exit to flush it."""
+    text_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else text_formatter
+    console = logging.StreamHandler()
+    handlers = [console]
+    if LOG_FILE:
+        if LOG_ROTATE_WHEN:
+            log_file = logging.handlers.TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        else:
+            log_file = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        log_file.setFormatter(formatter)
+        handlers.append(log_file)
+        console.setLevel(logging.WARNING)
+        console.setFormatter(text_formatter)
+    else:
+        console.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram.ext").setLevel(logging.WARNING)
+
+    writer = LogWriter(queue_handler.queue, *handlers, respect_handler_level=True)
+    writer.start()
+    return writer
+
+# --- Metrics ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MATCH_WAIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterMetric:
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help_text, self.labelnames = name, help_text, labelnames
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name + _format_labels(self.labelnames, labels), value
+
+class GaugeMetric:
+    """A value read from `read()` whenever the metrics are scraped, so updating it costs nothing.
+
+    `read` may be a coroutine function, for values that live in the state backend.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name, self.help_text, self.read = name, help_text, read
+        self.value = 0
+
+    async def refresh(self):
+        value = self.read()
+        self.value = await value if asyncio.iscoroutine(value) else value
+
+    def samples(self):
+        yield self.name, self.value
+
+class HistogramMetric:
+    """Counts observations into fixed buckets; observe() is a bisect and two increments."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = ()):
+        self.name, self.help_text, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket" + _format_labels(self.labelnames, labels, f'le="{bound}"'), cumulative
+            yield self.name + "_sum" + _format_labels(self.labelnames, labels), total
+            yield self.name + "_count" + _format_labels(self.labelnames, labels), cumulative
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    async def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, GaugeMetric):
+                await metric.refresh()
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{sample} {value}" for sample, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Starts a minimal HTTP server that answers GET /metrics."""
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                request_line = await reader.readline()
+                while await reader.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                parts = request_line.split()
+                if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                    status, body = "200 OK", (await self.render()).encode()
+                else:
+                    status, body = "404 Not Found", b"Not found\n"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+        return await asyncio.start_server(handle, host, port)
+
+metrics = MetricsRegistry()
+metrics_server: asyncio.AbstractServer | None = None
+HANDLER_SECONDS = metrics.register(HistogramMetric("omegle_handler_seconds", "Time spent in each update handler.", LATENCY_BUCKETS, ("handler",)))
+HANDLER_ERRORS = metrics.register(CounterMetric("omegle_handler_errors_total", "Update handlers that raised.", ("handler",)))
+DB_STATEMENT_SECONDS = metrics.register(HistogramMetric("omegle_db_statement_seconds", "Time the database thread spent per statement or transaction.", LATENCY_BUCKETS, ("statement",)))
+TELEGRAM_CALLS = metrics.register(CounterMetric("omegle_telegram_calls_total", "Outbound Bot API calls by method and outcome (success, error, retry).", ("method", "outcome")))
+FLOOD_LIMITED = metrics.register(CounterMetric("omegle_flood_limited_total", "Messages stopped by flood control; verdict is cooldown (started one) or drop.", ("verdict",)))
+MATCH_WAIT_SECONDS = metrics.register(HistogramMetric("omegle_time_to_match_seconds", "Time users spent in the waiting queue before being paired.", MATCH_WAIT_BUCKETS))
+LOG_RECORDS_DROPPED = metrics.register(CounterMetric("omegle_log_records_dropped_total", "Log records dropped because the log writer fell behind."))
+metrics.register(GaugeMetric("omegle_waiting_users", "Users waiting for a partner.", lambda: state_count(0)))
+metrics.register(GaugeMetric("omegle_active_pairs", "Open chats.", lambda: state_count(1)))
+metrics.register(GaugeMetric("omegle_send_queue_depth", "Bot API calls waiting in the outbound dispatcher.", lambda: dispatcher.stats()["queue_depth"]))
+metrics.register(GaugeMetric("omegle_message_log_queue_depth", "Message log records waiting to be written.", lambda: message_log.pending()))
+
+async def state_count(index: int) -> int:
+    return (await state.counts())[index]
+
+def instrumented(handler):
+    """Wraps an update handler to record its latency and errors."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        user = update.effective_user
+        context_token = log_context.set({"handler": name, "user_id": user.id if user else None})
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, name)
+            logger.info("Handled update in %.1f ms", elapsed * 1000, extra={"event": "update", "latency_ms": round(elapsed * 1000, 2)})
+            log_context.reset(context_token)
+    return wrapper
+
+# --- Database ---
+DB_FILE = "omegle_bot.db"
+DB_STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection, keyed by SQL text
+DB_BUSY_TIMEOUT_MS = 5000
+MESSAGE_LOG_BATCH_SIZE = 500       # Flush the message log once this many records are buffered...
+MESSAGE_LOG_FLUSH_INTERVAL = 1.0   # ...or once the oldest buffered record is this many seconds old
+MESSAGE_LOG_QUEUE_SIZE = 20000     # Handlers wait for room once this many records are pending
+MEDIA_FILE_CACHE_SIZE = 20000      # Most recently logged file_ids whose media_files ID is kept in memory
+MIGRATION_BATCH_SIZE = 50000       # Rows copied per statement by migrations that rebuild a table
+
+def get_db_connection():
+    """Creates and returns a database connection in WAL mode."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    # Set first: switching a new database to WAL needs a lock that another worker may be holding
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+class Database:
+    """A single long-lived connection whose statements all run on one dedicated thread.
+
+    Handlers await the async methods, so a slow write or checkpoint never blocks the event loop.
+    Because there is only one worker thread, statements are serialized and the connection is
+    never used from two threads at once.
+    """
+
+    def __init__(self):
+        self._conn: sqlite3.Connection | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self.busy_seconds = 0.0  # Time the database thread has spent running statements
+
+    def open(self):
+        """Starts the database thread and opens the connection on it."""
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="omegle-db")
+        self._conn = self._executor.submit(get_db_connection).result()
+
+    def close(self):
+        """Closes the connection and stops the database thread once queued work has finished."""
+        if self._executor is None:
+            return
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown(wait=True)
+        self._conn, self._executor = None, None
+
+    def run_sync(self, func, *args):
+        """Runs func(conn, *args) on the database thread and blocks until it returns (startup only)."""
+        return self._executor.submit(func, self._conn, *args).result()
+
+    async def run(self, func, *args, label: str | None = None):
+        """Runs func(conn, *args) on the database thread. `label` names it in the timing metrics."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, func, args, label or func.__name__)
+
+    def _timed(self, func, args: tuple, label: str):
+        started = time.perf_counter()
+        try:
+            return func(self._conn, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.busy_seconds += elapsed
+            DB_STATEMENT_SECONDS.observe(elapsed, label)
+
+    async def transaction(self, func, *args, label: str | None = None, immediate: bool = False):
+        """Runs func(conn, *args) inside a single transaction; it is rolled back if func raises.
+
+        immediate=True takes the database write lock up front (BEGIN IMMEDIATE), so reads made
+        inside the transaction can't be invalidated by another process before it commits.
+        """
+        def wrapper(conn, *args):
+            with conn:
+                if immediate:
+                    conn.execute("BEGIN IMMEDIATE")
+                return func(conn, *args)
+        return await self.run(wrapper, *args, label=label or func.__name__)
+
+    async def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """Executes and commits a single statement. The cursor exposes lastrowid and rowcount."""
+        return await self.transaction(lambda conn: conn.execute(sql, params), label=statement_label(sql))
+
+    async def executemany(self, sql: str, seq_of_params) -> sqlite3.Cursor:
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params), label=statement_label(sql))
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> sqlite3.Row | None:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), label=statement_label(sql))
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), label=statement_label(sql))
+
+@functools.lru_cache(maxsize=512)
+def statement_label(sql: str) -> str:
+    """The SQL text on one line, used as the statement label in the timing metrics."""
+    return " ".join(sql.split())
+
+db = Database()
+
+# Stored in messages.media_type and reports.reported_media_type instead of the name; never renumber.
+# NULL is plain text and 0 an attachment type added to Telegram after this list was written.
+MEDIA_TYPE_CODES = {
+    "photo": 1, "video": 2, "animation": 3, "sticker": 4, "voice": 5, "video_note": 6, "audio": 7, "document": 8,
+    "location": 9, "contact": 10, "poll": 11, "dice": 12, "venue": 13, "game": 14, "invoice": 15, "story": 16,
+}
+MEDIA_TYPE_NAMES = {code: name for name, code in MEDIA_TYPE_CODES.items()}
+
+def media_type_code(media_type: str | None) -> int | None:
+    return None if media_type is None else MEDIA_TYPE_CODES.get(media_type, 0)
+
+class MediaFileIds:
+    """Integer IDs for Telegram file_ids, each stored once in media_files.
+
+    The same popular stickers and GIFs are relayed over and over, so the message log and reports
+    refer to their file_id by ID. Recently used IDs are kept in an LRU, so logging a message rarely
+    needs a lookup. Only used on the database thread, and never inside a transaction.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._ids: OrderedDict[str, int] = OrderedDict()
+
+    def lookup(self, conn: sqlite3.Connection, file_ids) -> dict[str, int]:
+        """Returns file_id -> ID, adding the file_ids seen for the first time to media_files."""
+        found, missing = {}, []
+        for file_id in file_ids:
+            media_file_id = self._ids.get(file_id)
+            if media_file_id is None:
+                missing.append(file_id)
+            else:
+                self._ids.move_to_end(file_id)
+                found[file_id] = media_file_id
+        if missing:
+            # Committed before the IDs are cached or used, so a cached ID always exists in the table
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO media_files (file_id) VALUES (?)", [(file_id,) for file_id in missing])
+            for file_id in missing:
+                row = conn.execute("SELECT id FROM media_files WHERE file_id = ?", (file_id,)).fetchone()
+                found[file_id] = self._ids[file_id] = row['id']
+            while len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+        return found
+
+media_files = MediaFileIds(MEDIA_FILE_CACHE_SIZE)
+
+class MessageLogWriter:
+    """Write-behind pipeline for the messages table.
+
+    Handlers enqueue records and return immediately; a background task writes them with a single
+    executemany per batch. The queue is bounded, so a stalled database slows senders down instead
+    of growing memory without limit, and stop() drains everything still pending.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=MESSAGE_LOG_QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes all pending records and stops the background task."""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def log(self, pair_id: int, sender_id: int, text: str | None, media_type: str | None, media_id: str | None):
+        """Queues one relayed message for writing. Waits only when the queue is full."""
+        await self._queue.put((pair_id, sender_id, text, media_type_code(media_type), media_id, int(time.time())))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = loop.time() + MESSAGE_LOG_FLUSH_INTERVAL
+            while len(batch) < MESSAGE_LOG_BATCH_SIZE:
+                try:
+                    record = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            await self._flush(batch)
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, batch: list[tuple]):
+        file_ids = media_files.lookup(conn, {media_id for _, _, _, _, media_id, _ in batch if media_id})
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (pair_id, sender_id, message_text, media_type, media_file_id, sent_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(pair_id, sender_id, text, media_type, file_ids.get(media_id), sent_at)
+                 for pair_id, sender_id, text, media_type, media_id, sent_at in batch]
+            )
+
+    async def _flush(self, batch: list[tuple], attempts: int = 3):
+        for attempt in range(1, attempts + 1):
+            try:
+                await db.run(self._write, batch, label="write message log")
+                return
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write {len(batch)} message log records (attempt {attempt}/{attempts}): {e}")
+                await asyncio.sleep(attempt)
+        logger.error(f"Dropped {len(batch)} message log records after {attempts} failed attempts.")
+
+message_log = MessageLogWriter()
+
+# --- Schema Migrations ---
+# The schema version is kept in PRAGMA user_version; migration N brings a database from version
+# N-1 to N. Append new migrations to MIGRATIONS and never edit one that has shipped.
+
+def migration_1_base_schema(conn: sqlite3.Connection):
+    """The original tables. Safe on databases created before versioning existed."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_pairs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            disconnected_at TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pair_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            message_text TEXT,
+            media_type TEXT,
+            media_id TEXT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (pair_id) REFERENCES chat_pairs(id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS banned_users (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            banned_by_admin_id INTEGER
+        )
+    ''')
+    # Attempt to add the new column to an existing table if it's missing
+    try:
+        conn.execute("ALTER TABLE banned_users ADD COLUMN banned_by_admin_id INTEGER;")
+        logger.info("Column 'banned_by_admin_id' added to 'banned_users' table.")
+    except sqlite3.OperationalError:
+        # Column already exists, which is fine
+        pass
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sudo_users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reporter_id INTEGER,
+            reported_id INTEGER,
+            reason TEXT,
+            reported_message_text TEXT,
+            reported_media_id TEXT,
+            reported_media_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'pending' -- pending, accepted, rejected
+        )
+    ''')
+
+def migration_2_indexes(conn: sqlite3.Connection):
+    """Indexes for the lookups that otherwise scan the whole history."""
+    # Partial indexes: only open chats are indexed, so they stay small however long the history grows
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_pairs_active ON chat_pairs (id, user1_id, user2_id) WHERE disconnected_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_pairs_active_user1 ON chat_pairs (user1_id, user2_id) WHERE disconnected_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_pairs_active_user2 ON chat_pairs (user2_id, user1_id) WHERE disconnected_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (pair_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_status ON reports (status)")
+
+def migration_3_retention(conn: sqlite3.Connection):
+    """Links reports to their chat so retention can keep the evidence, and indexes the age columns."""
+    conn.execute("ALTER TABLE reports ADD COLUMN pair_id INTEGER")
+    # Best guess for existing reports: the latest chat between the two users that began before the report
+    conn.execute('''
+        UPDATE reports SET pair_id = (
+            SELECT id FROM chat_pairs
+            WHERE ((user1_id = reports.reporter_id AND user2_id = reports.reported_id)
+                OR (user1_id = reports.reported_id AND user2_id = reports.reporter_id))
+              AND connected_at <= reports.created_at
+            ORDER BY id DESC LIMIT 1
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_pending_pair ON reports (pair_id) WHERE status = 'pending'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_pairs_closed ON chat_pairs (disconnected_at) WHERE disconnected_at IS NOT NULL")
+
+def migration_4_shared_state(conn: sqlite3.Connection):
+    """Tables behind the shared SQLite state backend."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS waiting_queue (
+            user_id INTEGER PRIMARY KEY,
+            enqueued_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waiting_queue_enqueued_at ON waiting_queue (enqueued_at)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS recent_splits (
+            user_low INTEGER NOT NULL,
+            user_high INTEGER NOT NULL,
+            split_at REAL NOT NULL,
+            PRIMARY KEY (user_low, user_high)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_recent_splits_split_at ON recent_splits (split_at)")
+
+def migration_5_stats(conn: sqlite3.Connection):
+    """Hourly usage counters behind /stats; hour 0 holds the all-time totals."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            hour INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (hour, name)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_6_broadcasts(conn: sqlite3.Connection):
+    """Broadcast progress, and users who blocked the bot so broadcasts skip them."""
+    conn.execute("ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            text TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+def migration_7_interests(conn: sqlite3.Connection):
+    """Interest tags set with /interests, and the shared waiting queue indexed by them."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_interests (
+            user_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (user_id, tag)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("ALTER TABLE waiting_queue ADD COLUMN has_interests INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waiting_queue_anyone ON waiting_queue (enqueued_at) WHERE has_interests = 0")
+    # One row per waiting user and tag, ordered so the longest-waiting user with a tag comes first
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS waiting_interests (
+            tag TEXT NOT NULL,
+            enqueued_at REAL NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, enqueued_at, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waiting_interests_user ON waiting_interests (user_id)")
+
+def sql_media_type_code(column: str) -> str:
+    """SQL expression turning the media type name in `column` into its MEDIA_TYPE_CODES code."""
+    cases = " ".join(f"WHEN {column} = '{name}' THEN {code}" for name, code in MEDIA_TYPE_CODES.items())
+    return f"CASE {cases} WHEN {column} IS NOT NULL THEN 0 END"
+
+def sql_media_type_name(column: str) -> str:
+    """SQL expression turning the MEDIA_TYPE_CODES code in `column` back into the name."""
+    cases = " ".join(f"WHEN {code} THEN '{name}'" for name, code in MEDIA_TYPE_CODES.items())
+    return f"CASE {column} {cases} WHEN 0 THEN 'other' END"
+
+def table_sizes(conn: sqlite3.Connection) -> dict[str, int]:
+    """Bytes used by each table and its indexes, or {} if this SQLite build has no dbstat table."""
+    try:
+        rows = conn.execute(
+            "SELECT m.tbl_name AS name, SUM(s.pgsize) AS size FROM dbstat AS s JOIN sqlite_master AS m ON m.name = s.name GROUP BY m.tbl_name"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {row['name']: row['size'] for row in rows}
+
+def used_bytes(conn: sqlite3.Connection) -> int:
+    pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * conn.execute("PRAGMA page_size").fetchone()[0]
+
+def rebuild_table(conn: sqlite3.Connection, table: str, columns_sql: str, copy_sql: str, media_column: str):
+    """Replaces `table` with one laid out as columns_sql, copying MIGRATION_BATCH_SIZE rows at a time.
+
+    copy_sql selects the rows with `id > ? AND id <= ?` in the new column order; the file_ids in
+    media_column are added to media_files first, so it can join media_files AS f on them.
+    """
+    conn.execute(f"CREATE TABLE {table}_compact ({columns_sql})")
+    total = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    copied, last_id = 0, 0
+    while True:
+        upper = conn.execute(
+            f"SELECT MAX(id) FROM (SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?)", (last_id, MIGRATION_BATCH_SIZE)
+        ).fetchone()[0]
+        if upper is None:
+            break
+        conn.execute(
+            f"INSERT OR IGNORE INTO media_files (file_id) SELECT {media_column} FROM {table} "
+            f"WHERE id > ? AND id <= ? AND {media_column} IS NOT NULL",
+            (last_id, upper)
+        )
+        copied += conn.execute(f"INSERT INTO {table}_compact {copy_sql}", (last_id, upper)).rowcount
+        last_id = upper
+        logger.info(f"Rewrote {copied}/{total} rows of {table}.")
+    # Keep AUTOINCREMENT counting from where it was, so archived IDs are never handed out again
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_compact RENAME TO {table}")
+    if sequence:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+
+def migration_8_compact_message_log(conn: sqlite3.Connection):
+    """Stores file_ids once in media_files, media types as MEDIA_TYPE_CODES and times as epoch seconds.
+
+    Rewrites messages and reports in batches and logs how much smaller they got.
+    """
+    sizes_before, used_before = table_sizes(conn), used_bytes(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            id INTEGER PRIMARY KEY,
+            file_id TEXT NOT NULL UNIQUE
+        )
+    ''')
+    rebuild_table(conn, "messages", '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pair_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        message_text TEXT,
+        media_type INTEGER,
+        media_file_id INTEGER REFERENCES media_files(id),
+        sent_at INTEGER NOT NULL,
+        FOREIGN KEY (pair_id) REFERENCES chat_pairs(id)
+    ''', f'''
+        SELECT m.id, m.pair_id, m.sender_id, m.message_text, {sql_media_type_code("m.media_type")}, f.id,
+               COALESCE(CAST(strftime('%s', m.sent_at) AS INTEGER), 0)
+        FROM messages AS m LEFT JOIN media_files AS f ON f.file_id = m.media_id
+        WHERE m.id > ? AND m.id <= ?
+    ''', "media_id")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (pair_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at)")
+    rebuild_table(conn, "reports", '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reporter_id INTEGER,
+        reported_id INTEGER,
+        reason TEXT,
+        reported_message_text TEXT,
+        reported_media_type INTEGER,
+        reported_media_file_id INTEGER REFERENCES media_files(id),
+        created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        status TEXT DEFAULT 'pending', -- pending, accepted, rejected
+        pair_id INTEGER
+    ''', f'''
+        SELECT r.id, r.reporter_id, r.reported_id, r.reason, r.reported_message_text,
+               {sql_media_type_code("r.reported_media_type")}, f.id,
+               COALESCE(CAST(strftime('%s', r.created_at) AS INTEGER), 0), r.status, r.pair_id
+        FROM reports AS r LEFT JOIN media_files AS f ON f.file_id = r.reported_media_id
+        WHERE r.id > ? AND r.id <= ?
+    ''', "reported_media_id")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_status ON reports (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_pending_pair ON reports (pair_id) WHERE status = 'pending'")
+
+    sizes_after = table_sizes(conn)
+    report = ", ".join(
+        f"{table} {sizes_before.get(table, 0) / 2**20:.1f} -> {sizes_after.get(table, 0) / 2**20:.1f} MiB"
+        for table in ("messages", "reports", "media_files") if table in sizes_after
+    )
+    logger.info(
+        f"Compacted the message log: {report + '; ' if report else ''}"
+        f"database {used_before / 2**20:.1f} -> {used_bytes(conn) / 2**20:.1f} MiB."
+    )
+
+def migration_9_broadcast_leases(conn: sqlite3.Connection):
+    """Which worker is sending a broadcast, so only one of several resumes it."""
+    conn.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+    conn.execute("ALTER TABLE broadcasts ADD COLUMN lease_until REAL")
+
+MIGRATIONS = [
+    migration_1_base_schema,
+    migration_2_indexes,
+    migration_3_retention,
+    migration_4_shared_state,
+    migration_5_stats,
+    migration_6_broadcasts,
+    migration_7_interests,
+    migration_8_compact_message_log,
+    migration_9_broadcast_leases,
+]
+
+# Written as a UNION ALL so each side searches its own index; an OR here may walk a whole index
+ACTIVE_PAIR_SQL = (
+    "SELECT id, user2_id AS partner_id FROM chat_pairs WHERE user1_id = ? AND disconnected_at IS NULL "
+    "UNION ALL SELECT id, user1_id FROM chat_pairs WHERE user2_id = ? AND disconnected_at IS NULL"
+)
+# The longest-waiting of the first MATCH_SCAN_LIMIT users in one slice of the queue who isn't a recent partner
+CLAIM_PARTNER_SQL = '''
+    SELECT user_id, enqueued_at FROM (
+        SELECT user_id, enqueued_at FROM {queue} WHERE {condition} AND user_id != ? ORDER BY enqueued_at LIMIT ?
+    ) AS candidates
+    WHERE NOT EXISTS (
+        SELECT 1 FROM recent_splits
+        WHERE user_low = min(candidates.user_id, ?) AND user_high = max(candidates.user_id, ?)
+    )
+    ORDER BY enqueued_at LIMIT 1
+'''
+# The slices: users who share an interest, users without interests, and users whose INTEREST_MATCH_WAIT is over
+CLAIM_BY_INTEREST_SQL = CLAIM_PARTNER_SQL.format(queue="waiting_interests", condition="tag = ?")
+CLAIM_ANYONE_SQL = CLAIM_PARTNER_SQL.format(queue="waiting_queue", condition="has_interests = 0")
+CLAIM_WAITED_SQL = CLAIM_PARTNER_SQL.format(queue="waiting_queue", condition="enqueued_at <= ?")
+
+# Old rows that retention may move to the archive; chats with a pending report are left alone
+# Archived messages keep the readable layout: media type names, file_ids and text timestamps
+ARCHIVABLE_MESSAGES_SQL = f'''
+    SELECT messages.id, pair_id, sender_id, message_text, {sql_media_type_name("media_type")} AS media_type,
+           media_files.file_id AS media_id, strftime('%Y-%m-%d %H:%M:%S', sent_at, 'unixepoch') AS sent_at
+    FROM messages LEFT JOIN media_files ON media_files.id = messages.media_file_id
+    WHERE sent_at < ? AND pair_id NOT IN (SELECT pair_id FROM reports WHERE status = 'pending' AND pair_id IS NOT NULL)
+    LIMIT ?
+'''
+ARCHIVABLE_CHATS_SQL = '''
+    SELECT id, user1_id, user2_id, connected_at, disconnected_at FROM chat_pairs
+    WHERE disconnected_at IS NOT NULL AND disconnected_at < ?
+      AND id NOT IN (SELECT pair_id FROM reports WHERE status = 'pending' AND pair_id IS NOT NULL)
+      AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.pair_id = chat_pairs.id)
+    LIMIT ?
+'''
+
+# The next page of users a broadcast goes to, by keyset on user_id
+BROADCAST_PAGE_SQL = '''
+    SELECT user_id FROM users
+    WHERE user_id > ? AND blocked_at IS NULL
+      AND NOT EXISTS (SELECT 1 FROM banned_users WHERE banned_users.user_id = users.user_id)
+    ORDER BY user_id LIMIT ?
+'''
+
+# Queries on the bot's hot paths; check_query_plans makes sure none of them scans a whole table.
+# Keep in sync with the statements used in the handlers.
+HOT_QUERIES = {
+    "load active pairs": ("SELECT id, user1_id, user2_id FROM chat_pairs WHERE disconnected_at IS NULL ORDER BY id", ()),
+    "open pair ids": ("SELECT id FROM chat_pairs WHERE disconnected_at IS NULL", ()),
+    "latest message of pair": ("SELECT sent_at FROM messages WHERE pair_id = ? ORDER BY id DESC LIMIT 1", (1,)),
+    "expire waiting users": ("DELETE FROM waiting_queue WHERE enqueued_at < ?", (0.0,)),
+    "active pair of user": (ACTIVE_PAIR_SQL, (1, 1)),
+    "close pair": ("UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ? AND disconnected_at IS NULL", (1,)),
+    "claim partner by interest": (CLAIM_BY_INTEREST_SQL, ('music', 1, MATCH_SCAN_LIMIT, 1, 1)),
+    "claim partner without interests": (CLAIM_ANYONE_SQL, (1, MATCH_SCAN_LIMIT, 1, 1)),
+    "claim partner who waited": (CLAIM_WAITED_SQL, (0.0, 1, MATCH_SCAN_LIMIT, 1, 1)),
+    "interests of user": ("SELECT tag FROM user_interests WHERE user_id = ? ORDER BY tag", (1,)),
+    "dequeue interests": ("DELETE FROM waiting_interests WHERE user_id = ?", (1,)),
+    "expire recent splits": ("DELETE FROM recent_splits WHERE split_at < ?", (0.0,)),
+    "messages of pair": ("SELECT id FROM messages WHERE pair_id = ?", (1,)),
+    "reports by status": ("SELECT id FROM reports WHERE status = ?", ('pending',)),
+    "report by id": ("SELECT * FROM reports WHERE id = ?", (1,)),
+    "ban record": ("SELECT reason, banned_at, banned_by_admin_id FROM banned_users WHERE user_id = ?", (1,)),
+    "broadcast page": (BROADCAST_PAGE_SQL, (0, 1)),
+    "media file by file_id": ("SELECT id FROM media_files WHERE file_id = ?", ('file',)),
+    "archivable messages": (ARCHIVABLE_MESSAGES_SQL, (0, 1)),
+    "archivable chats": (ARCHIVABLE_CHATS_SQL, ('2000-01-01 00:00:00', 1)),
+}
+
+def check_query_plans(conn: sqlite3.Connection):
+    """Runs EXPLAIN QUERY PLAN on HOT_QUERIES and raises if any of them falls back to a full table scan."""
+    offenders = []
+    tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row['detail']
+            # "SCAN t USING [COVERING] INDEX i" walks an index (a partial one here); a bare "SCAN t" reads
+            # every row. Scans of a subquery, which is already bounded by its own LIMIT, are fine.
+            if detail.startswith("SCAN") and "USING" not in detail and detail.split()[1] in tables:
+                offenders.append(f"{name}: {detail}")
+    if offenders:
+        raise RuntimeError("Hot queries fall back to full table scans:\n" + "\n".join(offenders))
+
+def needs_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """Whether the database still has to be rebuilt with incremental auto-vacuum, read under the write lock."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+    finally:
+        conn.rollback()
+
+def setup_database(conn: sqlite3.Connection):
+    """Applies pending migrations, each in its own transaction, then checks the hot query plans.
+
+    Several workers may start on the same database at once. Each migration runs under BEGIN
+    IMMEDIATE and re-reads user_version inside it, so a migration another worker has just applied
+    is skipped instead of being run twice.
+    """
+    # Incremental auto-vacuum lets retention hand freed pages back without a full VACUUM.
+    # It only takes effect through a VACUUM: switching to WAL has already written the file header
+    # of a brand-new database, where the VACUUM is instant.
+    if needs_incremental_vacuum(conn):
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone():
+            logger.info("Rebuilding the database once to enable incremental vacuum...")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+    migrated = False
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                break
+            migration = MIGRATIONS[version]
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        migrated = True
+        logger.info(f"Database migrated to schema version {version + 1} ({migration.__name__}).")
+    if migrated:
+        # Tables rebuilt by a migration leave their old pages free; hand them back now rather
+        # than over many retention runs. executescript, because it runs the pragma to completion.
+        conn.executescript("PRAGMA incremental_vacuum")
+    check_query_plans(conn)
+    logger.info("Database setup complete.")
+
+# --- Shared state ---
+class Matchmaker:
+    """The queue of users waiting for a partner.
+
+    Backed by an OrderedDict of user_id -> enqueue time, so enqueue, dequeue, membership checks
+    and cancel are all O(1). Users with interests are also queued under each of their tags and
+    the rest in a queue of their own, so a match is found by looking at the front of a few
+    queues, never by walking the whole waiting list. Handlers must hold `lock` while they check
+    a user's state and pair them, which keeps two simultaneous /connect updates from claiming
+    the same waiting user.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self._waiting: OrderedDict[int, float] = OrderedDict()
+        # tag -> users waiting with that interest, and the users waiting without any, in queue order
+        self._by_interest: dict[str, OrderedDict[int, None]] = {}
+        self._without_interests: OrderedDict[int, None] = OrderedDict()
+        self._interests: dict[int, tuple[str, ...]] = {}
+        # (smaller_id, larger_id) -> time the pair split; ordered by time so expiry pops from the front
+        self._recent_splits: OrderedDict[tuple[int, int], float] = OrderedDict()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._waiting
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    def _queues(self, interests: tuple[str, ...]) -> list[OrderedDict]:
+        if not interests:
+            return [self._without_interests]
+        return [self._by_interest.setdefault(tag, OrderedDict()) for tag in interests]
+
+    def enqueue(self, user_id: int, enqueued_at: float | None = None, interests: tuple[str, ...] = ()):
+        self._waiting[user_id] = enqueued_at or time.time()
+        if interests:
+            self._interests[user_id] = interests
+        for queue in self._queues(interests):
+            queue[user_id] = None
+
+    def requeue(self, user_id: int, enqueued_at: float, interests: tuple[str, ...] = ()):
+        """Puts a user back in their place in the queue, e.g. when pairing them failed.
+
+        expire() and the fallback scan rely on the queues being in enqueue-time order. The user
+        was taken from near the front, so only the few users queued before them are moved.
+        """
+        self.enqueue(user_id, enqueued_at, interests)
+        for queue in (self._waiting, *self._queues(interests)):
+            queue.move_to_end(user_id, last=False)
+            earlier = list(itertools.takewhile(lambda other: self._waiting[other] < enqueued_at, itertools.islice(queue, 1, None)))
+            for other in reversed(earlier):
+                queue.move_to_end(other, last=False)
+
+    def _remove(self, user_id: int) -> tuple[float, tuple[str, ...]] | None:
+        """Takes a user out of every queue. Returns (enqueued_at, interests), or None if they weren't waiting."""
+        enqueued_at = self._waiting.pop(user_id, None)
+        if enqueued_at is None:
+            return None
+        interests = self._interests.pop(user_id, ())
+        for queue in self._queues(interests):
+            del queue[user_id]
+        for tag in interests:
+            if not self._by_interest[tag]:
+                del self._by_interest[tag]
+        return enqueued_at, interests
+
+    def cancel(self, user_id: int) -> bool:
+        """Removes a user from the queue. Returns False if they weren't waiting."""
+        return self._remove(user_id) is not None
+
+    def expire(self, cutoff: float) -> list[int]:
+        """Removes and returns the users queued before cutoff. The queue is in enqueue-time order."""
+        expired = []
+        while self._waiting:
+            user_id, enqueued_at = next(iter(self._waiting.items()))
+            if enqueued_at >= cutoff:
+                break
+            self._remove(user_id)
+            expired.append(user_id)
+        return expired
+
+    def entries(self) -> list[tuple[int, float, list[str]]]:
+        """(user_id, enqueued_at, interests) for every waiting user, in queue order."""
+        return [(user_id, enqueued_at, list(self._interests.get(user_id, ()))) for user_id, enqueued_at in self._waiting.items()]
+
+    def remember_split(self, user1_id: int, user2_id: int):
+        key = (min(user1_id, user2_id), max(user1_id, user2_id))
+        self._recent_splits.pop(key, None)
+        self._recent_splits[key] = time.monotonic()
+
+    def _split_recently(self, user1_id: int, user2_id: int) -> bool:
+        cutoff = time.monotonic() - RECENT_PARTNER_WINDOW
+        while self._recent_splits:
+            key, split_at = next(iter(self._recent_splits.items()))
+            if split_at > cutoff:
+                break
+            self._recent_splits.popitem(last=False)
+        return (min(user1_id, user2_id), max(user1_id, user2_id)) in self._recent_splits
+
+    def _first_suitable(self, user_id: int, candidates) -> int | None:
+        """The first of up to MATCH_SCAN_LIMIT candidates, in queue order, who isn't the user or a recent partner."""
+        for candidate_id in itertools.islice(candidates, MATCH_SCAN_LIMIT):
+            if candidate_id != user_id and not self._split_recently(user_id, candidate_id):
+                return candidate_id
+        return None
+
+    def _anyone(self, user_id: int) -> int | None:
+        """The longest-waiting suitable user who takes anyone: no interests, or INTEREST_MATCH_WAIT is over."""
+        cutoff = time.time() - INTEREST_MATCH_WAIT
+        waited = (candidate_id for candidate_id, _ in itertools.takewhile(lambda item: item[1] <= cutoff, self._waiting.items()))
+        return self._oldest(self._first_suitable(user_id, self._without_interests), self._first_suitable(user_id, waited))
+
+    def _oldest(self, *candidates: int | None) -> int | None:
+        return min((c for c in candidates if c is not None), key=self._waiting.__getitem__, default=None)
+
+    def take_partner(self, user_id: int, interests: tuple[str, ...] = ()) -> tuple[int, float, tuple[str, ...]] | None:
+        """Removes and returns (partner_id, enqueued_at, interests) for the longest-waiting suitable user.
+
+        A user with interests is only matched with someone sharing one; the rest take anyone who
+        takes them. Either way only the fronts of len(interests) or two queues are looked at.
+        """
+        if interests:
+            partner_id = self._oldest(*(
+                self._first_suitable(user_id, self._by_interest.get(tag, ())) for tag in interests
+            ))
+        else:
+            partner_id = self._anyone(user_id)
+        if partner_id is None:
+            return None
+        return (partner_id, *self._remove(partner_id))
+
+    def take_fallback_pair(self) -> tuple[tuple[int, float, tuple[str, ...]], tuple[int, float, tuple[str, ...]]] | None:
+        """Removes and returns two users who take anyone by now, once nobody sharing an interest turned up."""
+        cutoff = time.time() - INTEREST_MATCH_WAIT
+        waited = itertools.takewhile(lambda item: item[1] <= cutoff, self._waiting.items())
+        for user_id, _ in list(itertools.islice(waited, MATCH_SCAN_LIMIT)):
+            partner_id = self._anyone(user_id)
+            if partner_id is not None:
+                return (user_id, *self._remove(user_id)), (partner_id, *self._remove(partner_id))
+        return None
+
+def close_pair(conn: sqlite3.Connection, pair_id: int):
+    """Marks a chat pair as disconnected. Runs inside Database.transaction."""
+    conn.execute(
+        "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ? AND disconnected_at IS NULL",
+        (pair_id,)
+    )
+
+class StateBackend(ABC):
+    """Where the waiting queue, the open chats and the ban and sudo sets live.
+
+    chat_pairs, banned_users and sudo_users in the database stay the durable record either way;
+    the backend decides how the bot looks them up and how pairing is kept atomic.
+    STATE_BACKEND picks the implementation in init_database.
+    """
+
+    shared = False  # Whether several bot processes work on the same state
+
+    def load(self, conn: sqlite3.Connection):
+        """Prepares the backend on startup. Runs on the database thread."""
+
+    def snapshot(self) -> dict | None:
+        """Returns the state to save in STATE_SNAPSHOT_FILE, or None if the backend is durable by itself."""
+        return None
+
+    @abstractmethod
+    async def match_or_wait(self, user_id: int, interests: tuple[str, ...] = ()) -> tuple[str, tuple[int, int] | None, float | None]:
+        """Pairs the user with a waiting user, or queues them if nobody suitable is waiting.
+
+        A user with interests is only paired with someone sharing one of them; after
+        INTEREST_MATCH_WAIT seconds in the queue, fallback_pairs pairs them with anyone.
+        Returns (status, (partner_id, pair_id), seconds the partner waited). status is "paired" or
+        "waiting", or "chatting" / "already_waiting" if the user was already in a chat or in the queue,
+        or "banned" if a ban came in while the /connect was being handled.
+        """
+
+    @abstractmethod
+    async def fallback_pairs(self) -> list[tuple[int, int, int, float, float]]:
+        """Pairs waiting users whose INTEREST_MATCH_WAIT is over with anyone who takes them.
+
+        Returns (pair_id, user1_id, user2_id, seconds user1 waited, seconds user2 waited) per new chat.
+        """
+
+    @abstractmethod
+    async def get_pair(self, user_id: int) -> tuple[int, int] | None:
+        """Returns (partner_id, pair_id) for the user's open chat."""
+
+    @abstractmethod
+    async def end_chat(self, user_id: int, partner_id: int | None = None) -> tuple[int, int] | None:
+        """Closes the user's open chat, if it is with partner_id when given. Returns (partner_id, pair_id)."""
+
+    @abstractmethod
+    async def leave(self, user_id: int) -> tuple[tuple[int, int] | None, bool]:
+        """Ends the user's chat or takes them out of the queue. Returns ((partner_id, pair_id), stopped waiting)."""
+
+    @abstractmethod
+    async def end_chats(self, chats: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        """Closes many (pair_id, user1_id, user2_id) chats at once; returns the ones that were still open."""
+
+    @abstractmethod
+    async def expire_waiting(self, cutoff: float) -> list[int]:
+        """Takes users queued before cutoff (epoch seconds) out of the queue and returns them."""
+
+    @abstractmethod
+    async def open_chats(self) -> list[tuple[int, int, int]]:
+        """(pair_id, user1_id, user2_id) of every open chat."""
+
+    @abstractmethod
+    async def is_banned(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def is_sudo(self, user_id: int) -> bool:
+        ...
+
+    async def set_banned(self, user_id: int, banned: bool):
+        """Called before a ban is written to banned_users, and after one was removed."""
+
+    async def set_sudo(self, user_id: int, sudo: bool):
+        """Called after an admin was written to or removed from sudo_users."""
+
+    @abstractmethod
+    async def counts(self) -> tuple[int, int]:
+        """Returns (waiting users, open chats)."""
+
+class InProcessState(StateBackend):
+    """Keeps all state in this process's memory, loaded from the database at startup.
+
+    Every lookup is a dict or set access, which makes it the fastest choice for a single bot process.
+    """
+
+    def __init__(self):
+        self.matchmaker = Matchmaker()
+        # user_id -> (partner_id, pair_id) for every open chat
+        self.active_pairs: dict[int, tuple[int, int]] = {}
+        # Permission caches, written through by every command that changes them
+        self.banned_user_ids: set[int] = set()
+        self.sudo_user_ids: set[int] = set()
+
+    def load(self, conn: sqlite3.Connection):
+        self.banned_user_ids = {row['user_id'] for row in conn.execute("SELECT user_id FROM banned_users")}
+        self.sudo_user_ids = {row['user_id'] for row in conn.execute("SELECT user_id FROM sudo_users")}
+        logger.info(f"Loaded {len(self.banned_user_ids)} banned users and {len(self.sudo_user_ids)} admins.")
+        snapshot = read_state_snapshot()
+        if not snapshot or not self.restore_pairs(conn, snapshot["pairs"]):
+            self.load_active_pairs(conn)
+        if snapshot:
+            self.restore_queue(snapshot["waiting"])
+
+    def snapshot(self) -> dict:
+        return {
+            "version": STATE_SNAPSHOT_VERSION,
+            "saved_at": time.time(),
+            "waiting": self.matchmaker.entries(),
+            "pairs": [
+                (pair_id, user_id, partner_id)
+                for user_id, (partner_id, pair_id) in self.active_pairs.items() if user_id < partner_id
+            ],
+        }
+
+    def restore_pairs(self, conn: sqlite3.Connection, pairs: list) -> bool:
+        """Loads the open chats from a snapshot if they are exactly the ones open in chat_pairs."""
+        open_pair_ids = {row['id'] for row in conn.execute("SELECT id FROM chat_pairs WHERE disconnected_at IS NULL")}
+        if open_pair_ids != {pair_id for pair_id, _, _ in pairs}:
+            logger.warning("The state snapshot's open chats don't match chat_pairs; rebuilding them from the database.")
+            return False
+        self.active_pairs.clear()
+        for pair_id, user1_id, user2_id in pairs:
+            self.register_pair(user1_id, user2_id, pair_id)
+        logger.info(f"Restored {len(pairs)} active pairs from the state snapshot.")
+        return True
+
+    def restore_queue(self, waiting: list):
+        """Puts waiting users back in the queue in their old order, with their original enqueue times."""
+        restored = 0
+        for user_id, enqueued_at, *interests in waiting:
+            if user_id not in self.active_pairs and user_id not in self.banned_user_ids:
+                self.matchmaker.enqueue(user_id, enqueued_at, tuple(interests[0]) if interests else ())
+                restored += 1
+        logger.info(f"Restored {restored} waiting users from the state snapshot.")
+
+    def load_active_pairs(self, conn: sqlite3.Connection):
+        """Rebuilds the active-pair index from chat_pairs."""
+        self.active_pairs.clear()
+        stale_pair_ids = []
+        rows = conn.execute(
+            "SELECT id, user1_id, user2_id FROM chat_pairs WHERE disconnected_at IS NULL ORDER BY id"
+        ).fetchall()
+        for row in rows:
+            for user_id in (row['user1_id'], row['user2_id']):
+                # Older versions could leave several open rows per user; keep the newest one
+                if user_id in self.active_pairs:
+                    stale_pair_ids.append(self.unregister_pair(user_id)[1])
+            self.register_pair(row['user1_id'], row['user2_id'], row['id'])
+        if stale_pair_ids:
+            with conn:
+                conn.executemany(
+                    "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    [(pair_id,) for pair_id in stale_pair_ids]
+                )
+        logger.info(f"Loaded {len(self.active_pairs) // 2} active pairs, closed {len(stale_pair_ids)} stale ones.")
+
+    def register_pair(self, user1_id: int, user2_id: int, pair_id: int):
+        """Adds a freshly created pair to the active-pair index."""
+        self.active_pairs[user1_id] = (user2_id, pair_id)
+        self.active_pairs[user2_id] = (user1_id, pair_id)
+
+    def unregister_pair(self, user_id: int) -> tuple[int, int] | None:
+        """Removes the user's pair from the index and returns (partner_id, pair_id)."""
+        pair = self.active_pairs.pop(user_id, None)
+        if pair:
+            partner_id, pair_id = pair
+            if self.active_pairs.get(partner_id, (None, None))[1] == pair_id:
+                del self.active_pairs[partner_id]
+        return pair
+
+    async def match_or_wait(self, user_id: int, interests: tuple[str, ...] = ()) -> tuple[str, tuple[int, int] | None, float | None]:
+        # Checking the user's state and claiming a partner happen under one lock so that
+        # a waiting user can never be handed to two /connect updates at once
+        async with self.matchmaker.lock:
+            if user_id in self.banned_user_ids:
+                return "banned", None, None
+            if user_id in self.active_pairs:
+                return "chatting", None, None
+            if user_id in self.matchmaker:
+                return "already_waiting", None, None
+            match = self.matchmaker.take_partner(user_id, interests)
+            if not match:
+                self.matchmaker.enqueue(user_id, interests=interests)
+                return "waiting", None, None
+            partner_id, enqueued_at, partner_interests = match
+            try:
+                cursor = await db.execute(
+                    "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)",
+                    (user_id, partner_id)
+                )
+            except Exception:
+                self.matchmaker.requeue(partner_id, enqueued_at, partner_interests)
+                raise
+            self.register_pair(user_id, partner_id, cursor.lastrowid)
+            return "paired", (partner_id, cursor.lastrowid), time.time() - enqueued_at
+
+    async def fallback_pairs(self) -> list[tuple[int, int, int, float, float]]:
+        pairs = []
+        async with self.matchmaker.lock:
+            while match := self.matchmaker.take_fallback_pair():
+                (user1_id, enqueued1_at, interests1), (user2_id, enqueued2_at, interests2) = match
+                try:
+                    cursor = await db.execute(
+                        "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)",
+                        (user1_id, user2_id)
+                    )
+                except Exception:
+                    self.matchmaker.requeue(user2_id, enqueued2_at, interests2)
+                    self.matchmaker.requeue(user1_id, enqueued1_at, interests1)
+                    raise
+                self.register_pair(user1_id, user2_id, cursor.lastrowid)
+                now = time.time()
+                pairs.append((cursor.lastrowid, user1_id, user2_id, now - enqueued1_at, now - enqueued2_at))
+        return pairs
+
+    async def get_pair(self, user_id: int) -> tuple[int, int] | None:
+        return self.active_pairs.get(user_id)
+
+    async def end_chat(self, user_id: int, partner_id: int | None = None) -> tuple[int, int] | None:
+        pair = self.active_pairs.get(user_id)
+        if not pair or (partner_id is not None and pair[0] != partner_id):
+            return None
+        # The index is updated before awaiting so concurrent handlers see the chat as ended at once
+        self.unregister_pair(user_id)
+        self.matchmaker.remember_split(user_id, pair[0])
+        await db.transaction(close_pair, pair[1])
+        return pair
+
+    async def leave(self, user_id: int) -> tuple[tuple[int, int] | None, bool]:
+        async with self.matchmaker.lock:
+            pair = await self.end_chat(user_id)
+            if pair:
+                return pair, False
+            return None, self.matchmaker.cancel(user_id)
+
+    async def end_chats(self, chats: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        closed = []
+        for pair_id, user1_id, user2_id in chats:
+            if self.active_pairs.get(user1_id) == (user2_id, pair_id):
+                self.unregister_pair(user1_id)
+                self.matchmaker.remember_split(user1_id, user2_id)
+                closed.append((pair_id, user1_id, user2_id))
+        if closed:
+            await db.executemany(
+                "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ? AND disconnected_at IS NULL",
+                [(pair_id,) for pair_id, _, _ in closed]
+            )
+        return closed
+
+    async def expire_waiting(self, cutoff: float) -> list[int]:
+        async with self.matchmaker.lock:
+            return self.matchmaker.expire(cutoff)
+
+    async def open_chats(self) -> list[tuple[int, int, int]]:
+        return [
+            (pair_id, user_id, partner_id)
+            for user_id, (partner_id, pair_id) in self.active_pairs.items() if user_id < partner_id
+        ]
+
+    async def is_banned(self, user_id: int) -> bool:
+        return user_id in self.banned_user_ids
+
+    async def is_sudo(self, user_id: int) -> bool:
+        return user_id in self.sudo_user_ids
+
+    async def set_banned(self, user_id: int, banned: bool):
+        if banned:
+            self.banned_user_ids.add(user_id)
+            self.matchmaker.cancel(user_id)
+        else:
+            self.banned_user_ids.discard(user_id)
+
+    async def set_sudo(self, user_id: int, sudo: bool):
+        if sudo:
+            self.sudo_user_ids.add(user_id)
+        else:
+            self.sudo_user_ids.discard(user_id)
+
+    async def counts(self) -> tuple[int, int]:
+        return len(self.matchmaker), len(self.active_pairs) // 2
+
+class SQLiteSharedState(StateBackend):
+    """Keeps all state in the database so several bot processes can share one pairing pool.
+
+    Every worker opens the same DB_FILE. Pairing runs in a BEGIN IMMEDIATE transaction, which
+    holds SQLite's write lock across all processes, so a waiting user is claimed exactly once
+    and a user queued by one worker can be paired by another. Lookups are indexed reads on
+    the database thread instead of dict accesses.
+    """
+
+    shared = True
+
+    def load(self, conn: sqlite3.Connection):
+        waiting = conn.execute("SELECT COUNT(*) FROM waiting_queue").fetchone()[0]
+        logger.info(f"Using the shared SQLite state in {DB_FILE} ({waiting} users waiting).")
+
+    @staticmethod
+    def _pair(conn: sqlite3.Connection, user_id: int) -> tuple[int, int] | None:
+        row = conn.execute(ACTIVE_PAIR_SQL, (user_id, user_id)).fetchone()
+        return (row['partner_id'], row['id']) if row else None
+
+    @staticmethod
+    def _claim(conn: sqlite3.Connection, sql: str, user_id: int, *condition) -> sqlite3.Row | None:
+        return conn.execute(sql, (*condition, user_id, MATCH_SCAN_LIMIT, user_id, user_id)).fetchone()
+
+    def _anyone(self, conn: sqlite3.Connection, user_id: int, now: float) -> sqlite3.Row | None:
+        """The longest-waiting suitable user who takes anyone: no interests, or INTEREST_MATCH_WAIT is over."""
+        candidates = [
+            self._claim(conn, CLAIM_ANYONE_SQL, user_id),
+            self._claim(conn, CLAIM_WAITED_SQL, user_id, now - INTEREST_MATCH_WAIT),
+        ]
+        return min((row for row in candidates if row), key=lambda row: row['enqueued_at'], default=None)
+
+    @staticmethod
+    def _dequeue(conn: sqlite3.Connection, user_id: int) -> bool:
+        conn.execute("DELETE FROM waiting_interests WHERE user_id = ?", (user_id,))
+        return conn.execute("DELETE FROM waiting_queue WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    def _match_or_wait(self, conn: sqlite3.Connection, user_id: int, interests: tuple[str, ...]):
+        if conn.execute("SELECT 1 FROM banned_users WHERE user_id = ?", (user_id,)).fetchone():
+            return "banned", None, None
+        if self._pair(conn, user_id):
+            return "chatting", None, None
+        if conn.execute("SELECT 1 FROM waiting_queue WHERE user_id = ?", (user_id,)).fetchone():
+            return "already_waiting", None, None
+        now = time.time()
+        conn.execute("DELETE FROM recent_splits WHERE split_at < ?", (now - RECENT_PARTNER_WINDOW,))
+        if interests:
+            candidates = [self._claim(conn, CLAIM_BY_INTEREST_SQL, user_id, tag) for tag in interests]
+            match = min((row for row in candidates if row), key=lambda row: row['enqueued_at'], default=None)
+        else:
+            match = self._anyone(conn, user_id, now)
+        if not match:
+            conn.execute(
+                "INSERT INTO waiting_queue (user_id, enqueued_at, has_interests) VALUES (?, ?, ?)",
+                (user_id, now, bool(interests))
+            )
+            conn.executemany(
+                "INSERT INTO waiting_interests (tag, enqueued_at, user_id) VALUES (?, ?, ?)",
+                [(tag, now, user_id) for tag in interests]
+            )
+            return "waiting", None, None
+        self._dequeue(conn, match['user_id'])
+        cursor = conn.execute("INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)", (user_id, match['user_id']))
+        return "paired", (match['user_id'], cursor.lastrowid), now - match['enqueued_at']
+
+    async def match_or_wait(self, user_id: int, interests: tuple[str, ...] = ()) -> tuple[str, tuple[int, int] | None, float | None]:
+        return await db.transaction(self._match_or_wait, user_id, interests, immediate=True)
+
+    def _fallback_pairs(self, conn: sqlite3.Connection):
+        pairs = []
+        now = time.time()
+        conn.execute("DELETE FROM recent_splits WHERE split_at < ?", (now - RECENT_PARTNER_WINDOW,))
+        paired = True
+        while paired:
+            paired = False
+            waited = conn.execute(
+                "SELECT user_id, enqueued_at FROM waiting_queue WHERE enqueued_at <= ? ORDER BY enqueued_at LIMIT ?",
+                (now - INTEREST_MATCH_WAIT, MATCH_SCAN_LIMIT)
+            ).fetchall()
+            for user in waited:
+                partner = self._anyone(conn, user['user_id'], now)
+                if partner:
+                    self._dequeue(conn, user['user_id'])
+                    self._dequeue(conn, partner['user_id'])
+                    cursor = conn.execute(
+                        "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)", (user['user_id'], partner['user_id'])
+                    )
+                    pairs.append((cursor.lastrowid, user['user_id'], partner['user_id'], now - user['enqueued_at'], now - partner['enqueued_at']))
+                    paired = True
+                    break
+        return pairs
+
+    async def fallback_pairs(self) -> list[tuple[int, int, int, float, float]]:
+        return await db.transaction(self._fallback_pairs, immediate=True)
+
+    async def get_pair(self, user_id: int) -> tuple[int, int] | None:
+        return await db.run(self._pair, user_id)
+
+    def _end_chat(self, conn: sqlite3.Connection, user_id: int, partner_id: int | None):
+        pair = self._pair(conn, user_id)
+        if not pair or (partner_id is not None and pair[0] != partner_id):
+            return None
+        close_pair(conn, pair[1])
+        conn.execute(
+            "INSERT OR REPLACE INTO recent_splits (user_low, user_high, split_at) VALUES (?, ?, ?)",
+            (min(user_id, pair[0]), max(user_id, pair[0]), time.time())
+        )
+        return pair
+
+    async def end_chat(self, user_id: int, partner_id: int | None = None) -> tuple[int, int] | None:
+        return await db.transaction(self._end_chat, user_id, partner_id, immediate=True)
+
+    async def leave(self, user_id: int) -> tuple[tuple[int, int] | None, bool]:
+        def leave(conn: sqlite3.Connection):
+            pair = self._end_chat(conn, user_id, None)
+            if pair:
+                return pair, False
+            return None, self._dequeue(conn, user_id)
+        return await db.transaction(leave, immediate=True)
+
+    async def end_chats(self, chats: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        def end_chats(conn: sqlite3.Connection):
+            closed = []
+            now = time.time()
+            for pair_id, user1_id, user2_id in chats:
+                cursor = conn.execute(
+                    "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ? AND disconnected_at IS NULL",
+                    (pair_id,)
+                )
+                if cursor.rowcount:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO recent_splits (user_low, user_high, split_at) VALUES (?, ?, ?)",
+                        (min(user1_id, user2_id), max(user1_id, user2_id), now)
+                    )
+                    closed.append((pair_id, user1_id, user2_id))
+            return closed
+        return await db.transaction(end_chats, immediate=True)
+
+    async def expire_waiting(self, cutoff: float) -> list[int]:
+        def expire(conn: sqlite3.Connection):
+            user_ids = [row['user_id'] for row in conn.execute("DELETE FROM waiting_queue WHERE enqueued_at < ? RETURNING user_id", (cutoff,))]
+            conn.executemany("DELETE FROM waiting_interests WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+            return user_ids
+        return await db.transaction(expire, immediate=True)
+
+    async def open_chats(self) -> list[tuple[int, int, int]]:
+        rows = await db.fetchall("SELECT id, user1_id, user2_id FROM chat_pairs WHERE disconnected_at IS NULL")
+        return [(row['id'], row['user1_id'], row['user2_id']) for row in rows]
+
+    async def is_banned(self, user_id: int) -> bool:
+        return await db.fetchone("SELECT 1 FROM banned_users WHERE user_id = ?", (user_id,)) is not None
+
+    async def is_sudo(self, user_id: int) -> bool:
+        return await db.fetchone("SELECT 1 FROM sudo_users WHERE user_id = ?", (user_id,)) is not None
+
+    async def counts(self) -> tuple[int, int]:
+        row = await db.fetchone(
+            "SELECT (SELECT COUNT(*) FROM waiting_queue) AS waiting, "
+            "(SELECT COUNT(*) FROM chat_pairs WHERE disconnected_at IS NULL) AS pairs"
+        )
+        return row['waiting'], row['pairs']
+
+STATE_BACKENDS = {"memory": InProcessState, "sqlite": SQLiteSharedState}
+state: StateBackend = InProcessState()
+
+STATE_SNAPSHOT_VERSION = 1
+
+def read_state_snapshot() -> dict | None:
+    """Reads STATE_SNAPSHOT_FILE, or returns None if there is no usable snapshot."""
+    try:
+        with open(STATE_SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable state snapshot {STATE_SNAPSHOT_FILE}: {e}")
+        return None
+    if snapshot.get("version") != STATE_SNAPSHOT_VERSION:
+        logger.warning(f"Ignoring state snapshot {STATE_SNAPSHOT_FILE} with unknown version {snapshot.get('version')}.")
+        return None
+    return snapshot
+
+def write_state_snapshot(snapshot: dict):
+    """Replaces STATE_SNAPSHOT_FILE atomically, so a crash mid-write leaves the previous snapshot intact."""
+    temporary = STATE_SNAPSHOT_FILE + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, STATE_SNAPSHOT_FILE)
+
+async def save_state_snapshot():
+    # Taken on the event loop without awaiting, so the queue and the pairs are consistent with each other
+    snapshot = state.snapshot()
+    if snapshot is not None:
+        await asyncio.to_thread(write_state_snapshot, snapshot)
+
+async def state_snapshot_job(context: CallbackContext) -> None:
+    try:
+        await save_state_snapshot()
+    except Exception as e:
+        logger.error(f"Saving the state snapshot failed: {e}")
+
+# --- Outbound Sending ---
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of up to `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    def try_acquire(self) -> bool:
+        """Takes a token if one is available, without waiting."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self) -> float:
+        """Takes a token now and returns how many seconds to wait before using it."""
+        self._refill(time.monotonic())
+        # A negative balance is the queue of reservations ahead of this one
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self):
+        """Takes a token, waiting for it if necessary. Waiters are served in arrival order."""
+        if wait := self.reserve():
+            await asyncio.sleep(wait)
+
+class OutboundDispatcher:
+    """Central queue for every Bot API call the bot makes.
+
+    Calls wait in one FIFO queue per chat, paced by that chat's token bucket, so they keep their
+    order. Once a chat's next call has its token it moves to a priority queue served by a pool of
+    workers, paced by a global token bucket; a worker never waits on a single chat, so a busy chat
+    can't hold up the other lanes. The bot stays just under Telegram's flood limits instead of
+    hitting them. RetryAfter errors are retried after the delay Telegram asks for; any other error
+    is raised to the caller, or logged for calls queued with post().
+    """
+
+    def __init__(self):
+        self._ready: asyncio.PriorityQueue | None = None
+        self._room: asyncio.Semaphore | None = None
+        self._idle: asyncio.Event | None = None
+        self._take_lock: asyncio.Lock | None = None
+        self._workers: list[asyncio.Task] = []
+        # Calls queued with post() whose result nobody awaits
+        self._posted: set[asyncio.Task] = set()
+        self._sequence = itertools.count()
+        self._global_bucket: TokenBucket | None = None
+        # chat_id -> calls waiting behind the one that is scheduled or in flight
+        self._pending: dict[int, deque] = {}
+        # chat_id -> token bucket, least recently used first
+        self._buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._queued = 0
+        self._unfinished = 0
+        self.queued_by_priority = {PRIORITY_RELAY: 0, PRIORITY_NOTICE: 0, PRIORITY_ADMIN: 0, PRIORITY_BROADCAST: 0}
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        self._ready = asyncio.PriorityQueue()
+        self._room = asyncio.Semaphore(SEND_QUEUE_SIZE)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._take_lock = asyncio.Lock()
+        self._global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(SEND_WORKERS)]
+
+    async def stop(self):
+        """Waits for queued calls to go out, then stops the workers."""
+        if not self._workers:
+            return
+        while self._posted:
+            await asyncio.gather(*self._posted)
+        await self._idle.wait()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queued,
+            "queued_by_priority": dict(self.queued_by_priority),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    async def submit(self, chat_id: int | None, method, *args, priority: int = PRIORITY_NOTICE, **kwargs):
+        """Queues method(*args, **kwargs), a call addressed to chat_id, and returns its result."""
+        await self._room.acquire()
+        future = asyncio.get_running_loop().create_future()
+        call = (priority, next(self._sequence), chat_id, method, args, kwargs, future)
+        self._queued += 1
+        self._unfinished += 1
+        self._idle.clear()
+        self.queued_by_priority[priority] += 1
+        if chat_id is None:
+            self._ready.put_nowait(call)
+        elif chat_id in self._pending:
+            self._pending[chat_id].append(call)
+        else:
+            self._pending[chat_id] = deque()
+            self._schedule(call)
+        return await future
+
+    def post(self, chat_id: int | None, method, *args, priority: int = PRIORITY_NOTICE, **kwargs):
+        """Queues a call like submit() without waiting for it to go out. Calls keep the order they were posted in.
+
+        For notifications a handler shouldn't wait for, e.g. to the admin group, whose lane is
+        paced slowly. A failure is logged rather than raised.
+        """
+        task = asyncio.create_task(self._post(chat_id, method, args, priority, kwargs))
+        self._posted.add(task)
+        task.add_done_callback(self._posted.discard)
+
+    async def _post(self, chat_id: int | None, method, args: tuple, priority: int, kwargs: dict):
+        try:
+            await self.submit(chat_id, method, *args, priority=priority, **kwargs)
+        except Exception as e:
+            logger.error("Posted %s to %s failed: %s", method.__name__, chat_id, e, extra={"event": "send_failed", "method": method.__name__})
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_CHAT_SEND_RATE, 1)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_SEND_RATE, PRIVATE_CHAT_SEND_BURST)
+            self._buckets[chat_id] = bucket
+            self._evict_idle_chats()
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _evict_idle_chats(self):
+        # Least recently used first; chats with calls queued are still in use and go to the back
+        skipped = 0
+        while len(self._buckets) > SEND_CHAT_STATE_LIMIT:
+            chat_id = next(iter(self._buckets))
+            if chat_id not in self._pending:
+                del self._buckets[chat_id]
+            elif skipped < len(self._pending):
+                self._buckets.move_to_end(chat_id)
+                skipped += 1
+            else:
+                break
+
+    def _schedule(self, call: tuple):
+        """Hands a chat's next call to the workers once the chat's bucket has a token for it."""
+        if call[-1].cancelled():
+            self._ready.put_nowait(call)  # Nothing is sent, so it needs no token
+            return
+        wait = self._bucket(call[2]).reserve()
+        if wait:
+            asyncio.get_running_loop().call_later(wait, self._ready.put_nowait, call)
+        else:
+            self._ready.put_nowait(call)
+
+    def _finished(self, chat_id: int | None):
+        if chat_id is not None:
+            waiting = self._pending[chat_id]
+            if waiting:
+                self._schedule(waiting.popleft())
+            else:
+                del self._pending[chat_id]
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            # One worker at a time waits for the global bucket, holding the call it took
+            async with self._take_lock:
+                priority, _, chat_id, method, args, kwargs, future = await self._ready.get()
+                self._queued -= 1
+                self.queued_by_priority[priority] -= 1
+                self._room.release()
+                if not future.cancelled():
+                    await self._global_bucket.acquire()
+            try:
+                if future.cancelled():
+                    continue
+                result = await self._call_with_retry(method, args, kwargs)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._finished(chat_id)
+
+    async def _call_with_retry(self, method, args: tuple, kwargs: dict):
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            try:
+                result = await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    TELEGRAM_CALLS.inc(method.__name__, "error")
+                    raise
+                TELEGRAM_CALLS.inc(method.__name__, "retry")
+                self.retried += 1
+                delay = e.retry_after
+                if not isinstance(delay, (int, float)):
+                    delay = delay.total_seconds()
+                logger.warning("Flood limit hit on %s, retrying in %ss", method.__name__, delay, extra={"event": "send_retry", "method": method.__name__})
+                await asyncio.sleep(delay)
+            except Exception:
+                TELEGRAM_CALLS.inc(method.__name__, "error")
+                raise
+            else:
+                TELEGRAM_CALLS.inc(method.__name__, "success")
+                return result
+
+dispatcher = OutboundDispatcher()
+
+async def send(method, chat_id: int, *args, priority: int = PRIORITY_NOTICE, **kwargs):
+    """Sends method(chat_id, *args, **kwargs), e.g. context.bot.send_message, through the dispatcher."""
+    return await dispatcher.submit(chat_id, method, chat_id, *args, priority=priority, **kwargs)
+
+def post(method, chat_id: int, *args, priority: int = PRIORITY_NOTICE, **kwargs):
+    """Like send(), but returns as soon as the call is queued; delivery failures are only logged."""
+    dispatcher.post(chat_id, method, chat_id, *args, priority=priority, **kwargs)
+
+async def reply(update: Update, text: str, **kwargs):
+    """Replies in the chat the update came from, through the dispatcher."""
+    return await send(update.get_bot().send_message, update.effective_chat.id, text, **kwargs)
+
+# --- Statistics ---
+STATS_HOURS_IN_MEMORY = 25  # Enough hourly buckets to answer "last 24 hours" at any minute of the hour
+STATS_SESSION_LIMIT = 100000  # Start times kept for chats still open, for the average session length
+
+class StatsTracker:
+    """Usage counters kept up to date as events happen, so /stats never counts table rows.
+
+    Counts go into the bucket of the current hour and into all-time totals. The increments that
+    have not been written yet are added to the stats table by the snapshot job (an upsert per
+    hour and name), which also lets several bot processes add to the same rows.
+
+    The in-memory counts only cover this process. With a shared state backend, /stats reads the
+    windows from the stats table instead and adds what this process has not saved yet.
+    """
+
+    def __init__(self):
+        # Hour start (epoch seconds) -> counts, oldest first
+        self._hours: OrderedDict[int, Counter] = OrderedDict()
+        self.totals: Counter = Counter()
+        self._unsaved: Counter = Counter()
+        # pair_id -> time the chat started, for chats started by this process
+        self._session_starts: dict[int, float] = {}
+
+    def record(self, name: str, amount: float = 1):
+        hour = int(time.time()) // 3600 * 3600
+        bucket = self._hours.get(hour)
+        if bucket is None:
+            bucket = self._hours[hour] = Counter()
+            while len(self._hours) > STATS_HOURS_IN_MEMORY:
+                self._hours.popitem(last=False)
+        bucket[name] += amount
+        self.totals[name] += amount
+        self._unsaved[(hour, name)] += amount
+
+    def message(self, media_type: str | None):
+        self.record(f"messages_{media_type or 'text'}")
+
+    def chat_started(self, pair_id: int):
+        self.record("chats_started")
+        self._session_starts[pair_id] = time.time()
+        if len(self._session_starts) > STATS_SESSION_LIMIT:
+            # Chats ended by another process never come back here; forget the oldest
+            del self._session_starts[next(iter(self._session_starts))]
+
+    def chat_ended(self, pair_id: int):
+        self.record("chats_ended")
+        started = self._session_starts.pop(pair_id, None)
+        if started is not None:
+            self.record("sessions_timed")
+            self.record("session_seconds", time.time() - started)
+
+    def window(self, hours: int) -> Counter:
+        """Sums the counts of the last `hours` hours, the current one included."""
+        since = int(time.time()) // 3600 * 3600 - (hours - 1) * 3600
+        total = Counter()
+        for hour, bucket in reversed(self._hours.items()):
+            if hour < since:
+                break
+            total.update(bucket)
+        return total
+
+    def windows(self) -> tuple[Counter, Counter, Counter]:
+        """Counts of the last hour, the last 24 hours and all time, as this process saw them."""
+        return self.window(1), self.window(24), self.totals
+
+    @staticmethod
+    def read_windows(conn: sqlite3.Connection) -> tuple[Counter, Counter, Counter]:
+        """The same windows summed from the stats table, i.e. the counts every worker has saved.
+
+        Reads the hourly rows of the last 24 hours and the totals row, so it doesn't grow with history.
+        """
+        current = int(time.time()) // 3600 * 3600
+        last_hour, last_day, totals = Counter(), Counter(), Counter()
+        for row in conn.execute("SELECT hour, name, value FROM stats WHERE hour >= ?", (current - 23 * 3600,)):
+            last_day[row['name']] += row['value']
+            if row['hour'] == current:
+                last_hour[row['name']] += row['value']
+        for row in conn.execute("SELECT name, value FROM stats WHERE hour = 0"):
+            totals[row['name']] = row['value']
+        return last_hour, last_day, totals
+
+    def add_unsaved(self, windows: tuple[Counter, Counter, Counter]):
+        """Adds the counts this process has not written to the stats table yet to read_windows()."""
+        current = int(time.time()) // 3600 * 3600
+        last_hour, last_day, totals = windows
+        for (hour, name), amount in self._unsaved.items():
+            totals[name] += amount
+            if hour > current - 24 * 3600:
+                last_day[name] += amount
+            if hour == current:
+                last_hour[name] += amount
+
+    def load(self, conn: sqlite3.Connection):
+        """Loads the totals and the recent hours from the stats table on startup."""
+        since = int(time.time()) // 3600 * 3600 - (STATS_HOURS_IN_MEMORY - 1) * 3600
+        for row in conn.execute("SELECT name, value FROM stats WHERE hour = 0"):
+            self.totals[row['name']] = row['value']
+        for row in conn.execute("SELECT hour, name, value FROM stats WHERE hour >= ? ORDER BY hour", (since,)):
+            self._hours.setdefault(row['hour'], Counter())[row['name']] = row['value']
+
+    def save(self, conn: sqlite3.Connection, increments: Counter):
+        """Adds increments taken with take_unsaved() to the stats table. Runs inside Database.transaction."""
+        totals = Counter()
+        for (hour, name), amount in increments.items():
+            totals[name] += amount
+        rows = [(hour, name, amount) for (hour, name), amount in increments.items()]
+        rows += [(0, name, amount) for name, amount in totals.items()]
+        conn.executemany(
+            "INSERT INTO stats (hour, name, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (hour, name) DO UPDATE SET value = value + excluded.value",
+            rows
+        )
+        cutoff = int(time.time()) - STATS_HISTORY_DAYS * 86400
+        conn.execute("DELETE FROM stats WHERE hour > 0 AND hour < ?", (cutoff,))
 
-logger = logging.getLogger(__name__)
+    def take_unsaved(self) -> Counter:
+        increments, self._unsaved = self._unsaved, Counter()
+        return increments
 
-# --- Database ---
-DB_FILE = "omegle_bot.db"
+    def restore_unsaved(self, increments: Counter):
+        """Puts increments back after a failed save so the next snapshot retries them."""
+        self._unsaved.update(increments)
 
-def get_db_connection():
-    """Creates and returns a database connection."""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+stats = StatsTracker()
 
-def setup_database(conn: sqlite3.Connection):
-    """Creates tables if they don't exist. Updates the schema if needed."""
-    with conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_pairs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user1_id INTEGER NOT NULL,
-                user2_id INTEGER NOT NULL,
-                connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                disconnected_at TIMESTAMP
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                pair_id INTEGER NOT NULL,
-                sender_id INTEGER NOT NULL,
-                message_text TEXT,
-                media_type TEXT,
-                media_id TEXT,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (pair_id) REFERENCES chat_pairs(id)
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS banned_users (
-                user_id INTEGER PRIMARY KEY,
-                reason TEXT,
-                banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                banned_by_admin_id INTEGER
-            )
-        ''')
-        # Attempt to add the new column to an existing table if it's missing
-        try:
-            conn.execute("ALTER TABLE banned_users ADD COLUMN banned_by_admin_id INTEGER;")
-            logger.info("Column 'banned_by_admin_id' added to 'banned_users' table.")
-        except sqlite3.OperationalError:
-            # Column already exists, which is fine
-            pass
-            
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS sudo_users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                reporter_id INTEGER,
-                reported_id INTEGER,
-                reason TEXT,
-                reported_message_text TEXT,
-                reported_media_id TEXT,
-                reported_media_type TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending' -- pending, accepted, rejected
-            )
-        ''')
-    logger.info("Database setup complete.")
+async def save_stats():
+    increments = stats.take_unsaved()
+    if not increments:
+        return
+    try:
+        await db.transaction(stats.save, increments)
+    except Exception:
+        stats.restore_unsaved(increments)
+        raise
 
-# --- In-memory state (for waiting users only) ---
-waiting_users = []
+async def stats_snapshot_job(context: CallbackContext) -> None:
+    try:
+        await save_stats()
+    except Exception as e:
+        logger.error(f"Saving statistics failed: {e}")
 
 # --- Helper Functions ---
 async def is_sudo_user(user_id: int) -> bool:
     """Checks if a user is an admin."""
-    with get_db_connection() as conn:
-        cursor = conn.execute("SELECT 1 FROM sudo_users WHERE user_id = ?", (user_id,))
-        return cursor.fetchone() is not None
+    return await state.is_sudo(user_id)
 
-async def get_ban_info(user_id: int) -> tuple | None:
-    """Checks if a user is banned and returns their ban details."""
-    with get_db_connection() as conn:
-        cursor = conn.execute(
-            "SELECT reason, banned_at, banned_by_admin_id FROM banned_users WHERE user_id = ?",
-            (user_id,)
-        )
-        return cursor.fetchone()
+async def is_banned(user_id: int) -> bool:
+    """Checks if a user is banned."""
+    return await state.is_banned(user_id)
 
-async def get_active_partner(user_id: int) -> int | None:
-    """Gets the active partner's ID from the database."""
-    with get_db_connection() as conn:
-        cursor = conn.execute(
-            "SELECT user1_id, user2_id FROM chat_pairs WHERE (user1_id = ? OR user2_id = ?) AND disconnected_at IS NULL",
-            (user_id, user_id)
-        )
-        pair = cursor.fetchone()
-        if pair:
-            return pair['user2_id'] if pair['user1_id'] == user_id else pair['user1_id']
-    return None
+async def get_ban_info(user_id: int) -> tuple | None:
+    """Reads a user's full ban record from the database (used by /checkban)."""
+    return await db.fetchone(
+        "SELECT reason, banned_at, banned_by_admin_id FROM banned_users WHERE user_id = ?",
+        (user_id,)
+    )
 
-async def disconnect_user(user_id: int, partner_id: int, conn: sqlite3.Connection):
-    """Handles the logic of disconnecting a pair in the database."""
+def record_ban(conn: sqlite3.Connection, user_id: int, reason: str, admin_id: int | None):
+    """Stores a ban. Runs inside Database.transaction."""
     conn.execute(
-        "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE ((user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)) AND disconnected_at IS NULL",
-        (user_id, partner_id, partner_id, user_id)
+        "INSERT OR REPLACE INTO banned_users (user_id, reason, banned_by_admin_id) VALUES (?, ?, ?)",
+        (user_id, reason, admin_id)
+    )
+    # Leave the shared waiting queue in the same transaction: a /connect that queued them just
+    # before the ban is undone here, and one after it sees the ban. Both tables stay empty with
+    # the in-process backend, whose set_banned takes the user out of its own queue.
+    conn.execute("DELETE FROM waiting_interests WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM waiting_queue WHERE user_id = ?", (user_id,))
+
+class ChatActivity:
+    """When each open chat last relayed a message, least recently active first.
+
+    touch() moves a chat to the back in O(1), so the reaper finds idle chats at the front
+    without looking at the active ones. Kept in memory; each process tracks what it relays.
+    """
+
+    def __init__(self):
+        # pair_id -> (last activity, user1_id, user2_id)
+        self._chats: OrderedDict[int, tuple[float, int, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def touch(self, pair_id: int, user1_id: int, user2_id: int, at: float | None = None):
+        self._chats.pop(pair_id, None)
+        self._chats[pair_id] = (at or time.time(), user1_id, user2_id)
+
+    def forget(self, pair_id: int):
+        self._chats.pop(pair_id, None)
+
+    def idle(self, cutoff: float, limit: int) -> list[tuple[int, int, int]]:
+        """(pair_id, user1_id, user2_id) of up to `limit` chats with no activity since cutoff."""
+        chats = []
+        for pair_id, (last_active, user1_id, user2_id) in self._chats.items():
+            if last_active >= cutoff or len(chats) >= limit:
+                break
+            chats.append((pair_id, user1_id, user2_id))
+        return chats
+
+activity = ChatActivity()
+
+def chat_started(pair_id: int, user1_id: int, user2_id: int):
+    stats.chat_started(pair_id)
+    activity.touch(pair_id, user1_id, user2_id)
+
+def chat_ended(pair_id: int):
+    stats.chat_ended(pair_id)
+    activity.forget(pair_id)
+
+PARTNER_FOUND_TEXT = "✅ Partner found! Enjoy your chat.\nUse /disconnect to end it, or /reconnect to find someone new."
+
+async def announce_pair(bot, user_id: int, partner_id: int, pair_id: int):
+    """Starts tracking a new chat and tells both users, the one who was waiting (partner_id) first."""
+    chat_started(pair_id, user_id, partner_id)
+    try:
+        await send(bot.send_message, partner_id, PARTNER_FOUND_TEXT)
+    except Forbidden:
+        # The partner blocked the bot while waiting; the user hasn't heard of them, so just look again
+        await partner_blocked_bot(bot, user_id, partner_id, notify=False)
+        status, pair, waited = await state.match_or_wait(user_id, await get_interests(user_id))
+        if status == "paired":
+            MATCH_WAIT_SECONDS.observe(waited)
+            await announce_pair(bot, user_id, *pair)
+        elif status == "waiting":
+            await send(bot.send_message, user_id, "⏳ Searching for a partner... Please wait.")
+        return
+    await send(bot.send_message, user_id, PARTNER_FOUND_TEXT)
+
+def parse_interests(words: list[str]) -> tuple[str, ...]:
+    """Normalizes /interests arguments to unique lowercase tags: ["#Music,", "gaming"] -> ("music", "gaming")."""
+    tags = []
+    for word in " ".join(words).replace(",", " ").split():
+        tag = "".join(ch for ch in word.lower() if ch.isalnum() or ch == "_")[:MAX_INTEREST_LENGTH]
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tuple(tags[:MAX_INTERESTS])
+
+async def get_interests(user_id: int) -> tuple[str, ...]:
+    rows = await db.fetchall("SELECT tag FROM user_interests WHERE user_id = ? ORDER BY tag", (user_id,))
+    return tuple(row['tag'] for row in rows)
+
+async def partner_blocked_bot(bot, user_id: int, partner_id: int, notify: bool = True):
+    """Ends a chat at once when sending to the partner fails because they blocked the bot."""
+    pair = await state.end_chat(user_id, partner_id=partner_id)
+    await db.execute("UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE user_id = ?", (partner_id,))
+    if pair:
+        chat_ended(pair[1])
+        if notify:
+            await send(bot.send_message, user_id, "Your partner has left the chat. Use /connect to find a new partner.")
+        logger.info("Ended chat %s: %s blocked the bot", pair[1], partner_id,
+                    extra={"event": "partner_blocked", "user_id": user_id, "partner_id": partner_id, "pair_id": pair[1]})
+
+# Checked in order: an animation message also carries a `document`
+MEDIA_TYPES = ("video", "animation", "sticker", "voice", "video_note", "audio", "document")
+ALBUM_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "audio": InputMediaAudio, "document": InputMediaDocument}
+
+def extract_media(message) -> tuple[str | None, str | None]:
+    """Returns (media_type, file_id) for a message's attachment, or (None, None) for plain text."""
+    if message.photo:
+        return 'photo', message.photo[-1].file_id
+    for media_type in MEDIA_TYPES:
+        attachment = getattr(message, media_type)
+        if attachment:
+            return media_type, attachment.file_id
+    if message.effective_attachment:
+        # Locations, contacts, polls, dice... have no file to log
+        return type(message.effective_attachment).__name__.lower(), None
+    return None, None
+
+class AlbumRelay:
+    """Buffers album items (messages sharing a media_group_id) and relays each album as one send_media_group.
+
+    Telegram delivers every album item as a separate update. Items are collected for ALBUM_WINDOW
+    seconds after the first one arrives, then sent in a single call and logged together.
+    """
+
+    def __init__(self):
+        self._albums: dict[str, dict] = {}
+        self._album_by_user: dict[int, str] = {}
+        self._flushing: set[asyncio.Task] = set()
+
+    def add(self, bot, user_id: int, partner_id: int, pair_id: int, message):
+        media_group_id = message.media_group_id
+        album = self._albums.get(media_group_id)
+        if album is None:
+            timer = asyncio.get_running_loop().call_later(ALBUM_WINDOW, self._start_flush, media_group_id)
+            album = self._albums[media_group_id] = {
+                "bot": bot, "user_id": user_id, "partner_id": partner_id, "pair_id": pair_id,
+                "messages": [], "timer": timer,
+            }
+            self._album_by_user[user_id] = media_group_id
+        album["messages"].append(message)
+
+    async def flush_user(self, user_id: int):
+        """Relays the user's pending album right away so it isn't overtaken by their next message."""
+        media_group_id = self._album_by_user.get(user_id)
+        if media_group_id in self._albums:
+            self._albums[media_group_id]["timer"].cancel()
+            await self._flush(media_group_id)
+
+    async def flush_all(self):
+        """Relays every pending album (used on shutdown)."""
+        for media_group_id in list(self._albums):
+            self._albums[media_group_id]["timer"].cancel()
+            await self._flush(media_group_id)
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+    def _start_flush(self, media_group_id: str):
+        task = asyncio.create_task(self._flush(media_group_id))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, media_group_id: str):
+        album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return
+        user_id, partner_id, pair_id = album["user_id"], album["partner_id"], album["pair_id"]
+        if self._album_by_user.get(user_id) == media_group_id:
+            del self._album_by_user[user_id]
+        if await state.get_pair(user_id) != (partner_id, pair_id):
+            return  # The chat ended while the album was being collected
+
+        messages = sorted(album["messages"], key=lambda m: m.message_id)
+        records, media = [], []
+        for message in messages:
+            media_type, media_id = extract_media(message)
+            media.append(ALBUM_MEDIA[media_type](media_id, caption=message.caption, caption_entities=message.caption_entities))
+            records.append((message.caption, media_type, media_id))
+        try:
+            await send(album["bot"].send_media_group, partner_id, media, priority=PRIORITY_RELAY)
+        except Forbidden:
+            await partner_blocked_bot(album["bot"], user_id, partner_id)
+            return
+        except Exception as e:
+            logger.error("Failed to forward album from %s to %s: %s", user_id, partner_id, e,
+                         extra={"event": "relay_failed", "user_id": user_id, "partner_id": partner_id, "pair_id": pair_id})
+            await send(album["bot"].send_message, user_id, "An error occurred while sending your album. Please try again.")
+            return
+        activity.touch(pair_id, user_id, partner_id)
+        logger.info("Relayed an album of %s from %s to %s", len(records), user_id, partner_id,
+                    extra={"event": "relay", "user_id": user_id, "partner_id": partner_id, "pair_id": pair_id, "media_type": "album"})
+        for text, media_type, media_id in records:
+            stats.message(media_type)
+            await message_log.log(pair_id, user_id, text, media_type, media_id)
+
+album_relay = AlbumRelay()
+
+# --- Flood Control ---
+class FloodLimiter:
+    """Per-user token buckets for relayed messages, with cooldowns that grow on repeat offences.
+
+    check() is a dict lookup and a bucket refill, so it runs before any database or network work.
+    A user who empties their bucket gets a strike and a cooldown from FLOOD_COOLDOWNS; messages
+    during a cooldown are dropped without a reply. Strikes are forgotten after FLOOD_STRIKE_RESET
+    quiet seconds. Once more than FLOOD_STATE_LIMIT users are tracked, the least recently active
+    ones are forgotten unless they are still in a cooldown.
+    """
+
+    def __init__(self):
+        # user_id -> [bucket, strikes, end of cooldown, time of the last strike], least recently active first
+        self._users: OrderedDict[int, list] = OrderedDict()
+
+    def check(self, user_id: int) -> tuple[str, float, int]:
+        """Returns ("ok" | "cooldown" | "drop", cooldown seconds, strikes).
+
+        "cooldown" is returned once, for the message that started a cooldown; the messages after
+        it get "drop" until the cooldown is over.
+        """
+        now = time.monotonic()
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = [TokenBucket(FLOOD_RATE, FLOOD_BURST), 0, 0.0, 0.0]
+            if len(self._users) > FLOOD_STATE_LIMIT:
+                self._evict_idle(now)
+        else:
+            self._users.move_to_end(user_id)
+        bucket, strikes, cooldown_until, last_strike = entry
+        if now < cooldown_until:
+            return "drop", cooldown_until - now, strikes
+        if bucket.try_acquire():
+            return "ok", 0.0, strikes
+        if now - last_strike > FLOOD_STRIKE_RESET:
+            strikes = 0
+        strikes += 1
+        cooldown = FLOOD_COOLDOWNS[min(strikes, len(FLOOD_COOLDOWNS)) - 1]
+        entry[1:] = [strikes, now + cooldown, now]
+        return "cooldown", cooldown, strikes
+
+    def _evict_idle(self, now: float):
+        # Users who are still muted go to the back rather than have their cooldown lifted early
+        for _ in range(len(self._users)):
+            if len(self._users) <= FLOOD_STATE_LIMIT:
+                break
+            user_id, entry = next(iter(self._users.items()))
+            if now < entry[2]:
+                self._users.move_to_end(user_id)
+            else:
+                del self._users[user_id]
+
+flood_limiter = FloodLimiter()
+
+# The updates message_handler relays, which are the ones flood control counts
+RELAYED_MESSAGES = filters.UpdateType.MESSAGE & ~filters.COMMAND & ~filters.StatusUpdate.ALL & filters.ChatType.PRIVATE
+
+async def flood_limited(update: Update, verdict: str, cooldown: float, strikes: int):
+    """Tells a user who started a cooldown why their messages stop arriving, reporting repeat offenders."""
+    FLOOD_LIMITED.inc(verdict)
+    if verdict != "cooldown":
+        return
+    user_id = update.effective_user.id
+    await reply(update, f"⚠️ You are sending messages too fast. Your messages won't be delivered for {cooldown} seconds.")
+    logger.warning("User %s hit the flood limit (strike %s, %ss cooldown)", user_id, strikes, cooldown,
+                   extra={"event": "flood_limited", "user_id": user_id, "strikes": strikes, "cooldown_s": cooldown})
+    if strikes == FLOOD_REPORT_STRIKES:
+        await report_flooding(update.get_bot(), user_id, strikes)
+
+async def report_flooding(bot, user_id: int, strikes: int):
+    """Files a report against a user who keeps flooding and sends it to the admin group."""
+    pair = await state.get_pair(user_id)
+    reason = f"Automatic: flooding ({strikes} cooldowns in a row)"
+    cursor = await db.execute(
+        "INSERT INTO reports (reporter_id, reported_id, reason, pair_id) VALUES (NULL, ?, ?, ?)",
+        (user_id, reason, pair[1] if pair else None)
     )
+    report_id = cursor.lastrowid
+    stats.record("reports_submitted")
+    keyboard = [
+        [InlineKeyboardButton("✅ Accept (Ban)", callback_data=f"accept_report_{report_id}"),
+         InlineKeyboardButton("❌ Reject", callback_data=f"reject_report_{report_id}")]
+    ]
+    post(bot.send_message, ADMIN_GROUP_ID,
+        f"🚨 *New Report #{report_id}*\n\n"
+        f"🎯 *Reported User:*\n"
+        f"   ID: `{user_id}`\n\n"
+        f"📝 *Reason:*\n"
+        f"   `{reason}`",
+        reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', priority=PRIORITY_ADMIN)
+    logger.info("Report %s filed automatically against %s for flooding", report_id, user_id,
+                extra={"event": "report", "report_id": report_id, "reported_id": user_id, "pair_id": pair[1] if pair else None})
 
 # --- User Commands ---
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
-    with get_db_connection() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-            (user.id, user.username)
-        )
-    await update.message.reply_text(
+    cursor = await db.execute(
+        "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+        (user.id, user.username)
+    )
+    if cursor.rowcount:
+        stats.record("joins")
+    else:
+        # Sending /start again means the user unblocked the bot
+        await db.execute("UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL", (user.id,))
+    await reply(update,
         f"Welcome to *OmegleBot*, {user.first_name}!\n\n"
         "This bot lets you have anonymous chats with random users.\n\n"
         "Use /connect to find a chat partner.\n"
@@ -162,6 +2372,7 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "/connect - Find a random chat partner\n"
         "/disconnect - End your current chat\n"
         "/reconnect - End the current chat and find a new one\n"
+        "/interests - Meet people who share your interests\n"
         "/report - Report a user (use by replying to their message)\n"
         "/rules - Read the chat rules"
     )
@@ -172,17 +2383,26 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "`/delsudo <user_id>` - Remove an admin\n"
         "`/ban <user_id> <reason>` - Ban a user\n"
         "`/unban <user_id>` - Unban a user\n"
-        "`/checkban <user_id>` - Check a user's ban status"
+        "`/checkban <user_id>` - Check a user's ban status\n"
+        "`/stats` - Show usage statistics"
+    )
+    owner_text = (
+        "\n\n*Owner Commands:*\n"
+        "`/broadcast <text>` - Message every user (or reply to a message with /broadcast)\n"
+        "`/broadcast cancel` - Stop the running broadcast\n"
+        "`/profile <seconds>` - Profile the bot and write .pstats files"
     )
     
     full_text = user_text
     if is_admin:
         full_text += admin_text
+    if update.effective_user.id == BOT_OWNER_ID:
+        full_text += owner_text
         
-    await update.message.reply_text(full_text, parse_mode='Markdown')
+    await reply(update, full_text, parse_mode='Markdown')
 
 async def rules(update: Update, context: CallbackContext) -> None:
-    await update.message.reply_text(
+    await reply(update,
         "OmegleBot Rules:\n"
         "1. Be respectful and kind to others.\n"
         "2. Do not share personal information or ask for it.\n"
@@ -194,66 +2414,61 @@ async def rules(update: Update, context: CallbackContext) -> None:
 async def connect(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
 
-    if await get_ban_info(user_id):
-        await update.message.reply_text("You are permanently banned and cannot use this bot.")
+    if await is_banned(user_id):
+        await reply(update, "You are permanently banned and cannot use this bot.")
         return
 
-    if await get_active_partner(user_id):
-        await update.message.reply_text("You are already in a chat. Use /disconnect or /reconnect.")
+    status, pair, waited = await state.match_or_wait(user_id, await get_interests(user_id))
+    if status == "chatting":
+        await reply(update, "You are already in a chat. Use /disconnect or /reconnect.")
         return
-
-    if user_id in waiting_users:
-        await update.message.reply_text("You are already waiting for a partner. Please be patient.")
+    if status == "banned":
+        await reply(update, "You are permanently banned and cannot use this bot.")
+        return
+    if status == "already_waiting":
+        await reply(update, "You are already waiting for a partner. Please be patient.")
         return
 
-    if waiting_users:
-        partner_id = waiting_users.pop(0)
-        
-        with get_db_connection() as conn:
-            conn.execute(
-                "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)",
-                (user_id, partner_id)
-            )
-
-        await context.bot.send_message(user_id, "✅ Partner found! Enjoy your chat.\nUse /disconnect to end it, or /reconnect to find someone new.")
-        await context.bot.send_message(partner_id, "✅ Partner found! Enjoy your chat.\nUse /disconnect to end it, or /reconnect to find someone new.")
-        logger.info(f"Paired {user_id} with {partner_id}")
+    if status == "paired":
+        partner_id, pair_id = pair
+        MATCH_WAIT_SECONDS.observe(waited)
+        await announce_pair(context.bot, user_id, partner_id, pair_id)
+        logger.info("Paired %s with %s", user_id, partner_id,
+                    extra={"event": "paired", "partner_id": partner_id, "pair_id": pair_id, "waited_s": round(waited, 1)})
     else:
-        waiting_users.append(user_id)
-        await update.message.reply_text("⏳ Searching for a partner... Please wait.")
-        logger.info(f"User {user_id} is now waiting.")
+        await reply(update, "⏳ Searching for a partner... Please wait.")
+        logger.info("User %s is now waiting.", user_id, extra={"event": "waiting"})
         
 async def disconnect(update: Update, context: CallbackContext, silent: bool = False) -> None:
     """Disconnects the user. silent=True avoids sending messages (used by /reconnect)."""
     user_id = update.effective_user.id
-    partner_id = await get_active_partner(user_id)
+    pair, stopped_waiting = await state.leave(user_id)
 
-    if not partner_id:
-        if user_id in waiting_users:
-            waiting_users.remove(user_id)
+    if not pair:
+        if stopped_waiting:
             if not silent:
-                await update.message.reply_text("Stopped searching for a partner.")
+                await reply(update, "Stopped searching for a partner.")
         elif not silent:
-            await update.message.reply_text("You are not in any chat.")
+            await reply(update, "You are not in any chat.")
         return
-
-    with get_db_connection() as conn:
-        await disconnect_user(user_id, partner_id, conn)
+    partner_id, pair_id = pair
+    chat_ended(pair_id)
 
     if not silent:
-        await context.bot.send_message(user_id, "You have been disconnected.")
-    await context.bot.send_message(partner_id, "Your partner has disconnected.")
-    logger.info(f"User {user_id} disconnected from {partner_id}")
+        await send(context.bot.send_message, user_id, "You have been disconnected.")
+    await send(context.bot.send_message, partner_id, "Your partner has disconnected.")
+    logger.info("User %s disconnected from %s", user_id, partner_id,
+                extra={"event": "disconnect", "partner_id": partner_id, "pair_id": pair_id})
 
 async def reconnect(update: Update, context: CallbackContext) -> None:
     """Disconnects and immediately searches for a new partner."""
     user_id = update.effective_user.id
     
-    if await get_ban_info(user_id):
-        await update.message.reply_text("You are permanently banned and cannot use this bot.")
+    if await is_banned(user_id):
+        await reply(update, "You are permanently banned and cannot use this bot.")
         return
 
-    await update.message.reply_text("Ending the current chat and finding a new one...")
+    await reply(update, "Ending the current chat and finding a new one...")
     
     # Silently disconnect
     await disconnect(update, context, silent=True)
@@ -261,43 +2476,81 @@ async def reconnect(update: Update, context: CallbackContext) -> None:
     # Immediately connect
     await connect(update, context)
 
+async def interests_command(update: Update, context: CallbackContext) -> None:
+    """/interests <tags> sets the user's interests, /interests clear removes them, /interests shows them."""
+    user_id = update.effective_user.id
+    if not context.args:
+        interests = await get_interests(user_id)
+        if interests:
+            await reply(update,
+                f"Your interests: {' '.join('#' + tag for tag in interests)}\n"
+                "Use /interests <tags> to change them, or /interests clear to remove them."
+            )
+        else:
+            await reply(update,
+                "You have no interests set, so you'll be matched with anyone.\n"
+                f"Use e.g. /interests music gaming (up to {MAX_INTERESTS}) to meet people who share one."
+            )
+        return
+
+    clear = context.args[0].lower() == "clear"
+    interests = () if clear else parse_interests(context.args)
+    if not clear and not interests:
+        await reply(update, "Interests can only contain letters, digits and underscores, e.g. /interests music gaming")
+        return
+
+    def save(conn: sqlite3.Connection):
+        conn.execute("DELETE FROM user_interests WHERE user_id = ?", (user_id,))
+        conn.executemany("INSERT INTO user_interests (user_id, tag) VALUES (?, ?)", [(user_id, tag) for tag in interests])
+    await db.transaction(save)
+
+    if clear:
+        await reply(update, "Your interests were removed; you'll be matched with anyone.")
+    else:
+        await reply(update,
+            f"Interests saved: {' '.join('#' + tag for tag in interests)}\n"
+            f"From your next /connect you'll be matched with someone who shares one, "
+            f"or with anyone if nobody turns up within {format_duration(INTEREST_MATCH_WAIT)}."
+        )
+
 async def report(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("To report someone, reply to their message with the command /report <reason>.")
+        await reply(update, "To report someone, reply to their message with the command /report <reason>.")
         return
         
-    partner_id = await get_active_partner(user.id)
-    if not partner_id:
-        await update.message.reply_text("You are not in a chat.")
+    pair = await state.get_pair(user.id)
+    if not pair:
+        await reply(update, "You are not in a chat.")
         return
+    partner_id, pair_id = pair
 
     reason = ' '.join(context.args)
     if not reason:
-        await update.message.reply_text("You must provide a reason for the report. Usage: /report <reason>")
+        await reply(update, "You must provide a reason for the report. Usage: /report <reason>")
         return
 
     reported_msg = update.message.reply_to_message
     
     if not reported_msg.from_user.is_bot:
-        await update.message.reply_text("You can only report messages received from your partner through the bot.")
+        await reply(update, "You can only report messages received from your partner through the bot.")
         return
 
-    text, media_id, media_type = (reported_msg.text or reported_msg.caption), None, None
-    if reported_msg.photo:
-        media_id = reported_msg.photo[-1].file_id
-        media_type = 'photo'
+    text = reported_msg.text or reported_msg.caption
+    media_type, media_id = extract_media(reported_msg)
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO reports (reporter_id, reported_id, reason, reported_message_text, reported_media_id, reported_media_type)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (user.id, partner_id, reason, text, media_id, media_type)
-        )
-        report_id = cursor.lastrowid
-        conn.commit()
+    def save_report(conn: sqlite3.Connection):
+        media_file_id = media_files.lookup(conn, [media_id])[media_id] if media_id else None
+        with conn:
+            return conn.execute(
+                """INSERT INTO reports (reporter_id, reported_id, reason, reported_message_text, reported_media_type, reported_media_file_id, pair_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (user.id, partner_id, reason, text, media_type_code(media_type), media_file_id, pair_id)
+            )
+    cursor = await db.run(save_report)
+    report_id = cursor.lastrowid
+    stats.record("reports_submitted")
 
     keyboard = [
         [InlineKeyboardButton("✅ Accept (Ban)", callback_data=f"accept_report_{report_id}"),
@@ -318,205 +2571,204 @@ async def report(update: Update, context: CallbackContext) -> None:
         f"👇 *Reported message is below* 👇"
     )
     
-    await context.bot.send_message(ADMIN_GROUP_ID, report_message, reply_markup=reply_markup, parse_mode='Markdown')
-    await context.bot.forward_message(ADMIN_GROUP_ID, from_chat_id=user.id, message_id=reported_msg.message_id)
+    # Not awaited: the admin lane is paced slowly, and this update holds the reporter's and the chat's locks
+    post(context.bot.send_message, ADMIN_GROUP_ID, report_message, reply_markup=reply_markup, parse_mode='Markdown', priority=PRIORITY_ADMIN)
+    post(context.bot.forward_message, ADMIN_GROUP_ID, from_chat_id=user.id, message_id=reported_msg.message_id, priority=PRIORITY_ADMIN)
 
-    await update.message.reply_text(f"Report #{report_id} has been submitted. Thank you.")
-    logger.info(f"Report {report_id} submitted by {user.id} against {partner_id}")
+    await reply(update, f"Report #{report_id} has been submitted. Thank you.")
+    logger.info("Report %s submitted by %s against %s", report_id, user.id, partner_id,
+                extra={"event": "report", "report_id": report_id, "reported_id": partner_id, "pair_id": pair_id})
 
 
 async def message_handler(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    partner_id = await get_active_partner(user_id)
 
-    if not partner_id:
-        await update.message.reply_text("You are not in a chat. Use /connect to find a partner.")
+    pair = await state.get_pair(user_id)
+
+    if not pair:
+        await reply(update, "You are not in a chat. Use /connect to find a partner.")
         return
-        
+
+    partner_id, pair_id = pair
     message = update.message
-    text, media_id, media_type = None, None, None
 
+    if message.media_group_id and extract_media(message)[0] in ALBUM_MEDIA:
+        album_relay.add(context.bot, user_id, partner_id, pair_id, message)
+        return
+    await album_relay.flush_user(user_id)
+
+    # copy_message relays every content type the same way and keeps captions and formatting
     try:
-        if message.text:
-            text = message.text
-            await context.bot.send_message(partner_id, text)
-        elif message.photo:
-            media_id = message.photo[-1].file_id
-            media_type = 'photo'
-            await context.bot.send_photo(partner_id, media_id, caption=message.caption)
-        elif message.video:
-            media_id = message.video.file_id
-            media_type = 'video'
-            await context.bot.send_video(partner_id, media_id, caption=message.caption)
-        elif message.animation:
-            media_id = message.animation.file_id
-            media_type = 'animation'
-            await context.bot.send_animation(partner_id, media_id, caption=message.caption)
-        elif message.sticker:
-            media_id = message.sticker.file_id
-            media_type = 'sticker'
-            await context.bot.send_sticker(partner_id, media_id)
-        else:
-            return
+        await send(context.bot.copy_message, partner_id, from_chat_id=user_id, message_id=message.message_id, priority=PRIORITY_RELAY)
+    except Forbidden:
+        await partner_blocked_bot(context.bot, user_id, partner_id)
+        return
     except Exception as e:
-        logger.error(f"Failed to forward message from {user_id} to {partner_id}: {e}")
-        await update.message.reply_text("An error occurred while sending your message. Please try again.")
+        logger.error("Failed to forward message from %s to %s: %s", user_id, partner_id, e,
+                     extra={"event": "relay_failed", "partner_id": partner_id, "pair_id": pair_id})
+        await reply(update, "An error occurred while sending your message. Please try again.")
         return
 
-    with get_db_connection() as conn:
-        cursor = conn.execute(
-            "SELECT id FROM chat_pairs WHERE ((user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)) AND disconnected_at IS NULL",
-            (user_id, partner_id, partner_id, user_id)
-        )
-        pair_data = cursor.fetchone()
-        if pair_data:
-            conn.execute(
-                "INSERT INTO messages (pair_id, sender_id, message_text, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
-                (pair_data['id'], user_id, text or message.caption, media_type, media_id)
-            )
+    activity.touch(pair_id, user_id, partner_id)
+    media_type, media_id = extract_media(message)
+    stats.message(media_type)
+    logger.info("Relayed a message from %s to %s", user_id, partner_id,
+                extra={"event": "relay", "partner_id": partner_id, "pair_id": pair_id, "media_type": media_type or "text"})
+    await message_log.log(pair_id, user_id, message.text or message.caption, media_type, media_id)
 
 # --- Admin Handlers and Commands ---
 
 async def handle_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    await query.answer()
+    await dispatcher.submit(None, query.answer)
 
     admin_user = query.from_user
     data = query.data.split('_')
     action, subject, item_id = data[0], data[1], int(data[2])
 
     if not await is_sudo_user(admin_user.id) and admin_user.id != BOT_OWNER_ID:
-        await query.edit_message_text(text="Error: You do not have permission to perform this action.")
+        await dispatcher.submit(ADMIN_GROUP_ID, query.edit_message_text, text="Error: You do not have permission to perform this action.", priority=PRIORITY_ADMIN)
         return
 
-    with get_db_connection() as conn:
-        if subject == "report":
-            report_data = conn.execute("SELECT * FROM reports WHERE id = ?", (item_id,)).fetchone()
-            if not report_data:
-                await query.edit_message_text(text=f"Error: Report #{item_id} not found.")
-                return
+    if subject == "report":
+        report_data = await db.fetchone("SELECT * FROM reports WHERE id = ?", (item_id,))
+        if not report_data:
+            await dispatcher.submit(ADMIN_GROUP_ID, query.edit_message_text, text=f"Error: Report #{item_id} not found.", priority=PRIORITY_ADMIN)
+            return
+        
+        reporter_id, reported_id = report_data['reporter_id'], report_data['reported_id']
+
+        if action == 'accept':
+            ban_reason = f"Report #{item_id} ({report_data['reason']})"
             
-            reporter_id, reported_id = report_data['reporter_id'], report_data['reported_id']
-
-            if action == 'accept':
-                ban_reason = f"Report #{item_id} ({report_data['reason']})"
-                # Ban the user, logging who did it
-                conn.execute(
-                    "INSERT OR REPLACE INTO banned_users (user_id, reason, banned_by_admin_id) VALUES (?, ?, ?)",
-                    (reported_id, ban_reason, admin_user.id)
-                )
+            # Banned before anything is awaited, so a /connect from them can't pair them meanwhile
+            await state.set_banned(reported_id, True)
+
+            def accept_report(conn: sqlite3.Connection):
+                # Ban the user, logging who did it, and close the report in the same transaction
+                record_ban(conn, reported_id, ban_reason, admin_user.id)
                 conn.execute("UPDATE reports SET status = 'accepted' WHERE id = ?", (item_id,))
-                
-                active_partner = await get_active_partner(reported_id)
-                if active_partner == reporter_id:
-                    await disconnect_user(reported_id, reporter_id, conn)
-                    await context.bot.send_message(reporter_id, "Your report was accepted. The chat has been terminated.")
-
-                await query.edit_message_text(text=f"✅ Report #{item_id} accepted by {admin_user.mention_markdown()}. User `{reported_id}` has been banned.", parse_mode='Markdown')
-                await context.bot.send_message(reported_id, f"You have been permanently banned due to an accepted report.\nReason: {ban_reason}")
-            
-            elif action == 'reject':
-                conn.execute("UPDATE reports SET status = 'rejected' WHERE id = ?", (item_id,))
-                await query.edit_message_text(text=f"❌ Report #{item_id} rejected by {admin_user.mention_markdown()}.", parse_mode='Markdown')
-                await context.bot.send_message(reporter_id, f"Your report #{item_id} has been rejected by the administration.")
+            await db.transaction(accept_report)
+
+            # Only end the chat if the two are still talking to each other; automatic
+            # reports have no reporter and end whatever chat the user is in
+            ended = await state.end_chat(reported_id, partner_id=reporter_id)
+            stats.record("reports_accepted")
+
+            if ended:
+                chat_ended(ended[1])
+                if reporter_id:
+                    await send(context.bot.send_message, reporter_id, "Your report was accepted. The chat has been terminated.")
+                else:
+                    await send(context.bot.send_message, ended[0], "Your partner has been banned by an admin. The chat has been terminated.")
+
+            await dispatcher.submit(ADMIN_GROUP_ID, query.edit_message_text, text=f"✅ Report #{item_id} accepted by {admin_user.mention_markdown()}. User `{reported_id}` has been banned.", parse_mode='Markdown', priority=PRIORITY_ADMIN)
+            await send(context.bot.send_message, reported_id, f"You have been permanently banned due to an accepted report.\nReason: {ban_reason}")
+        
+        elif action == 'reject':
+            await db.execute("UPDATE reports SET status = 'rejected' WHERE id = ?", (item_id,))
+            stats.record("reports_rejected")
+            await dispatcher.submit(ADMIN_GROUP_ID, query.edit_message_text, text=f"❌ Report #{item_id} rejected by {admin_user.mention_markdown()}.", parse_mode='Markdown', priority=PRIORITY_ADMIN)
+            if reporter_id:
+                await send(context.bot.send_message, reporter_id, f"Your report #{item_id} has been rejected by the administration.")
 
 async def add_sudo(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id != BOT_OWNER_ID:
-        await update.message.reply_text('Permission denied.')
+        await reply(update, 'Permission denied.')
         return
     try:
         user_id = int(context.args[0])
         username = context.args[1]
     except (IndexError, ValueError):
-        await update.message.reply_text('Usage: /addsudo <user_id> <username>')
+        await reply(update, 'Usage: /addsudo <user_id> <username>')
         return
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR REPLACE INTO sudo_users (user_id, username) VALUES (?, ?)", (user_id, username))
-    await update.message.reply_text(f'User {username} ({user_id}) has been added as an admin.')
+    await db.execute("INSERT OR REPLACE INTO sudo_users (user_id, username) VALUES (?, ?)", (user_id, username))
+    await state.set_sudo(user_id, True)
+    await reply(update, f'User {username} ({user_id}) has been added as an admin.')
 
 async def del_sudo(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id != BOT_OWNER_ID:
-        await update.message.reply_text('Permission denied.')
+        await reply(update, 'Permission denied.')
         return
     try:
         user_id = int(context.args[0])
     except (IndexError, ValueError):
-        await update.message.reply_text('Usage: /delsudo <user_id>')
+        await reply(update, 'Usage: /delsudo <user_id>')
         return
-    with get_db_connection() as conn:
-        conn.execute("DELETE FROM sudo_users WHERE user_id = ?", (user_id,))
-    await update.message.reply_text(f'User {user_id} has been removed from the admin list.')
+    await db.execute("DELETE FROM sudo_users WHERE user_id = ?", (user_id,))
+    await state.set_sudo(user_id, False)
+    await reply(update, f'User {user_id} has been removed from the admin list.')
     
 async def ban_user(update: Update, context: CallbackContext) -> None:
     admin_id = update.effective_user.id
     if not await is_sudo_user(admin_id) and admin_id != BOT_OWNER_ID:
-        await update.message.reply_text('Permission denied.')
+        await reply(update, 'Permission denied.')
         return
     try:
         target_id = int(context.args[0])
         reason = ' '.join(context.args[1:]) if len(context.args) > 1 else "Manual ban by an administrator"
     except (IndexError, ValueError):
-        await update.message.reply_text('Usage: /ban <user_id> <reason>')
+        await reply(update, 'Usage: /ban <user_id> <reason>')
         return
 
     if target_id == BOT_OWNER_ID or await is_sudo_user(target_id):
-        await update.message.reply_text('You cannot ban the owner or another admin.')
+        await reply(update, 'You cannot ban the owner or another admin.')
         return
     
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR REPLACE INTO banned_users (user_id, reason, banned_by_admin_id) VALUES (?, ?, ?)", (target_id, reason, admin_id))
-        
-        partner_id = await get_active_partner(target_id)
-        if partner_id:
-            await disconnect_user(target_id, partner_id, conn)
-            await context.bot.send_message(partner_id, "Your partner has been banned by an admin. The chat has been terminated.")
+    # Banned before anything is awaited, so a /connect from the target can't pair them meanwhile
+    await state.set_banned(target_id, True)
+    await db.transaction(record_ban, target_id, reason, admin_id)
+    partner_id, pair_id = (await state.leave(target_id))[0] or (None, None)
+    if pair_id is not None:
+        chat_ended(pair_id)
+    if partner_id:
+        await send(context.bot.send_message, partner_id, "Your partner has been banned by an admin. The chat has been terminated.")
 
-    await update.message.reply_text(f'User {target_id} has been banned. Reason: {reason}')
-    await context.bot.send_message(target_id, f'You have been banned by an administrator. Reason: {reason}')
+    await reply(update, f'User {target_id} has been banned. Reason: {reason}')
+    await send(context.bot.send_message, target_id, f'You have been banned by an administrator. Reason: {reason}')
 
 async def unban_user(update: Update, context: CallbackContext) -> None:
     admin_id = update.effective_user.id
     if not await is_sudo_user(admin_id) and admin_id != BOT_OWNER_ID:
-        await update.message.reply_text('Permission denied.')
+        await reply(update, 'Permission denied.')
         return
     try:
         target_id = int(context.args[0])
     except (IndexError, ValueError):
-        await update.message.reply_text('Usage: /unban <user_id>')
+        await reply(update, 'Usage: /unban <user_id>')
         return
         
-    with get_db_connection() as conn:
-        result = conn.execute("DELETE FROM banned_users WHERE user_id = ?", (target_id,))
+    result = await db.execute("DELETE FROM banned_users WHERE user_id = ?", (target_id,))
+    await state.set_banned(target_id, False)
     
     if result.rowcount > 0:
-        await update.message.reply_text(f'User {target_id} has been unbanned.')
-        await context.bot.send_message(target_id, "You have been unbanned by an administrator.")
+        await reply(update, f'User {target_id} has been unbanned.')
+        await send(context.bot.send_message, target_id, "You have been unbanned by an administrator.")
     else:
-        await update.message.reply_text(f'User {target_id} was not banned.')
+        await reply(update, f'User {target_id} was not banned.')
 
 async def check_ban(update: Update, context: CallbackContext) -> None:
     admin_id = update.effective_user.id
     if not await is_sudo_user(admin_id) and admin_id != BOT_OWNER_ID:
-        await update.message.reply_text('Permission denied.')
+        await reply(update, 'Permission denied.')
         return
     try:
         target_id = int(context.args[0])
     except (IndexError, ValueError):
-        await update.message.reply_text('Usage: /checkban <user_id>')
+        await reply(update, 'Usage: /checkban <user_id>')
         return
     
     ban_info = await get_ban_info(target_id)
 
     if not ban_info:
-        await update.message.reply_text(f"User `{target_id}` is not banned.", parse_mode='Markdown')
+        await reply(update, f"User `{target_id}` is not banned.", parse_mode='Markdown')
         return
 
     reason, banned_at_str, banned_by_admin_id = ban_info
     
     admin_info_str = "System (following a report)"
     if banned_by_admin_id:
-        with get_db_connection() as conn:
-            admin = conn.execute("SELECT username FROM sudo_users WHERE user_id = ?", (banned_by_admin_id,)).fetchone()
+        admin = await db.fetchone("SELECT username FROM sudo_users WHERE user_id = ?", (banned_by_admin_id,))
         if admin:
             admin_info_str = f"Admin @{admin['username']} (`{banned_by_admin_id}`)"
         elif banned_by_admin_id == BOT_OWNER_ID:
@@ -533,44 +2785,688 @@ async def check_ban(update: Update, context: CallbackContext) -> None:
         f"*Banned by:* {admin_info_str}\n"
         f"*Reason:* `{reason}`"
     )
-    await update.message.reply_text(response_text, parse_mode='Markdown')
+    await reply(update, response_text, parse_mode='Markdown')
 
-def main() -> None:
-    # Initialize the database on startup
-    conn = get_db_connection()
-    setup_database(conn)
-    conn.close()
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+async def stats_command(update: Update, context: CallbackContext) -> None:
+    admin_id = update.effective_user.id
+    if not await is_sudo_user(admin_id) and admin_id != BOT_OWNER_ID:
+        await reply(update, 'Permission denied.')
+        return
+
+    waiting, open_chats = await state.counts()
+    if state.shared:
+        # Every worker's counts, not just the ones this process has seen
+        counts = await db.run(stats.read_windows)
+        stats.add_unsaved(counts)
+    else:
+        counts = stats.windows()
+    windows = dict(zip(("Last hour", "Last 24h", "All time"), counts))
+
+    lines = [
+        "📊 *Bot Statistics*\n",
+        f"*Right now:* {open_chats} open chats, {waiting} users waiting",
+    ]
+    for title, counts in windows.items():
+        messages = {name[len("messages_"):]: int(value) for name, value in counts.items() if name.startswith("messages_") and value}
+        by_type = ", ".join(f"{media_type.replace('_', ' ')} {count}" for media_type, count in sorted(messages.items(), key=lambda item: -item[1]))
+        average = format_duration(counts["session_seconds"] / counts["sessions_timed"]) if counts["sessions_timed"] else "n/a"
+        lines += [
+            f"\n*{title}:*",
+            f"   New users: {int(counts['joins'])}",
+            f"   Chats started: {int(counts['chats_started'])}, ended: {int(counts['chats_ended'])}",
+            f"   Average chat: {average}",
+            f"   Messages: {sum(messages.values())}" + (f" ({by_type})" if by_type else ""),
+            f"   Reports: {int(counts['reports_submitted'])} submitted, "
+            f"{int(counts['reports_accepted'])} accepted, {int(counts['reports_rejected'])} rejected",
+        ]
+    await reply(update, "\n".join(lines), parse_mode='Markdown')
+
+# --- Broadcasts ---
+class Broadcaster:
+    """Sends one message to every user, a page of user IDs at a time.
+
+    Users are read with a keyset cursor (user_id > last one sent), so memory use doesn't grow
+    with the users table. Sends are paced by their own token bucket and go through the
+    dispatcher's lowest-priority lane, so chats between users are never held up. Progress is
+    saved after every page and a broadcast that was running when the bot stopped resumes on
+    startup; at most one page may then be delivered twice.
+
+    With several workers, the one sending a broadcast holds a lease on its row, renewed with
+    every page. The others leave it alone until the lease lapses, e.g. because that worker died.
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+        self._broadcast_id: int | None = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot, broadcast_id: int):
+        self._broadcast_id = broadcast_id
+        self._task = asyncio.create_task(self._run(bot, broadcast_id))
+
+    async def claim(self, broadcast_id: int) -> bool:
+        """Takes the lease on a running broadcast unless another worker holds it."""
+        now = time.time()
+        cursor = await db.execute(
+            "UPDATE broadcasts SET owner = ?, lease_until = ? "
+            "WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+            (self.owner, now + BROADCAST_LEASE_SECONDS, broadcast_id, self.owner, now)
+        )
+        return cursor.rowcount > 0
+
+    async def resume(self, bot):
+        """Picks up a broadcast that no worker is sending, e.g. one that was running when the bot stopped."""
+        if self.running:
+            return
+        row = await db.fetchone("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1")
+        if row and await self.claim(row['id']):
+            logger.info(f"Resuming broadcast #{row['id']}.")
+            self.start(bot, row['id'])
+
+    async def cancel(self) -> int | None:
+        """Stops the running broadcast, whichever worker sends it, and returns its ID."""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        # Another worker's broadcast stops when it next renews its lease
+        row = await db.transaction(lambda conn: conn.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP WHERE status = 'running' RETURNING id"
+        ).fetchone())
+        return row['id'] if row else None
+
+    async def stop(self):
+        """Interrupts the running broadcast on shutdown; it stays 'running' so the next start resumes it."""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            # Release the lease so another worker can carry on at once
+            await db.execute(
+                "UPDATE broadcasts SET owner = NULL WHERE id = ? AND owner = ?", (self._broadcast_id, self.owner)
+            )
+
+    async def _run(self, bot, broadcast_id: int):
+        broadcast = await db.fetchone("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+        bucket = TokenBucket(BROADCAST_RATE, 1)
+        concurrency = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_user_id = broadcast['last_user_id']
+        try:
+            while True:
+                rows = await db.fetchall(BROADCAST_PAGE_SQL, (last_user_id, BROADCAST_PAGE_SIZE))
+                if not rows:
+                    break
+                user_ids = [row['user_id'] for row in rows]
+                outcomes = await asyncio.gather(*(self._deliver(bot, broadcast, user_id, bucket, concurrency) for user_id in user_ids))
+                last_user_id = user_ids[-1]
+                if not await db.transaction(self._save_page, broadcast_id, self.owner, last_user_id, user_ids, outcomes):
+                    logger.info(f"Broadcast #{broadcast_id} was cancelled or taken over by another worker.")
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{broadcast_id} stopped: {e}")
+            return
+        finished = await db.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ? AND owner = ? AND status = 'running'",
+            (broadcast_id, self.owner)
+        )
+        if not finished.rowcount:
+            return
+        done = await db.fetchone("SELECT sent, failed, blocked FROM broadcasts WHERE id = ?", (broadcast_id,))
+        logger.info(f"Broadcast #{broadcast_id} finished: {done['sent']} sent, {done['failed']} failed, {done['blocked']} blocked the bot.")
+        await send(bot.send_message, broadcast['admin_id'],
+            f"📣 Broadcast #{broadcast_id} finished: {done['sent']} delivered, {done['failed']} failed, "
+            f"{done['blocked']} users had blocked the bot.")
+
+    async def _deliver(self, bot, broadcast: sqlite3.Row, user_id: int, bucket: TokenBucket, concurrency: asyncio.Semaphore) -> str:
+        async with concurrency:
+            await bucket.acquire()
+            try:
+                if broadcast['message_id']:
+                    await send(bot.copy_message, user_id, from_chat_id=broadcast['from_chat_id'],
+                               message_id=broadcast['message_id'], priority=PRIORITY_BROADCAST)
+                else:
+                    await send(bot.send_message, user_id, broadcast['text'], priority=PRIORITY_BROADCAST)
+            except Forbidden:
+                return "blocked"
+            except Exception as e:
+                logger.warning("Broadcast to %s failed: %s", user_id, e, extra={"event": "broadcast_failed", "user_id": user_id})
+                return "failed"
+            return "sent"
+
+    @staticmethod
+    def _save_page(conn: sqlite3.Connection, broadcast_id: int, owner: str, last_user_id: int, user_ids: list[int], outcomes: list[str]) -> bool:
+        """Saves a page's progress and renews the lease. Returns False if this worker no longer holds it."""
+        blocked = [(user_id,) for user_id, outcome in zip(user_ids, outcomes) if outcome == "blocked"]
+        if blocked:
+            conn.executemany("UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE user_id = ?", blocked)
+        cursor = conn.execute(
+            "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, lease_until = ? "
+            "WHERE id = ? AND owner = ? AND status = 'running'",
+            (last_user_id, outcomes.count("sent"), outcomes.count("failed"), len(blocked),
+             time.time() + BROADCAST_LEASE_SECONDS, broadcast_id, owner)
+        )
+        return cursor.rowcount > 0
+
+broadcaster = Broadcaster()
+
+async def broadcast_command(update: Update, context: CallbackContext) -> None:
+    """/broadcast <text>, or /broadcast as a reply to the message to send; /broadcast cancel stops it."""
+    if update.effective_user.id != BOT_OWNER_ID:
+        await reply(update, 'Permission denied.')
+        return
+
+    if context.args == ["cancel"]:
+        broadcast_id = await broadcaster.cancel()
+        await reply(update, f"Broadcast #{broadcast_id} cancelled." if broadcast_id else "No broadcast is running.")
+        return
+    # Any worker's broadcast counts, not just this process's
+    if await db.fetchone("SELECT 1 FROM broadcasts WHERE status = 'running'"):
+        await reply(update, "A broadcast is already running. Use /broadcast cancel to stop it.")
+        return
+
+    source = update.message.reply_to_message
+    # Everything after the command, keeping the line breaks that context.args would lose
+    command_and_text = update.message.text.split(maxsplit=1)
+    text = command_and_text[1].strip() if len(command_and_text) > 1 else ""
+    if not source and not text:
+        await reply(update, "Usage: /broadcast <text>, or reply to the message to send with /broadcast")
+        return
+
+    cursor = await db.execute(
+        "INSERT INTO broadcasts (admin_id, text, from_chat_id, message_id, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?)",
+        (update.effective_user.id, None if source else text, source.chat_id if source else None, source.message_id if source else None,
+         broadcaster.owner, time.time() + BROADCAST_LEASE_SECONDS)
+    )
+    broadcaster.start(context.bot, cursor.lastrowid)
+    await reply(update, f"📣 Broadcast #{cursor.lastrowid} started. You will get a summary when it is done.")
+    logger.info(f"Broadcast {cursor.lastrowid} started by {update.effective_user.id}")
+
+async def broadcast_takeover_job(context: CallbackContext) -> None:
+    """Carries on a broadcast whose worker stopped renewing its lease."""
+    try:
+        await broadcaster.resume(context.bot)
+    except Exception as e:
+        logger.error(f"Taking over a broadcast failed: {e}")
+
+# --- Reaper ---
+async def last_logged_messages(pair_ids: list[int]) -> dict[int, float]:
+    """Epoch time of the newest logged message of each chat, including ones relayed by other processes."""
+    def query(conn: sqlite3.Connection):
+        latest = {}
+        for pair_id in pair_ids:
+            row = conn.execute(
+                "SELECT sent_at FROM messages WHERE pair_id = ? ORDER BY id DESC LIMIT 1", (pair_id,)
+            ).fetchone()
+            if row:
+                latest[pair_id] = row['sent_at']
+        return latest
+    return await db.run(query)
+
+async def reap_idle_chats(bot) -> int:
+    """Ends chats with no messages for IDLE_CHAT_TIMEOUT seconds, REAPER_BATCH_SIZE at a time."""
+    cutoff = time.time() - IDLE_CHAT_TIMEOUT
+    reaped = 0
+    while candidates := activity.idle(cutoff, REAPER_BATCH_SIZE):
+        # Another worker may have relayed messages in these chats; the message log has them all
+        latest = await last_logged_messages([pair_id for pair_id, _, _ in candidates])
+        idle = []
+        for pair_id, user1_id, user2_id in candidates:
+            if latest.get(pair_id, 0) >= cutoff:
+                activity.touch(pair_id, user1_id, user2_id, at=latest[pair_id])
+            else:
+                idle.append((pair_id, user1_id, user2_id))
+        closed = await state.end_chats(idle)
+        for pair_id, _, _ in closed:
+            chat_ended(pair_id)
+        # Best effort: users who blocked the bot can't be told
+        await asyncio.gather(*(
+            send(bot.send_message, user_id, "Your chat was ended because nobody wrote anything for a while. Use /connect to find a new partner.")
+            for _, user1_id, user2_id in closed for user_id in (user1_id, user2_id)
+        ), return_exceptions=True)
+        reaped += len(closed)
+        # Chats that were already closed elsewhere
+        for pair_id, _, _ in idle:
+            activity.forget(pair_id)
+    return reaped
+
+async def expire_waiting_users(bot) -> int:
+    """Takes users who waited longer than MAX_WAIT_SECONDS out of the queue."""
+    expired = await state.expire_waiting(time.time() - MAX_WAIT_SECONDS)
+    await asyncio.gather(*(
+        send(bot.send_message, user_id, "No partner was found in time, so the search has stopped. Use /connect to try again.")
+        for user_id in expired
+    ), return_exceptions=True)
+    return len(expired)
+
+async def reaper_job(context: CallbackContext) -> None:
+    try:
+        reaped = await reap_idle_chats(context.bot) if IDLE_CHAT_TIMEOUT else 0
+        expired = await expire_waiting_users(context.bot) if MAX_WAIT_SECONDS else 0
+    except Exception as e:
+        logger.error(f"Reaper run failed: {e}")
+        return
+    if reaped or expired:
+        logger.info(f"Reaper ended {reaped} idle chats and stopped {expired} searches that took too long.")
+
+async def interest_fallback_job(context: CallbackContext) -> None:
+    """Pairs users who waited INTEREST_MATCH_WAIT seconds for a shared interest with anyone who takes them."""
+    try:
+        pairs = await state.fallback_pairs()
+    except Exception as e:
+        logger.error(f"Interest fallback pairing failed: {e}")
+        return
+    for _, _, _, waited1, waited2 in pairs:
+        MATCH_WAIT_SECONDS.observe(waited1)
+        MATCH_WAIT_SECONDS.observe(waited2)
+    # Best effort, like the reaper's notices: one user having blocked the bot mustn't stop the rest
+    await asyncio.gather(*(
+        announce_pair(context.bot, user2_id, user1_id, pair_id) for pair_id, user1_id, user2_id, _, _ in pairs
+    ), return_exceptions=True)
+    if pairs:
+        logger.info(f"Paired {len(pairs) * 2} users with anyone after no shared interest turned up.")
 
-    application = Application.builder().token(BOT_TOKEN).build()
+# --- Retention ---
+def append_to_archive(table: str, rows: list[dict], date_column: str):
+    """Appends rows to ARCHIVE_DIR/<table>/<YYYY-MM-DD>.jsonl.gz, partitioned by each row's date.
+
+    Files are only ever appended to (each append adds a gzip member, which gzip readers join
+    transparently) and are synced to disk before the caller deletes the rows from the database.
+    A crash in between can archive a row twice, never lose it; deduplicate by id when reading.
+    """
+    partitions: dict[str, list[dict]] = {}
+    for row in rows:
+        partitions.setdefault(row[date_column][:10], []).append(row)
+    directory = os.path.join(ARCHIVE_DIR, table)
+    os.makedirs(directory, exist_ok=True)
+    for day, day_rows in partitions.items():
+        with open(os.path.join(directory, f"{day}.jsonl.gz"), "ab") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as archive:
+                archive.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in day_rows).encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+async def archive_batches(table: str, select_sql: str, date_column: str, cutoff: str | int) -> int:
+    """Moves rows returned by select_sql to the archive in small batches. Returns the number moved."""
+    moved = 0
+    while True:
+        rows = [dict(row) for row in await db.fetchall(select_sql, (cutoff, RETENTION_BATCH_SIZE))]
+        if not rows:
+            return moved
+        await asyncio.to_thread(append_to_archive, table, rows, date_column)
+        await db.executemany(f"DELETE FROM {table} WHERE id = ?", [(row['id'],) for row in rows])
+        moved += len(rows)
+
+async def run_retention():
+    """Archives old messages, then the closed chats they belonged to, and reclaims the freed space."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    messages = await archive_batches("messages", ARCHIVABLE_MESSAGES_SQL, "sent_at", int(time.time()) - RETENTION_DAYS * 86400)
+    chats = await archive_batches("chat_pairs", ARCHIVABLE_CHATS_SQL, "disconnected_at", cutoff)
+    await db.run(lambda conn: conn.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})"))
+    if messages or chats:
+        logger.info(f"Retention archived {messages} messages and {chats} closed chats older than {cutoff}.")
+
+async def retention_job(context: CallbackContext) -> None:
+    try:
+        await run_retention()
+    except Exception as e:
+        logger.error(f"Retention run failed: {e}")
+
+def schedule_jobs(application: Application):
+    """Registers the periodic background jobs. Needs python-telegram-bot[job-queue]."""
+    if application.job_queue is None:
+        logger.warning("JobQueue is not available (install python-telegram-bot[job-queue]); periodic jobs are disabled.")
+        return
+    if IDLE_CHAT_TIMEOUT or MAX_WAIT_SECONDS:
+        application.job_queue.run_repeating(reaper_job, interval=REAPER_INTERVAL, first=REAPER_INTERVAL, name="reaper")
+    application.job_queue.run_repeating(interest_fallback_job, interval=INTEREST_FALLBACK_INTERVAL, name="interest fallback")
+    application.job_queue.run_repeating(state_snapshot_job, interval=STATE_SNAPSHOT_INTERVAL, name="state snapshot")
+    application.job_queue.run_repeating(stats_snapshot_job, interval=STATS_SNAPSHOT_INTERVAL, name="stats snapshot")
+    if RETENTION_DAYS:
+        application.job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL, first=60, name="retention")
+    application.job_queue.run_repeating(broadcast_takeover_job, interval=BROADCAST_LEASE_SECONDS, name="broadcast takeover")
+
+# --- Profiling ---
+def describe_callback(handle: asyncio.Handle) -> str:
+    """Names an event loop callback; for a task step, the coroutine the task is suspended in afterwards."""
+    task = getattr(handle._callback, "__self__", None)
+    if not isinstance(task, asyncio.Task):
+        return repr(handle)
+    coro = task.get_coro()
+    while getattr(coro, "cr_await", None) is not None and hasattr(coro.cr_await, "cr_frame"):
+        coro = coro.cr_await
+    frame = getattr(coro, "cr_frame", None)
+    where = f" ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})" if frame else ""
+    return f"{task.get_name()} in {getattr(coro, '__qualname__', coro)}{where}"
+
+class LoopProfiler:
+    """Profiles the running bot for a while, on /profile or SIGUSR1.
+
+    cProfile runs on the event loop thread and on the database thread, so the time spent in
+    handlers, in Bot API calls and in SQLite shows up separately. Every loop callback that blocks
+    for more than SLOW_CALLBACK_MS is listed, the way asyncio's debug mode does but without its
+    traceback capture skewing the profile. Each profile is written to PROFILE_DIR as .pstats files
+    (open them with snakeviz, or turn them into a flamegraph with flameprof or gprof2dot) plus the
+    slow callbacks. Nothing is hooked in between, so it costs nothing while idle.
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, seconds: float, notify=None):
+        """Profiles for `seconds` in the background, then awaits notify(summary) if given."""
+        self._task = asyncio.create_task(self._run(seconds, notify))
+
+    async def stop(self):
+        """Abandons a running profile, e.g. on shutdown."""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    @staticmethod
+    def _time_callbacks(slow_callbacks: list[tuple[float, str]]):
+        """Wraps every loop callback with a timer; returns the original Handle._run to put back."""
+        run = asyncio.Handle._run
+        threshold = SLOW_CALLBACK_MS / 1000
+
+        def timed_run(handle: asyncio.Handle):
+            started = time.perf_counter()
+            try:
+                run(handle)
+            finally:
+                elapsed = time.perf_counter() - started
+                if elapsed > threshold:
+                    slow_callbacks.append((elapsed, describe_callback(handle)))
+        asyncio.Handle._run = timed_run
+        return run
+
+    async def _run(self, seconds: float, notify):
+        name = os.path.join(PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        loop_profile, db_profile = cProfile.Profile(), cProfile.Profile()
+        slow_callbacks: list[tuple[float, str]] = []
+        run = self._time_callbacks(slow_callbacks)
+        loop_profile.enable()
+        db_profiled = False
+        try:
+            # Python 3.12+ allows one profiler per process; it then sees every thread by itself
+            db_profiled = await db.run(self._enable_on_db_thread, db_profile, label="profile")
+            await asyncio.sleep(seconds)
+        finally:
+            if db_profiled:
+                await db.run(lambda conn: db_profile.disable(), label="profile")
+            loop_profile.disable()
+            asyncio.Handle._run = run
+
+        profiles = {"loop": loop_profile, "db": db_profile} if db_profiled else {"loop": loop_profile}
+        paths = await asyncio.to_thread(self._save, name, profiles, slow_callbacks)
+        worst = sorted(slow_callbacks, reverse=True)[:5]
+        summary = "\n".join([
+            f"Profiled {seconds:g}s: {', '.join(paths)}",
+            f"{len(slow_callbacks)} loop callbacks blocked for more than {SLOW_CALLBACK_MS} ms.",
+            *(f"  {elapsed * 1000:.0f} ms {callback}" for elapsed, callback in worst),
+            *(f"Top {thread} functions by own time:\n{self._top(profile)}" for thread, profile in profiles.items()),
+        ])
+        logger.info(summary)
+        if notify:
+            try:
+                await notify(summary)
+            except Exception as e:
+                logger.error(f"Sending the profile summary failed: {e}")
+
+    @staticmethod
+    def _enable_on_db_thread(conn: sqlite3.Connection, profile: cProfile.Profile) -> bool:
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def _save(name: str, profiles: dict[str, cProfile.Profile], slow_callbacks: list[tuple[float, str]]) -> list[str]:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        paths = []
+        for thread, profile in profiles.items():
+            paths.append(f"{name}-{thread}.pstats")
+            profile.dump_stats(paths[-1])
+        if slow_callbacks:
+            paths.append(f"{name}-slow.txt")
+            with open(paths[-1], "w") as f:
+                f.writelines(f"{elapsed * 1000:.1f} ms {callback}\n" for elapsed, callback in slow_callbacks)
+        return paths
+
+    @staticmethod
+    def _top(profile: cProfile.Profile, limit: int = 8) -> str:
+        stats = pstats.Stats(profile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+        return "\n".join(
+            f"  {own:.3f}s {calls} calls {os.path.basename(filename)}:{line}({function})"
+            for (filename, line, function), (_, calls, own, _, _) in top
+        )
+
+profiler = LoopProfiler()
+
+def profile_on_signal():
+    if profiler.running:
+        logger.warning("SIGUSR1 ignored: a profile is already running.")
+        return
+    logger.info(f"SIGUSR1: profiling for {PROFILE_SIGNAL_SECONDS} seconds.")
+    profiler.start(PROFILE_SIGNAL_SECONDS)
+
+async def profile_command(update: Update, context: CallbackContext) -> None:
+    """/profile <seconds> profiles the bot and sends the owner a summary when done."""
+    if update.effective_user.id != BOT_OWNER_ID:
+        await reply(update, 'Permission denied.')
+        return
+    try:
+        seconds = float(context.args[0])
+    except (IndexError, ValueError):
+        await reply(update, f"Usage: /profile <seconds> (up to {PROFILE_MAX_SECONDS})")
+        return
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await reply(update, f"Profile for between 0 and {PROFILE_MAX_SECONDS} seconds.")
+        return
+    if profiler.running:
+        await reply(update, "A profile is already running.")
+        return
+
+    user_id = update.effective_user.id
+    profiler.start(seconds, notify=lambda summary: send(context.bot.send_message, user_id, summary[:4096]))
+    await reply(update, f"🔬 Profiling for {seconds:g} seconds. You will get a summary when it is done.")
+    logger.info(f"Profiling for {seconds:g}s, started by {user_id}")
+
+# --- Update Processing ---
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates concurrently while keeping them ordered where it matters.
+
+    Each update first takes its sender's lock and then the lock of the sender's current chat
+    pair, so updates from one user, and from both sides of one chat, run one at a time in
+    arrival order. Updates from unrelated users run in parallel.
+
+    Messages to relay go through flood control as they arrive, before any lock: a flood is
+    dropped at once instead of queueing behind the sender's earlier messages, each holding
+    one of the MAX_CONCURRENT_UPDATES slots meanwhile.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks: dict[tuple[str, int], list] = {}
+
+    @asynccontextmanager
+    async def _hold(self, key: tuple[str, int]):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        if RELAYED_MESSAGES.check_update(update):
+            verdict, cooldown, strikes = flood_limiter.check(user.id)
+            if verdict != "ok":
+                coroutine.close()
+                await flood_limited(update, verdict, cooldown, strikes)
+                return
+        async with self._hold(("user", user.id)):
+            pair = await state.get_pair(user.id)
+            if pair is None:
+                await coroutine
+                return
+            async with self._hold(("pair", pair[1])):
+                await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+async def on_startup(application: Application) -> None:
+    """Starts background workers once the event loop is running."""
+    global metrics_server
+    message_log.start()
+    dispatcher.start()
+    # Chats that were open before the restart get a full idle timeout from now
+    for pair_id, user1_id, user2_id in await state.open_chats():
+        activity.touch(pair_id, user1_id, user2_id)
+    if METRICS_ENABLED:
+        metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    schedule_jobs(application)
+    await broadcaster.resume(application.bot)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profile_on_signal)
+    except (AttributeError, NotImplementedError):
+        pass  # No SIGUSR1 on Windows; /profile still works
+
+async def on_stop(application: Application) -> None:
+    """Lets pending albums and queued API calls go out while the bot connection is still open."""
+    await broadcaster.stop()
+    await profiler.stop()
+    await album_relay.flush_all()
+    await dispatcher.stop()
+
+async def on_shutdown(application: Application) -> None:
+    """Drains background workers after polling has stopped.
+
+    The warm-restart snapshot is taken first, and a step that fails is logged without skipping the rest.
+    """
+    for step, action in [
+        ("Saving the state snapshot", save_state_snapshot),
+        ("Flushing the message log", message_log.stop),
+        ("Saving statistics", save_stats),
+    ]:
+        try:
+            await action()
+        except Exception as e:
+            logger.error(f"{step} failed at shutdown: {e}")
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+def init_database() -> None:
+    """Opens the database, brings the schema up to date and loads the state backend."""
+    global state
+    db.open()
+    db.run_sync(setup_database)
+    state = STATE_BACKENDS[STATE_BACKEND]()
+    db.run_sync(state.load)
+    db.run_sync(stats.load)
+
+def webhook_settings() -> dict:
+    """Keyword arguments for Application.run_webhook / Updater.start_webhook."""
+    if not WEBHOOK_SECRET_TOKEN:
+        raise ValueError("WEBHOOK_SECRET_TOKEN must be set when RUN_MODE is 'webhook'.")
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_URL_PATH,
+        "webhook_url": WEBHOOK_URL or None,
+        "secret_token": WEBHOOK_SECRET_TOKEN,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+    }
+
+def build_application(request=None) -> Application:
+    """Builds the Application with all handlers. `request` replaces the HTTP layer (used by test harnesses)."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(KeyedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
     
     # Filter for private chats only
     private_filter = filters.ChatType.PRIVATE
 
     # Command Handlers
-    application.add_handler(CommandHandler("start", start, filters=private_filter))
-    application.add_handler(CommandHandler("help", help_command, filters=private_filter))
-    application.add_handler(CommandHandler("rules", rules, filters=private_filter))
-    application.add_handler(CommandHandler("connect", connect, filters=private_filter))
-    application.add_handler(CommandHandler("disconnect", disconnect, filters=private_filter))
-    application.add_handler(CommandHandler("reconnect", reconnect, filters=private_filter))
-    application.add_handler(CommandHandler("report", report, filters=private_filter))
+    application.add_handler(CommandHandler("start", instrumented(start), filters=private_filter))
+    application.add_handler(CommandHandler("help", instrumented(help_command), filters=private_filter))
+    application.add_handler(CommandHandler("rules", instrumented(rules), filters=private_filter))
+    application.add_handler(CommandHandler("connect", instrumented(connect), filters=private_filter))
+    application.add_handler(CommandHandler("disconnect", instrumented(disconnect), filters=private_filter))
+    application.add_handler(CommandHandler("reconnect", instrumented(reconnect), filters=private_filter))
+    application.add_handler(CommandHandler("interests", instrumented(interests_command), filters=private_filter))
+    application.add_handler(CommandHandler("report", instrumented(report), filters=private_filter))
 
     # Admin Handlers
-    application.add_handler(CommandHandler("addsudo", add_sudo, filters=private_filter))
-    application.add_handler(CommandHandler("delsudo", del_sudo, filters=private_filter))
-    application.add_handler(CommandHandler("ban", ban_user, filters=private_filter))
-    application.add_handler(CommandHandler("unban", unban_user, filters=private_filter))
-    application.add_handler(CommandHandler("checkban", check_ban, filters=private_filter))
+    application.add_handler(CommandHandler("addsudo", instrumented(add_sudo), filters=private_filter))
+    application.add_handler(CommandHandler("delsudo", instrumented(del_sudo), filters=private_filter))
+    application.add_handler(CommandHandler("ban", instrumented(ban_user), filters=private_filter))
+    application.add_handler(CommandHandler("unban", instrumented(unban_user), filters=private_filter))
+    application.add_handler(CommandHandler("checkban", instrumented(check_ban), filters=private_filter))
+    application.add_handler(CommandHandler("stats", instrumented(stats_command), filters=private_filter))
+    application.add_handler(CommandHandler("broadcast", instrumented(broadcast_command), filters=private_filter))
+    application.add_handler(CommandHandler("profile", instrumented(profile_command), filters=private_filter))
     
     # Callback Handler for buttons
-    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(CallbackQueryHandler(instrumented(handle_callback)))
 
     # Message Handler (must be one of the last)
-    message_filters = (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Sticker.ALL) & ~filters.COMMAND & private_filter
-    application.add_handler(MessageHandler(message_filters, message_handler))
+    application.add_handler(MessageHandler(RELAYED_MESSAGES, instrumented(message_handler)))
+    return application
 
-    logger.info("OmegleBot is starting...")
-    application.run_polling()
+def main() -> None:
+    log_writer = setup_logging()
+    try:
+        # Initialize the database on startup
+        init_database()
+        application = build_application()
+
+        logger.info("OmegleBot is starting (%s)...", RUN_MODE)
+        if RUN_MODE == "webhook":
+            application.run_webhook(**webhook_settings())
+        else:
+            application.run_polling()
+        db.close()
+    finally:
+        log_writer.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,251 @@
+"""Load simulator and benchmark for OmegleBot.
+
+Feeds synthetic updates straight into the handlers registered by Omegle.build_application,
+with the Bot API replaced by fake_bot_api.FakeBotRequest, and reports updates per second,
+per-handler p50/p99 latency, database time per update and database growth:
+
+    python benchmark.py --users 5000 --messages 10 --json after.json --compare before.json
+
+--matchmaking instead times the matchmaker alone against ever longer waiting queues:
+
+    python benchmark.py --matchmaking 100000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+
+import Omegle
+from fake_bot_api import FakeBotRequest, callback_update, command_update, lift_send_limits, report_update, text_update
+
+# Command -> name of the handler function that serves it
+COMMAND_HANDLERS = {"connect": "connect", "disconnect": "disconnect", "reconnect": "reconnect", "report": "report"}
+
+def handler_name(update: dict) -> str:
+    if "callback_query" in update:
+        return "handle_callback"
+    text = update["message"].get("text") or ""
+    if text.startswith("/"):
+        return COMMAND_HANDLERS.get(text[1:].split()[0], text[1:].split()[0])
+    return "message_handler"
+
+def percentile(values: list[float], fraction: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def db_size() -> int:
+    return sum(os.path.getsize(path) for path in (Omegle.DB_FILE, Omegle.DB_FILE + "-wal") if os.path.exists(path))
+
+def build_phases(args) -> list[tuple[str, list[dict]]]:
+    users = list(range(1, args.users + 1))
+    update_ids = iter(range(1, 10**9))
+    phases = [
+        ("connect", [command_update(next(update_ids), user, "connect") for user in users]),
+        ("chat", [text_update(next(update_ids), user, f"message {i}") for i in range(args.messages) for user in users]),
+    ]
+    for round_number in range(args.reconnects):
+        phases.append((f"reconnect {round_number + 1}", [command_update(next(update_ids), user, "reconnect") for user in users]))
+        phases.append((f"chat {round_number + 2}", [text_update(next(update_ids), user, "hello again") for user in users]))
+    reporters = users[:args.reports]
+    phases.append(("report", [report_update(next(update_ids), user, 1, "spam") for user in reporters]))
+    # Report IDs are assigned in order of arrival, so decide on each one by ID
+    phases.append(("review", [
+        callback_update(next(update_ids), Omegle.BOT_OWNER_ID, Omegle.ADMIN_GROUP_ID, f"{'accept' if report_id % 2 else 'reject'}_report_{report_id}")
+        for report_id in range(1, len(reporters) + 1)
+    ]))
+    phases.append(("disconnect", [command_update(next(update_ids), user, "disconnect") for user in users]))
+    return phases
+
+async def run_phase(application, updates: list[dict], concurrency: int, latencies: dict[str, list[float]]):
+    """Pushes updates through the application's update processor, like the poller or webhook would."""
+    processor = application.update_processor
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(update: Update, name: str):
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies[name].append(time.perf_counter() - started)
+
+    async def feed(data: dict):
+        async with semaphore:
+            update = Update.de_json(data, application.bot)
+            await processor.process_update(update, timed(update, handler_name(data)))
+
+    await asyncio.gather(*(feed(data) for data in updates))
+
+async def run(args) -> dict:
+    request = FakeBotRequest(latency=args.api_latency)
+    application = Omegle.build_application(request=request)
+    await application.initialize()
+    await Omegle.on_startup(application)
+    await application.start()
+
+    results = {"phases": {}, "handlers": {}}
+    latencies: dict[str, list[float]] = defaultdict(list)
+    # Both ends measure the checkpointed main file, not schema setup still sitting in the WAL
+    await Omegle.db.run(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)"))
+    size_before = db_size()
+    total_updates, total_seconds, db_seconds_before = 0, 0.0, Omegle.db.busy_seconds
+
+    for name, updates in build_phases(args):
+        db_before = Omegle.db.busy_seconds
+        started = time.perf_counter()
+        await run_phase(application, updates, args.concurrency, latencies)
+        elapsed = time.perf_counter() - started
+        total_updates += len(updates)
+        total_seconds += elapsed
+        results["phases"][name] = {
+            "updates": len(updates),
+            "updates_per_second": len(updates) / elapsed if elapsed else 0.0,
+            "db_ms_per_update": (Omegle.db.busy_seconds - db_before) * 1000 / max(len(updates), 1),
+        }
+
+    await application.stop()
+    await Omegle.on_stop(application)
+    await application.shutdown()
+    await Omegle.on_shutdown(application)  # Flushes the message log before sizes are measured
+
+    await Omegle.db.run(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)"))
+    for name, values in sorted(latencies.items()):
+        results["handlers"][name] = {
+            "calls": len(values),
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    results["total"] = {
+        "updates": total_updates,
+        "updates_per_second": total_updates / total_seconds if total_seconds else 0.0,
+        "db_ms_per_update": (Omegle.db.busy_seconds - db_seconds_before) * 1000 / max(total_updates, 1),
+        "db_growth_bytes": db_size() - size_before,
+        "bot_api_calls": dict(request.calls),
+    }
+    return results
+
+def random_interests(rng: random.Random, vocabulary: list[str]) -> tuple[str, ...]:
+    """No interests for a third of the users, one to three popular-skewed tags for the rest."""
+    if rng.random() < 1 / 3:
+        return ()
+    return tuple(dict.fromkeys(vocabulary[int(rng.paretovariate(1.2)) % len(vocabulary)] for _ in range(rng.randint(1, 3))))
+
+def run_matchmaking(args) -> list[dict]:
+    """Times Matchmaker.take_partner with queues of 1k, 10k, ... up to args.matchmaking waiting users.
+
+    Each queue is filled with users who started waiting over the last two INTEREST_MATCH_WAITs,
+    so some take anyone by now. Then args.lookups users connect one after another; those not
+    matched join the queue, which keeps its length roughly steady during the run.
+    """
+    rng = random.Random(args.seed)
+    vocabulary = [f"tag{i}" for i in range(args.interest_tags)]
+    sizes = [size for size in (1000, 10000, 100000, 1000000) if size < args.matchmaking] + [args.matchmaking]
+    results = []
+    for size in sizes:
+        matchmaker = Omegle.Matchmaker()
+        now = time.time()
+        for user_id in range(1, size + 1):
+            matchmaker.enqueue(user_id, now - 2 * Omegle.INTEREST_MATCH_WAIT * (1 - user_id / size), random_interests(rng, vocabulary))
+        lookups = [(size + i, random_interests(rng, vocabulary)) for i in range(1, args.lookups + 1)]
+        matched = 0
+        started = time.perf_counter()
+        for user_id, interests in lookups:
+            if matchmaker.take_partner(user_id, interests):
+                matched += 1
+            else:
+                matchmaker.enqueue(user_id, interests=interests)
+        elapsed = time.perf_counter() - started
+        results.append({
+            "waiting": size,
+            "lookups_per_second": len(lookups) / elapsed,
+            "us_per_lookup": elapsed * 1e6 / len(lookups),
+            "matched_percent": matched * 100 / len(lookups),
+        })
+    return results
+
+def print_matchmaking_report(results: list[dict]):
+    print(f"{'waiting users':>14}{'lookups/s':>12}{'us/lookup':>11}{'matched':>9}")
+    for row in results:
+        print(f"{row['waiting']:>14}{row['lookups_per_second']:>12.0f}{row['us_per_lookup']:>11.1f}{row['matched_percent']:>8.0f}%")
+
+def change(new: float, old: float) -> str:
+    return f" ({(new - old) / old * 100:+.1f}%)" if old else ""
+
+def print_report(results: dict, baseline: dict | None):
+    baseline = baseline or {"phases": {}, "handlers": {}, "total": {}}
+    print(f"{'phase':<14}{'updates':>9}{'updates/s':>12}{'DB ms/update':>14}")
+    for name, phase in results["phases"].items():
+        old = baseline["phases"].get(name, {})
+        print(f"{name:<14}{phase['updates']:>9}{phase['updates_per_second']:>12.0f}{phase['db_ms_per_update']:>14.3f}"
+              f"{change(phase['updates_per_second'], old.get('updates_per_second', 0))}")
+    print()
+    print(f"{'handler':<18}{'calls':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, handler in results["handlers"].items():
+        old = baseline["handlers"].get(name, {})
+        print(f"{name:<18}{handler['calls']:>8}{handler['p50_ms']:>10.2f}{handler['p99_ms']:>10.2f}"
+              f"{change(handler['p99_ms'], old.get('p99_ms', 0))}")
+    total, old = results["total"], baseline["total"]
+    print()
+    print(f"Total: {total['updates']} updates at {total['updates_per_second']:.0f}/s"
+          f"{change(total['updates_per_second'], old.get('updates_per_second', 0))}, "
+          f"{total['db_ms_per_update']:.3f} ms DB time per update, "
+          f"database grew by {total['db_growth_bytes'] / 1024:.0f} KiB"
+          f"{change(total['db_growth_bytes'], old.get('db_growth_bytes', 0))}")
+    print(f"Bot API calls: {total['bot_api_calls']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="simulated users (paired two by two)")
+    parser.add_argument("--messages", type=int, default=10, help="text messages sent by every user in the first chat")
+    parser.add_argument("--reconnects", type=int, default=2, help="/reconnect rounds, each followed by one message per user")
+    parser.add_argument("--reports", type=int, default=50, help="users who file a report, reviewed by the owner afterwards")
+    parser.add_argument("--concurrency", type=int, default=256, help="updates fed to the bot at once")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="artificial Bot API round trip in seconds")
+    parser.add_argument("--state-backend", choices=sorted(Omegle.STATE_BACKENDS), default=Omegle.STATE_BACKEND, help="where matchmaking state is kept")
+    parser.add_argument("--flood-control", action="store_true", help="keep the per-user flood limits (synthetic users send far faster than people)")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep Telegram's send rate limits instead of lifting them")
+    parser.add_argument("--matchmaking", type=int, metavar="WAITING", help="only time matchmaking, with up to this many users waiting")
+    parser.add_argument("--lookups", type=int, default=20000, help="connecting users per queue length with --matchmaking")
+    parser.add_argument("--interest-tags", type=int, default=500, help="distinct interest tags with --matchmaking")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for --matchmaking")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.matchmaking:
+        results = run_matchmaking(args)
+        print_matchmaking_report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="omegle-bench-")
+    Omegle.DB_FILE = os.path.join(workdir, "omegle_bot.db")
+    Omegle.STATE_SNAPSHOT_FILE = os.path.join(workdir, "omegle_state.json")
+    Omegle.STATE_BACKEND = args.state_backend
+    if not args.telegram_limits:
+        lift_send_limits()
+
+    if not args.flood_control:
+        Omegle.FLOOD_RATE = Omegle.FLOOD_BURST = 10**6
+    Omegle.init_database()
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        Omegle.db.close()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
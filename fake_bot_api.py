@@ -0,0 +1,154 @@
+# Local stand-in for the Telegram Bot API, used by the test and benchmark harnesses.
+
+import asyncio
+import contextlib
+import itertools
+import json
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+import Omegle
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "OmegleBot", "username": "omegle_test_bot"}
+
+# Methods whose result is a single Message
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendAnimation", "sendSticker", "sendVoice",
+    "sendVideoNote", "sendDocument", "sendAudio", "forwardMessage", "editMessageText",
+}
+
+class FakeBotRequest(BaseRequest):
+    """Answers Bot API calls locally instead of contacting Telegram.
+
+    Pass it to Omegle.build_application(request=...). Every call is counted and timed per API
+    method, and `latency` adds an artificial delay to each call to mimic the round trip to Telegram.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.call_seconds: Counter[str] = Counter()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        started = time.perf_counter()
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        if api_method == "getUpdates":
+            # Webhook harnesses never poll, but don't spin if someone does
+            await asyncio.sleep(1)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        payload = json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+        self.call_seconds[api_method] += time.perf_counter() - started
+        return 200, payload
+
+    def _message(self, chat_id) -> dict:
+        chat_id = int(chat_id)
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+        }
+
+    def _result(self, api_method: str, params: dict):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method == "getUpdates":
+            return []
+        if api_method in MESSAGE_METHODS:
+            return self._message(params.get("chat_id", 0))
+        if api_method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if api_method == "sendMediaGroup":
+            return [self._message(params["chat_id"]) for _ in params.get("media", [])]
+        return True
+
+def lift_send_limits():
+    """Lifts Omegle's outbound send rates out of reach, so harnesses measure the bot itself rather than Telegram's flood limits."""
+    Omegle.GLOBAL_SEND_RATE = Omegle.PRIVATE_CHAT_SEND_RATE = Omegle.PRIVATE_CHAT_SEND_BURST = 10**6
+    Omegle.GROUP_CHAT_SEND_RATE = 10**6
+
+@contextlib.asynccontextmanager
+async def running_bot(request: FakeBotRequest | None = None):
+    """Starts Omegle's Application against the fake Bot API without polling, and yields it.
+
+    Feed updates with application.process_update(); on exit the bot stops and shuts down the
+    way run_polling would, so the shutdown hooks run.
+    """
+    application = Omegle.build_application(request=request or FakeBotRequest())
+    await application.initialize()
+    await Omegle.on_startup(application)
+    await application.start()
+    try:
+        yield application
+    finally:
+        await application.stop()
+        await Omegle.on_stop(application)
+        await application.shutdown()
+        await Omegle.on_shutdown(application)
+
+async def process(application, data: dict):
+    """Runs one update through the application's update processor and then its handlers, like the poller would."""
+    update = Update.de_json(data, application.bot)
+    await application.update_processor.process_update(update, application.process_update(update))
+
+# --- Synthetic updates ---
+def _message(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text,
+    }
+
+def command_update(update_id: int, user_id: int, command: str, *args: str) -> dict:
+    """Update JSON for a private-chat command such as command_update(1, 42, "connect")."""
+    message = _message(update_id, user_id, " ".join((f"/{command}",) + args))
+    message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command) + 1}]
+    return {"update_id": update_id, "message": message}
+
+def text_update(update_id: int, user_id: int, text: str) -> dict:
+    """Update JSON for a plain private-chat text message."""
+    return {"update_id": update_id, "message": _message(update_id, user_id, text)}
+
+def report_update(update_id: int, user_id: int, reported_message_id: int, reason: str) -> dict:
+    """Update JSON for /report sent as a reply to a message the bot relayed to the user."""
+    update = command_update(update_id, user_id, "report", reason)
+    reported = _message(reported_message_id, user_id, "reported message")
+    reported["from"] = BOT_USER
+    update["message"]["reply_to_message"] = reported
+    return update
+
+def callback_update(update_id: int, user_id: int, chat_id: int, data: str) -> dict:
+    """Update JSON for an inline button press on a bot message in chat_id."""
+    message = _message(update_id, chat_id, "button message")
+    message["chat"]["type"] = "supergroup"
+    message["from"] = BOT_USER
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": message,
+        },
+    }
@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import Omegle
+
+@pytest.fixture
+def bot_files(tmp_path, monkeypatch):
+    """Points the database, state snapshot and archives at a temporary directory and closes the database afterwards."""
+    monkeypatch.setattr(Omegle, "DB_FILE", str(tmp_path / "omegle_bot.db"))
+    monkeypatch.setattr(Omegle, "STATE_SNAPSHOT_FILE", str(tmp_path / "omegle_state.json"))
+    monkeypatch.setattr(Omegle, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(Omegle, "METRICS_ENABLED", False)
+    # init_database replaces the state backend
+    monkeypatch.setattr(Omegle, "state", Omegle.state)
+    # Nothing a test leaves in a worker's memory, e.g. a chat's send bucket or a cached file_id, reaches the next test
+    monkeypatch.setattr(Omegle, "media_files", Omegle.MediaFileIds(Omegle.MEDIA_FILE_CACHE_SIZE))
+    for name, cls in [
+        ("message_log", Omegle.MessageLogWriter), ("dispatcher", Omegle.OutboundDispatcher), ("stats", Omegle.StatsTracker),
+        ("activity", Omegle.ChatActivity), ("album_relay", Omegle.AlbumRelay), ("flood_limiter", Omegle.FloodLimiter),
+        ("broadcaster", Omegle.Broadcaster),
+    ]:
+        monkeypatch.setattr(Omegle, name, cls())
+    yield tmp_path
+    Omegle.db.close()
@@ -0,0 +1,37 @@
+import asyncio
+
+import Omegle
+from fake_bot_api import command_update, process, running_bot
+
+def test_loading_keeps_the_newest_open_chat_per_user(bot_files):
+    Omegle.init_database()
+
+    def insert(conn):
+        with conn:
+            # An older version left user 1 with two open chats
+            conn.executemany(
+                "INSERT INTO chat_pairs (id, user1_id, user2_id) VALUES (?, ?, ?)", [(1, 1, 2), (2, 3, 1), (3, 4, 5)]
+            )
+    Omegle.db.run_sync(insert)
+    Omegle.db.run_sync(Omegle.state.load_active_pairs)
+
+    assert Omegle.state.active_pairs == {1: (3, 2), 3: (1, 2), 4: (5, 3), 5: (4, 3)}
+    still_open = Omegle.db.run_sync(lambda conn: conn.execute("SELECT id FROM chat_pairs WHERE disconnected_at IS NULL ORDER BY id").fetchall())
+    assert [row['id'] for row in still_open] == [2, 3]
+
+async def connect_and_disconnect():
+    async with running_bot() as application:
+        await process(application, command_update(1, 1, "connect"))
+        await process(application, command_update(2, 2, "connect"))
+        paired = dict(Omegle.state.active_pairs)
+        await process(application, command_update(3, 2, "disconnect"))
+        return paired, dict(Omegle.state.active_pairs)
+
+def test_index_follows_connect_and_disconnect(bot_files):
+    Omegle.init_database()
+    paired, after = asyncio.run(connect_and_disconnect())
+    pair_id = paired[1][1]
+    assert paired == {1: (2, pair_id), 2: (1, pair_id)}
+    assert after == {}
+    closed = Omegle.db.run_sync(lambda conn: conn.execute("SELECT disconnected_at FROM chat_pairs WHERE id = ?", (pair_id,)).fetchone())
+    assert closed['disconnected_at'] is not None
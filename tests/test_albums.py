@@ -0,0 +1,64 @@
+import asyncio
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update, process, running_bot, text_update
+
+class RecordingRequest(FakeBotRequest):
+    """Also keeps every call to the partner (user 2) in order, as (method, parameters)."""
+
+    def __init__(self):
+        super().__init__()
+        self.to_partner = []
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = request_data.parameters if request_data else {}
+        if str(params.get("chat_id")) == "2":
+            self.to_partner.append((url.rsplit("/", 1)[-1], params))
+        return await super().do_request(url, method, request_data, **kwargs)
+
+def photo_update(update_id: int, user_id: int, media_group_id: str) -> dict:
+    update = text_update(update_id, user_id, "")
+    message = update["message"]
+    del message["text"]
+    message["photo"] = [{"file_id": f"photo-{update_id}", "file_unique_id": f"u{update_id}", "width": 90, "height": 90}]
+    message["media_group_id"] = media_group_id
+    message["caption"] = f"caption {update_id}"
+    return update
+
+async def send_album(then_text: bool) -> RecordingRequest:
+    request = RecordingRequest()
+    async with running_bot(request) as application:
+        await process(application, command_update(1, 1, "connect"))
+        await process(application, command_update(2, 2, "connect"))
+        request.to_partner.clear()
+        # Telegram may deliver the items of an album out of order
+        for update_id in (12, 10, 11):
+            await process(application, photo_update(update_id, 1, "album-1"))
+        if then_text:
+            await process(application, text_update(13, 1, "and some text"))
+        else:
+            await asyncio.sleep(Omegle.ALBUM_WINDOW * 3)
+    return request
+
+def album_file_ids(params: dict) -> list[str]:
+    return [item["media"] for item in params["media"]]
+
+def test_album_items_are_relayed_together_in_order(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "ALBUM_WINDOW", 0.05)
+    Omegle.init_database()
+
+    request = asyncio.run(send_album(then_text=False))
+    assert [method for method, _ in request.to_partner] == ["sendMediaGroup"]
+    assert album_file_ids(request.to_partner[0][1]) == ["photo-10", "photo-11", "photo-12"]
+
+    rows = Omegle.db.run_sync(lambda conn: conn.execute(Omegle.ARCHIVABLE_MESSAGES_SQL, (2**31, 100)).fetchall())
+    assert [(row['media_type'], row['media_id'], row['message_text']) for row in rows] == [
+        ("photo", f"photo-{i}", f"caption {i}") for i in (10, 11, 12)
+    ]
+
+def test_next_message_waits_for_the_pending_album(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "ALBUM_WINDOW", 5)
+    Omegle.init_database()
+
+    request = asyncio.run(send_album(then_text=True))
+    assert [method for method, _ in request.to_partner] == ["sendMediaGroup", "copyMessage"]
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+import Omegle
+from fake_bot_api import callback_update, command_update, running_bot
+
+async def ban_while_connecting(connect_delay: float) -> tuple:
+    """User 12 waits; the owner bans user 10 while user 10 sends /connect. Returns 10's chat and ban state."""
+    async with running_bot() as application:
+        update = lambda update_id, user_id, *command: Update.de_json(command_update(update_id, user_id, *command), application.bot)
+
+        await application.process_update(update(1, 12, "connect"))
+
+        async def connect_later():
+            await asyncio.sleep(connect_delay)
+            await application.process_update(update(3, 10, "connect"))
+
+        await asyncio.gather(application.process_update(update(2, Omegle.BOT_OWNER_ID, "ban", "10")), connect_later())
+        return await Omegle.state.get_pair(10), await Omegle.state.is_banned(10), await Omegle.state.counts()
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+@pytest.mark.parametrize("connect_delay", [0, 0.001, 0.005])
+def test_banned_user_is_never_paired(bot_files, monkeypatch, backend, connect_delay):
+    monkeypatch.setattr(Omegle, "STATE_BACKEND", backend)
+    Omegle.init_database()
+
+    pair, banned, (waiting, open_chats) = asyncio.run(ban_while_connecting(connect_delay))
+    assert banned
+    assert pair is None
+    # User 12 is still waiting for someone else
+    assert (waiting, open_chats) == (1, 0)
+
+async def accept_report_while_waiting() -> tuple:
+    """User 20 is reported and waiting for a partner; an admin accepts the report, then user 30 connects."""
+    async with running_bot() as application:
+        await Omegle.db.execute("INSERT INTO reports (reporter_id, reported_id, reason) VALUES (10, 20, 'spam')")
+
+        await application.process_update(Update.de_json(command_update(1, 20, "connect"), application.bot))
+        await application.process_update(Update.de_json(
+            callback_update(2, Omegle.BOT_OWNER_ID, Omegle.ADMIN_GROUP_ID, "accept_report_1"), application.bot
+        ))
+        await application.process_update(Update.de_json(command_update(3, 30, "connect"), application.bot))
+        return await Omegle.state.get_pair(30), await Omegle.state.is_banned(20), await Omegle.state.counts()
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_accepted_report_takes_user_out_of_the_queue(bot_files, monkeypatch, backend):
+    monkeypatch.setattr(Omegle, "STATE_BACKEND", backend)
+    Omegle.init_database()
+
+    pair, banned, (waiting, open_chats) = asyncio.run(accept_report_while_waiting())
+    assert banned
+    assert pair is None
+    # Only user 30 is waiting now
+    assert (waiting, open_chats) == (1, 0)
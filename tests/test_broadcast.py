@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import pytest
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update, process, running_bot
+
+class RecordingRequest(FakeBotRequest):
+    """Also keeps the chat_id and text of every sendMessage call."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            self.messages.append((int(request_data.parameters["chat_id"]), request_data.parameters["text"]))
+        return await super().do_request(url, method, request_data, **kwargs)
+
+@pytest.fixture
+def users(bot_files, monkeypatch):
+    """250 users, and send rates high enough that a broadcast to them takes a moment."""
+    for name in ("GLOBAL_SEND_RATE", "BROADCAST_RATE", "BROADCAST_CONCURRENCY"):
+        monkeypatch.setattr(Omegle, name, 1000)
+    Omegle.init_database()
+
+    def insert(conn):
+        with conn:
+            conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(user_id,) for user_id in range(1, 251)])
+    Omegle.db.run_sync(insert)
+
+def add_broadcast(owner: str, lease_until: float) -> int:
+    def insert(conn):
+        with conn:
+            return conn.execute(
+                "INSERT INTO broadcasts (admin_id, text, last_user_id, owner, lease_until) VALUES (?, 'news', 100, ?, ?)",
+                (Omegle.BOT_OWNER_ID, owner, lease_until)
+            ).lastrowid
+    return Omegle.db.run_sync(insert)
+
+def broadcast_row(broadcast_id: int):
+    return Omegle.db.run_sync(lambda conn: conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone())
+
+async def run_bot_while_broadcasting(request: FakeBotRequest, seconds: float = 0.5):
+    async with running_bot(request):
+        await asyncio.sleep(seconds)
+
+def test_interrupted_broadcast_resumes_after_the_last_saved_page(users):
+    # The worker that started it died mid-way: its lease has lapsed
+    broadcast_id = add_broadcast("other-host:1", time.time() - 1)
+    request = RecordingRequest()
+    asyncio.run(run_bot_while_broadcasting(request))
+
+    recipients = [chat_id for chat_id, text in request.messages if text == "news"]
+    assert sorted(recipients) == list(range(101, 251))
+    row = broadcast_row(broadcast_id)
+    assert (row['status'], row['sent'], row['last_user_id']) == ("done", 150, 250)
+
+def test_broadcast_leased_by_another_worker_is_left_alone(users):
+    broadcast_id = add_broadcast("other-host:1", time.time() + Omegle.BROADCAST_LEASE_SECONDS)
+    request = RecordingRequest()
+    asyncio.run(run_bot_while_broadcasting(request, seconds=0.1))
+
+    assert request.messages == []
+    assert broadcast_row(broadcast_id)['owner'] == "other-host:1"
+
+async def broadcast(text: str, cancel: bool) -> RecordingRequest:
+    request = RecordingRequest()
+    async with running_bot(request) as application:
+        await process(application, command_update(1, Omegle.BOT_OWNER_ID, "broadcast", text))
+        if cancel:
+            await process(application, command_update(2, Omegle.BOT_OWNER_ID, "broadcast", "cancel"))
+        else:
+            await asyncio.sleep(0.5)
+    return request
+
+def test_broadcast_text_keeps_its_line_breaks(users):
+    request = asyncio.run(broadcast("First line\nSecond line", cancel=False))
+    recipients = [chat_id for chat_id, text in request.messages if text == "First line\nSecond line"]
+    assert sorted(recipients) == list(range(1, 251))
+    assert broadcast_row(1)['status'] == "done"
+
+def test_cancelled_broadcast_is_not_resumed(users):
+    asyncio.run(broadcast("news", cancel=True))
+    assert broadcast_row(1)['status'] == "cancelled"
+
+    request = RecordingRequest()
+    asyncio.run(run_bot_while_broadcasting(request, seconds=0.1))
+    assert [text for _, text in request.messages if text == "news"] == []
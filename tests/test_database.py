@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+import pytest
+
+import Omegle
+
+def test_statements_run_on_the_database_thread(bot_files):
+    Omegle.init_database()
+
+    async def thread_names():
+        return (
+            await Omegle.db.run(lambda conn: threading.current_thread().name),
+            threading.current_thread().name,
+        )
+
+    db_thread, loop_thread = asyncio.run(thread_names())
+    assert db_thread.startswith("omegle-db")
+    assert db_thread != loop_thread
+
+def test_failed_transaction_is_rolled_back(bot_files):
+    Omegle.init_database()
+
+    def ban_then_fail(conn):
+        Omegle.record_ban(conn, 5, "spam", 1)
+        raise ValueError("admin changed their mind")
+
+    with pytest.raises(ValueError):
+        asyncio.run(Omegle.db.transaction(ban_then_fail))
+    assert asyncio.run(Omegle.db.fetchone("SELECT 1 FROM banned_users WHERE user_id = 5")) is None
+
+    busy_before = Omegle.db.busy_seconds
+    cursor = asyncio.run(Omegle.db.execute("INSERT INTO users (user_id) VALUES (5)"))
+    assert (cursor.rowcount, cursor.lastrowid) == (1, 5)
+    assert Omegle.db.busy_seconds > busy_before
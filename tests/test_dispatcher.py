@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+
+import pytest
+from telegram import Update
+from telegram.error import Forbidden, RetryAfter
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update, report_update, running_bot, text_update
+
+async def report_burst(reports: int) -> tuple[float, FakeBotRequest]:
+    """Users 1 and 2 chat; user 1 files several reports, then sends a message. Returns how long that took."""
+    request = FakeBotRequest()
+    async with running_bot(request) as application:
+        update = lambda data: Update.de_json(data, application.bot)
+        await application.process_update(update(command_update(1, 1, "connect")))
+        await application.process_update(update(command_update(2, 2, "connect")))
+        started = asyncio.get_running_loop().time()
+        for i in range(reports):
+            await application.process_update(update(report_update(10 + i, 1, 100 + i, "spam")))
+        await application.process_update(update(text_update(50, 1, "still here")))
+        elapsed = asyncio.get_running_loop().time() - started
+    return elapsed, request
+
+def test_reports_dont_wait_for_the_admin_lane(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "GROUP_CHAT_SEND_RATE", 10)
+    monkeypatch.setattr(Omegle, "PRIVATE_CHAT_SEND_BURST", 100)
+    Omegle.init_database()
+
+    elapsed, request = asyncio.run(report_burst(5))
+    # Ten admin group calls take 0.9s at this rate; the reporter's chat doesn't wait for them
+    assert elapsed < 0.3
+    # Shutdown still delivered every notification
+    assert (request.calls["forwardMessage"], request.calls["copyMessage"]) == (5, 1)
+
+async def with_dispatcher(test):
+    """Runs test(dispatcher) against a started OutboundDispatcher and stops it afterwards."""
+    dispatcher = Omegle.OutboundDispatcher()
+    dispatcher.start()
+    try:
+        return await test(dispatcher)
+    finally:
+        await dispatcher.stop()
+
+def test_calls_to_one_chat_keep_their_order(monkeypatch):
+    monkeypatch.setattr(Omegle, "PRIVATE_CHAT_SEND_BURST", 100)
+    delivered = []
+
+    async def send(chat_id: int, number: int):
+        # Later calls return sooner, so only the per-chat queue keeps them in order
+        await asyncio.sleep((10 - number) / 1000)
+        delivered.append((chat_id, number))
+
+    async def test(dispatcher):
+        await asyncio.gather(*(dispatcher.submit(chat_id, send, chat_id, number) for number in range(10) for chat_id in (1, 2)))
+
+    asyncio.run(with_dispatcher(test))
+    for chat_id in (1, 2):
+        assert [number for chat, number in delivered if chat == chat_id] == list(range(10))
+
+def test_a_paced_chat_doesnt_hold_up_the_others(monkeypatch):
+    monkeypatch.setattr(Omegle, "GROUP_CHAT_SEND_RATE", 2)
+    finished = {}
+
+    async def send(chat_id: int):
+        finished[chat_id] = asyncio.get_running_loop().time()
+
+    async def test(dispatcher):
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(dispatcher.submit(-100, send, -100) for _ in range(4)), dispatcher.submit(5, send, 5))
+        return started
+
+    started = asyncio.run(with_dispatcher(test))
+    # The group gets 2 calls a second; the private chat's call goes out right away
+    assert finished[5] - started < 0.1
+    assert finished[-100] - started >= 1.4
+
+def test_retry_after_is_retried_after_the_delay():
+    attempts = []
+
+    async def flaky():
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) < 3:
+            raise RetryAfter(datetime.timedelta(milliseconds=50))
+        return "sent"
+
+    async def test(dispatcher):
+        return await dispatcher.submit(1, flaky), dispatcher.retried
+
+    assert asyncio.run(with_dispatcher(test)) == ("sent", 2)
+    assert attempts[2] - attempts[0] >= 0.1
+
+def test_errors_reach_the_caller(monkeypatch):
+    monkeypatch.setattr(Omegle, "SEND_MAX_RETRIES", 1)
+
+    async def flood():
+        raise RetryAfter(datetime.timedelta(milliseconds=10))
+
+    async def forbidden():
+        raise Forbidden("bot was blocked by the user")
+
+    async def test(dispatcher):
+        with pytest.raises(RetryAfter):
+            await dispatcher.submit(1, flood)
+        with pytest.raises(Forbidden):
+            await dispatcher.submit(2, forbidden)
+        return dispatcher.failed
+
+    assert asyncio.run(with_dispatcher(test)) == 2
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update, process, running_bot, text_update
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_cooldowns_grow_with_each_strike_and_reset(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    limiter = Omegle.FloodLimiter()
+
+    assert [limiter.check(1)[0] for _ in range(Omegle.FLOOD_BURST)] == ["ok"] * Omegle.FLOOD_BURST
+    assert limiter.check(1) == ("cooldown", Omegle.FLOOD_COOLDOWNS[0], 1)
+    assert limiter.check(1)[0] == "drop"
+    assert limiter.check(2)[0] == "ok"
+
+    clock.now += Omegle.FLOOD_COOLDOWNS[0]
+    assert limiter.check(1)[0] == "ok"  # One token refilled per second meanwhile, up to the burst
+    for _ in range(Omegle.FLOOD_BURST):
+        limiter.check(1)
+    assert limiter.check(1)[1:] == (Omegle.FLOOD_COOLDOWNS[1], 2)
+
+    # A quiet hour forgets the strikes
+    clock.now += Omegle.FLOOD_STRIKE_RESET + Omegle.FLOOD_COOLDOWNS[1]
+    for _ in range(Omegle.FLOOD_BURST):
+        limiter.check(1)
+    assert limiter.check(1)[1:] == (Omegle.FLOOD_COOLDOWNS[0], 1)
+
+def test_idle_users_are_evicted_but_muted_ones_kept(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    monkeypatch.setattr(Omegle, "FLOOD_STATE_LIMIT", 2)
+    limiter = Omegle.FloodLimiter()
+
+    for _ in range(Omegle.FLOOD_BURST + 1):
+        limiter.check(1)  # Muted
+    limiter.check(2)
+    limiter.check(3)
+    limiter.check(4)
+    assert list(limiter._users) == [1, 4]
+    assert limiter.check(1)[0] == "drop"
+
+async def flood(messages: int) -> FakeBotRequest:
+    request = FakeBotRequest()
+    async with running_bot(request) as application:
+        await process(application, command_update(1, 1, "connect"))
+        await process(application, command_update(2, 2, "connect"))
+        await asyncio.gather(*(process(application, text_update(10 + i, 1, f"spam {i}")) for i in range(messages)))
+    return request
+
+def test_a_flood_is_cut_off_before_the_relay(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "PRIVATE_CHAT_SEND_BURST", 100)
+    Omegle.init_database()
+
+    request = asyncio.run(flood(30))
+    assert request.calls["copyMessage"] == Omegle.FLOOD_BURST
+    # "Searching", "partner found" and the cooldown notice
+    assert request.calls["sendMessage"] == 2 + 1 + 1
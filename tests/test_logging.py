@@ -0,0 +1,38 @@
+import json
+import logging
+import queue
+
+import Omegle
+
+def make_record(message: str, level: int = logging.INFO, **extra) -> logging.LogRecord:
+    record = logging.makeLogRecord({"name": "Omegle", "levelno": level, "levelname": logging.getLevelName(level), "msg": message})
+    record.__dict__.update(extra)
+    return record
+
+def test_records_are_dropped_and_counted_when_the_writer_falls_behind():
+    handler = Omegle.NonBlockingQueueHandler(queue.Queue(2))
+    dropped_before = Omegle.LOG_RECORDS_DROPPED.values.get((), 0)
+    for i in range(5):
+        handler.handle(make_record(f"record {i}"))
+
+    assert handler.queue.qsize() == 2
+    assert Omegle.LOG_RECORDS_DROPPED.values[()] - dropped_before == 3
+
+def test_json_lines_carry_extra_and_context_fields():
+    token = Omegle.log_context.set({"handler": "connect", "user_id": 42})
+    try:
+        record = make_record("Paired %s", args=(42,), event="paired", pair_id=7)
+        assert Omegle.ContextFilter().filter(record)
+    finally:
+        Omegle.log_context.reset(token)
+
+    entry = json.loads(Omegle.JsonFormatter().format(record))
+    assert entry["message"] == "Paired 42"
+    assert (entry["level"], entry["event"], entry["pair_id"], entry["handler"], entry["user_id"]) == ("INFO", "paired", 7, "connect", 42)
+
+def test_high_volume_events_are_sampled_but_warnings_kept(monkeypatch):
+    monkeypatch.setattr(Omegle, "LOG_SAMPLE_RATE", 0.0)
+    context_filter = Omegle.ContextFilter()
+    assert not context_filter.filter(make_record("relayed", event="relay"))
+    assert context_filter.filter(make_record("paired", event="paired"))
+    assert context_filter.filter(make_record("relay failed", level=logging.WARNING, event="relay"))
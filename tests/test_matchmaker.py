@@ -0,0 +1,60 @@
+import time
+
+import Omegle
+
+def queue(*users: tuple[int, float, tuple[str, ...]]) -> Omegle.Matchmaker:
+    """A Matchmaker with (user_id, seconds ago, interests) enqueued in that order."""
+    matchmaker = Omegle.Matchmaker()
+    now = time.time()
+    for user_id, seconds_ago, interests in users:
+        matchmaker.enqueue(user_id, now - seconds_ago, interests)
+    return matchmaker
+
+def test_pairs_longest_waiting_first():
+    matchmaker = queue((1, 30, ()), (2, 20, ()), (3, 10, ()))
+    assert matchmaker.take_partner(10)[0] == 1
+    assert matchmaker.take_partner(11)[0] == 2
+    assert list(matchmaker._waiting) == [3]
+
+def test_new_user_is_queued_when_nobody_waits():
+    matchmaker = Omegle.Matchmaker()
+    assert matchmaker.take_partner(1) is None
+    matchmaker.enqueue(1)
+    assert 1 in matchmaker and len(matchmaker) == 1
+
+def test_skips_recent_partner():
+    matchmaker = queue((1, 30, ()), (2, 20, ()))
+    matchmaker.remember_split(1, 5)
+    assert matchmaker.take_partner(5)[0] == 2
+    assert matchmaker.take_partner(6)[0] == 1
+
+def test_interests_are_matched_on_a_shared_tag():
+    matchmaker = queue((1, 5, ("music",)), (2, 4, ()), (3, 3, ("games", "music")))
+    assert matchmaker.take_partner(10, ("films", "games"))[0] == 3
+    # User 1 only takes someone sharing "music" until INTEREST_MATCH_WAIT is over
+    assert matchmaker.take_partner(11)[0] == 2
+    assert matchmaker.take_partner(12) is None
+    assert matchmaker.take_partner(13, ("music",))[0] == 1
+
+def test_interest_users_take_anyone_after_waiting():
+    wait = Omegle.INTEREST_MATCH_WAIT
+    matchmaker = queue((1, wait + 10, ("music",)), (2, wait + 5, ("games",)), (3, 1, ("films",)))
+    (user1, _, _), (user2, _, _) = matchmaker.take_fallback_pair()
+    assert {user1, user2} == {1, 2}
+    assert matchmaker.take_fallback_pair() is None
+
+def test_expire_removes_users_queued_before_cutoff():
+    matchmaker = queue((1, 300, ()), (2, 200, ("music",)), (3, 10, ()))
+    assert matchmaker.expire(time.time() - 100) == [1, 2]
+    assert list(matchmaker._waiting) == [3]
+    assert "music" not in matchmaker._by_interest
+
+def test_requeue_keeps_enqueue_time_order():
+    matchmaker = queue((1, 20, ("music",)), (2, 15, ()), (3, 10, ()))
+    partner_id, enqueued_at, interests = matchmaker.take_partner(10)
+    assert partner_id == 2
+    # Pairing failed, so user 2 goes back where they were: behind user 1, who waited longer
+    matchmaker.requeue(partner_id, enqueued_at, interests)
+    assert list(matchmaker._waiting) == [1, 2, 3]
+    assert list(matchmaker._without_interests) == [2, 3]
+    assert matchmaker.expire(time.time() - 12) == [1, 2]
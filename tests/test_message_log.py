@@ -0,0 +1,41 @@
+import asyncio
+
+import Omegle
+
+async def log_messages(count: int) -> list[int]:
+    """Logs `count` messages and returns the size of every batch written."""
+    batches = []
+    write = Omegle.MessageLogWriter._write
+
+    def counting_write(conn, batch):
+        batches.append(len(batch))
+        write(conn, batch)
+
+    Omegle.message_log._write = counting_write
+    Omegle.message_log.start()
+    for i in range(count):
+        await Omegle.message_log.log(1, 10 + i % 2, f"message {i}", None, None)
+    await Omegle.message_log.stop()
+    return batches
+
+def test_messages_are_written_in_batches_and_drained_on_stop(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "MESSAGE_LOG_BATCH_SIZE", 4)
+    Omegle.init_database()
+
+    assert asyncio.run(log_messages(10)) == [4, 4, 2]
+    texts = Omegle.db.run_sync(lambda conn: conn.execute("SELECT message_text FROM messages ORDER BY id").fetchall())
+    assert [row['message_text'] for row in texts] == [f"message {i}" for i in range(10)]
+
+def test_a_partial_batch_is_written_after_the_flush_interval(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "MESSAGE_LOG_FLUSH_INTERVAL", 0.05)
+    Omegle.init_database()
+
+    async def log_and_wait():
+        Omegle.message_log.start()
+        await Omegle.message_log.log(1, 10, "hello", "photo", "photo-file-id")
+        await asyncio.sleep(0.2)
+        written = await Omegle.db.fetchone("SELECT COUNT(*) AS count FROM messages")
+        await Omegle.message_log.stop()
+        return written['count']
+
+    assert asyncio.run(log_and_wait()) == 1
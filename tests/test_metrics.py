@@ -0,0 +1,41 @@
+import asyncio
+
+import Omegle
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Omegle.HistogramMetric("latency_seconds", "Latency.", (0.1, 1.0), ("handler",))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, "connect")
+
+    assert dict(histogram.samples()) == {
+        'latency_seconds_bucket{handler="connect",le="0.1"}': 1,
+        'latency_seconds_bucket{handler="connect",le="1.0"}': 3,
+        'latency_seconds_bucket{handler="connect",le="+Inf"}': 4,
+        'latency_seconds_sum{handler="connect"}': 4.25,
+        'latency_seconds_count{handler="connect"}': 4,
+    }
+
+def test_metrics_endpoint_serves_the_registry():
+    registry = Omegle.MetricsRegistry()
+    registry.register(Omegle.CounterMetric("sends_total", "Sends.", ("status",))).inc("ok", amount=2)
+
+    async def waiting():
+        return 7
+    registry.register(Omegle.GaugeMetric("waiting_users", "Users waiting.", waiting))
+
+    async def get(path: str) -> bytes:
+        server = await registry.serve("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    response = asyncio.run(get("/metrics"))
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b'\r\n\r\n# HELP sends_total Sends.\n# TYPE sends_total counter\nsends_total{status="ok"} 2\n' in response
+    assert b"waiting_users 7\n" in response
+    assert asyncio.run(get("/other")).startswith(b"HTTP/1.1 404")
@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+
+import Omegle
+
+# The tables as the original single-connection version of the bot created them, before versioned migrations
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE chat_pairs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user1_id INTEGER NOT NULL,
+        user2_id INTEGER NOT NULL,
+        connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        disconnected_at TIMESTAMP
+    );
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pair_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        message_text TEXT,
+        media_type TEXT,
+        media_id TEXT,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (pair_id) REFERENCES chat_pairs(id)
+    );
+    CREATE TABLE banned_users (
+        user_id INTEGER PRIMARY KEY,
+        reason TEXT,
+        banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        banned_by_admin_id INTEGER
+    );
+    CREATE TABLE sudo_users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT
+    );
+    CREATE TABLE reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reporter_id INTEGER,
+        reported_id INTEGER,
+        reason TEXT,
+        reported_message_text TEXT,
+        reported_media_id TEXT,
+        reported_media_type TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT DEFAULT 'pending'
+    );
+'''
+
+MESSAGES = [
+    (1, 1, "hello", None, None, "2026-01-02 10:00:00"),
+    (1, 2, None, "photo", "photo-file-id", "2026-01-02 10:00:05"),
+    (1, 1, "same photo again", "photo", "photo-file-id", "2026-01-02 10:00:09"),
+    (1, 2, None, "sticker", "sticker-file-id", "2026-01-02 10:00:12"),
+]
+
+def create_baseline_database(path: str):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO users (user_id, username) VALUES (?, ?)", [(1, "one"), (2, "two"), (3, None)])
+    conn.execute(
+        "INSERT INTO chat_pairs (user1_id, user2_id, connected_at, disconnected_at) "
+        "VALUES (1, 2, '2026-01-02 09:59:00', '2026-01-02 10:01:00')"
+    )
+    conn.executemany(
+        "INSERT INTO messages (pair_id, sender_id, message_text, media_type, media_id, sent_at) VALUES (?, ?, ?, ?, ?, ?)",
+        MESSAGES
+    )
+    conn.execute(
+        "INSERT INTO reports (reporter_id, reported_id, reason, reported_media_id, reported_media_type, status) "
+        "VALUES (1, 2, 'spam', 'sticker-file-id', 'sticker', 'rejected')"
+    )
+    conn.execute("INSERT INTO banned_users (user_id, reason, banned_by_admin_id) VALUES (3, 'spam', 1)")
+    conn.commit()
+    conn.close()
+
+def test_baseline_database_migrates_to_the_latest_version(bot_files):
+    create_baseline_database(Omegle.DB_FILE)
+    Omegle.init_database()
+
+    assert Omegle.db.run_sync(lambda conn: conn.execute("PRAGMA user_version").fetchone()[0]) == len(Omegle.MIGRATIONS)
+    assert Omegle.db.run_sync(lambda conn: conn.execute("PRAGMA integrity_check").fetchone()[0]) == "ok"
+    counts = Omegle.db.run_sync(lambda conn: [
+        conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("users", "chat_pairs", "messages", "reports")
+    ])
+    assert counts == [3, 1, len(MESSAGES), 1]
+    assert isinstance(Omegle.state, Omegle.InProcessState)
+    assert Omegle.state.banned_user_ids == {3}
+
+def test_migrations_run_once(bot_files):
+    create_baseline_database(Omegle.DB_FILE)
+    Omegle.init_database()
+    Omegle.db.close()
+
+    Omegle.init_database()
+    assert Omegle.db.run_sync(lambda conn: conn.execute("PRAGMA user_version").fetchone()[0]) == len(Omegle.MIGRATIONS)
+    assert Omegle.db.run_sync(lambda conn: conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]) == len(MESSAGES)
+
+def test_workers_starting_together_migrate_once(bot_files):
+    workers = 4
+    barrier, errors = threading.Barrier(workers), []
+
+    def start_worker():
+        barrier.wait()
+        conn = Omegle.get_db_connection()
+        try:
+            Omegle.setup_database(conn)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=start_worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    conn = Omegle.get_db_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(Omegle.MIGRATIONS)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    conn.close()
+
+def test_message_log_is_stored_compactly_and_reads_back(bot_files):
+    create_baseline_database(Omegle.DB_FILE)
+    Omegle.init_database()
+
+    # Messages read back as they were written, with each file_id stored once
+    rows = Omegle.db.run_sync(lambda conn: conn.execute(Omegle.ARCHIVABLE_MESSAGES_SQL, (2**31, 100)).fetchall())
+    assert [(r['pair_id'], r['sender_id'], r['message_text'], r['media_type'], r['media_id'], r['sent_at']) for r in rows] == MESSAGES
+    assert Omegle.db.run_sync(lambda conn: conn.execute("SELECT COUNT(*) FROM media_files").fetchone()[0]) == 2
+
+    report = Omegle.db.run_sync(lambda conn: conn.execute(
+        f"SELECT reason, pair_id, {Omegle.sql_media_type_name('reported_media_type')} AS media_type, file_id "
+        "FROM reports LEFT JOIN media_files ON media_files.id = reports.reported_media_file_id"
+    ).fetchone())
+    assert tuple(report) == ("spam", 1, "sticker", "sticker-file-id")
@@ -0,0 +1,30 @@
+import asyncio
+import os
+import time
+
+import Omegle
+
+def test_profile_lists_slow_callbacks_and_saves_pstats(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "PROFILE_DIR", str(bot_files / "profiles"))
+    monkeypatch.setattr(Omegle, "SLOW_CALLBACK_MS", 20)
+    Omegle.init_database()
+    summaries = []
+
+    async def notify(summary: str):
+        summaries.append(summary)
+
+    async def profile():
+        profiler = Omegle.LoopProfiler()
+        profiler.start(0.2, notify)
+        await asyncio.sleep(0.05)
+        asyncio.get_running_loop().call_soon(time.sleep, 0.05)  # Blocks the loop
+        await Omegle.db.fetchall("SELECT * FROM users")
+        await profiler._task
+
+    original_run = asyncio.Handle._run
+    asyncio.run(profile())
+    assert asyncio.Handle._run is original_run  # The callback timer was taken out again
+    assert "1 loop callbacks blocked for more than 20 ms." in summaries[0]
+    files = sorted(os.listdir(bot_files / "profiles"))
+    assert any(name.endswith("-loop.pstats") for name in files)
+    assert any(name.endswith("-slow.txt") for name in files)
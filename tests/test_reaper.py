@@ -0,0 +1,73 @@
+import asyncio
+import json
+import time
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update, process, running_bot, text_update
+
+class BlockingRequest(FakeBotRequest):
+    """Answers calls to the user IDs in `blocked` with Telegram's "bot was blocked by the user" error."""
+
+    def __init__(self):
+        super().__init__()
+        self.blocked: set[str] = set()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = request_data.parameters if request_data else {}
+        if str(params.get("chat_id")) in self.blocked:
+            return 403, json.dumps({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}).encode()
+        return await super().do_request(url, method, request_data, **kwargs)
+
+async def connect(application, *user_ids: int):
+    for user_id in user_ids:
+        await process(application, command_update(user_id * 10, user_id, "start"))
+        await process(application, command_update(user_id * 10 + 1, user_id, "connect"))
+
+async def reap() -> tuple:
+    """Chats (1, 2), (3, 4) and (5, 6): the first is idle, the second active, the third active on another worker."""
+    async with running_bot() as application:
+        await connect(application, 1, 2, 3, 4, 5, 6, 7)
+        pairs = {user_id: (await Omegle.state.get_pair(user_id))[1] for user_id in (1, 3, 5)}
+        idle_since = time.time() - Omegle.IDLE_CHAT_TIMEOUT - 60
+        Omegle.activity.touch(pairs[1], 1, 2, at=idle_since)
+        Omegle.activity.touch(pairs[5], 5, 6, at=idle_since)
+        Omegle.activity.touch(pairs[3], 3, 4)
+        await Omegle.db.execute(
+            "INSERT INTO messages (pair_id, sender_id, message_text, sent_at) VALUES (?, 5, 'hi', ?)", (pairs[5], int(time.time()))
+        )
+        # User 7 has been searching for too long
+        Omegle.state.matchmaker.cancel(7)
+        Omegle.state.matchmaker.enqueue(7, time.time() - Omegle.MAX_WAIT_SECONDS - 60)
+
+        reaped = await Omegle.reap_idle_chats(application.bot)
+        expired = await Omegle.expire_waiting_users(application.bot)
+        return reaped, expired, [await Omegle.state.get_pair(user_id) is not None for user_id in (1, 3, 5)], await Omegle.state.counts()
+
+def test_reaper_ends_idle_chats_and_stale_searches(bot_files):
+    Omegle.init_database()
+    reaped, expired, chatting, counts = asyncio.run(reap())
+    assert (reaped, expired) == (1, 1)
+    assert chatting == [False, True, True]
+    assert counts == (0, 2)
+
+async def relay_to_blocked_partner() -> tuple:
+    request = BlockingRequest()
+    async with running_bot(request) as application:
+        await connect(application, 1, 2)
+        request.blocked.add("2")
+        await process(application, text_update(100, 1, "hello?"))
+        ended = await Omegle.state.get_pair(1) is None
+        # User 4 blocks the bot while waiting; user 3 is paired with user 5 instead
+        await connect(application, 4)
+        request.blocked.add("4")
+        await connect(application, 3, 5)
+        return ended, await Omegle.state.get_pair(3), await Omegle.state.counts()
+
+def test_chats_with_users_who_blocked_the_bot_end(bot_files):
+    Omegle.init_database()
+    ended, pair, (waiting, open_chats) = asyncio.run(relay_to_blocked_partner())
+    assert ended
+    assert pair[0] == 5
+    assert (waiting, open_chats) == (0, 1)
+    blocked = Omegle.db.run_sync(lambda conn: conn.execute("SELECT user_id FROM users WHERE blocked_at IS NOT NULL ORDER BY user_id").fetchall())
+    assert [row['user_id'] for row in blocked] == [2, 4]
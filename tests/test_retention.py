@@ -0,0 +1,67 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+import Omegle
+
+DAY = 86400
+
+def add_history():
+    """Chat 1 is old and closed, chat 2 is old with a pending report, chat 3 is still open."""
+    now = time.time()
+    old = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - 60 * DAY))
+
+    def insert(conn):
+        with conn:
+            conn.executemany(
+                "INSERT INTO chat_pairs (id, user1_id, user2_id, connected_at, disconnected_at) VALUES (?, ?, ?, ?, ?)",
+                [(1, 1, 2, old, old), (2, 3, 4, old, old), (3, 5, 6, old, None)]
+            )
+            conn.executemany(
+                "INSERT INTO messages (pair_id, sender_id, message_text, sent_at) VALUES (?, ?, ?, ?)",
+                [(1, 1, "old", int(now - 60 * DAY)), (2, 3, "reported", int(now - 60 * DAY)),
+                 (3, 5, "old but open", int(now - 60 * DAY)), (3, 6, "recent", int(now - DAY))]
+            )
+            conn.execute("INSERT INTO reports (reporter_id, reported_id, reason, pair_id) VALUES (4, 3, 'spam', 2)")
+    Omegle.db.run_sync(insert)
+
+def read_archive(table: str) -> list[dict]:
+    directory = os.path.join(Omegle.ARCHIVE_DIR, table)
+    rows = []
+    for name in sorted(os.listdir(directory)):
+        with gzip.open(os.path.join(directory, name), "rt") as f:
+            rows += [json.loads(line) for line in f]
+    return rows
+
+def remaining(sql: str) -> list:
+    return [tuple(row) for row in Omegle.db.run_sync(lambda conn: conn.execute(sql).fetchall())]
+
+def test_old_rows_are_archived_then_deleted(bot_files):
+    Omegle.init_database()
+    add_history()
+    asyncio.run(Omegle.run_retention())
+
+    assert [row['message_text'] for row in read_archive("messages")] == ["old", "old but open"]
+    assert [row['id'] for row in read_archive("chat_pairs")] == [1]
+    assert remaining("SELECT message_text FROM messages ORDER BY id") == [("reported",), ("recent",)]
+    assert remaining("SELECT id FROM chat_pairs ORDER BY id") == [(2,), (3,)]
+
+def test_rows_stay_when_the_archive_cannot_be_written(bot_files, monkeypatch):
+    def disk_full(*args):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(Omegle, "append_to_archive", disk_full)
+    Omegle.init_database()
+    add_history()
+
+    with pytest.raises(OSError):
+        asyncio.run(Omegle.run_retention())
+    assert len(remaining("SELECT id FROM messages")) == 4
+    assert len(remaining("SELECT id FROM chat_pairs")) == 3
+
+def test_new_databases_use_incremental_vacuum(bot_files):
+    Omegle.init_database()
+    assert Omegle.db.run_sync(lambda conn: conn.execute("PRAGMA auto_vacuum").fetchone()[0]) == 2
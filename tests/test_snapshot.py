@@ -0,0 +1,32 @@
+import asyncio
+
+from telegram import Update
+
+import Omegle
+from fake_bot_api import command_update, running_bot
+
+async def pair_and_wait():
+    """Users 1 and 2 end up chatting and user 3 waiting, then the bot shuts down."""
+    async with running_bot() as application:
+        for update_id, user_id in enumerate((1, 2, 3), start=1):
+            await application.process_update(Update.de_json(command_update(update_id, user_id, "connect"), application.bot))
+
+def test_warm_restart_restores_the_queue_and_chats(bot_files):
+    Omegle.init_database()
+    asyncio.run(pair_and_wait())
+    Omegle.db.close()
+
+    Omegle.init_database()
+    assert Omegle.state.active_pairs[1][0] == 2
+    assert list(Omegle.state.matchmaker._waiting) == [3]
+
+def test_snapshot_is_saved_when_stats_fail_at_shutdown(bot_files, monkeypatch):
+    async def locked():
+        raise Omegle.sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(Omegle, "save_stats", locked)
+    Omegle.init_database()
+    asyncio.run(pair_and_wait())
+
+    snapshot = Omegle.read_state_snapshot()
+    assert [user_id for user_id, *_ in snapshot["waiting"]] == [3]
+    assert [(user1_id, user2_id) for _, user1_id, user2_id in snapshot["pairs"]] == [(1, 2)]
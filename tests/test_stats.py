@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+import Omegle
+
+HOUR = 3600
+NOW = 1_800_000_000 // HOUR * HOUR + 1800  # Half past some hour
+
+def at(monkeypatch, seconds_ago: float):
+    monkeypatch.setattr(time, "time", lambda: NOW - seconds_ago)
+
+def test_windows_sum_the_recent_hours(monkeypatch):
+    stats = Omegle.StatsTracker()
+    for seconds_ago, name in [(30 * HOUR, "joins"), (5 * HOUR, "joins"), (10, "joins"), (10, "chats_started")]:
+        at(monkeypatch, seconds_ago)
+        stats.record(name)
+    at(monkeypatch, 0)
+
+    last_hour, last_day, totals = stats.windows()
+    assert last_hour == {"joins": 1, "chats_started": 1}
+    assert last_day == {"joins": 2, "chats_started": 1}
+    assert totals == {"joins": 3, "chats_started": 1}
+
+def test_session_length_is_timed_from_chat_start(monkeypatch):
+    stats = Omegle.StatsTracker()
+    at(monkeypatch, 90)
+    stats.chat_started(7)
+    at(monkeypatch, 0)
+    stats.chat_ended(7)
+    stats.chat_ended(8)  # Started by another process
+
+    assert stats.totals["chats_ended"] == 2
+    assert (stats.totals["sessions_timed"], stats.totals["session_seconds"]) == (1, 90)
+
+def test_shared_windows_add_up_every_worker(bot_files, monkeypatch):
+    monkeypatch.setattr(Omegle, "STATE_BACKEND", "sqlite")
+    Omegle.init_database()
+    first, second = Omegle.StatsTracker(), Omegle.StatsTracker()
+
+    at(monkeypatch, 2 * HOUR)
+    first.record("joins", 2)
+    at(monkeypatch, 0)
+    first.record("joins")
+    asyncio.run(Omegle.db.transaction(first.save, first.take_unsaved()))
+    # Not saved yet: only the second worker knows about it
+    second.record("joins")
+
+    counts = Omegle.db.run_sync(second.read_windows)
+    second.add_unsaved(counts)
+    last_hour, last_day, totals = counts
+    assert (last_hour["joins"], last_day["joins"], totals["joins"]) == (2, 4, 4)
@@ -0,0 +1,46 @@
+import asyncio
+
+from telegram import Update
+
+import Omegle
+from fake_bot_api import command_update
+
+def run_updates(updates: list[tuple[int, float]]) -> tuple[list, float, dict]:
+    """Processes (user_id, seconds the handler takes) as commands arriving in that order.
+
+    Users 1 and 2 are chatting. Returns (user_id, index) in the order the handlers finished,
+    the total time taken, and the processor's locks afterwards.
+    """
+    Omegle.state.register_pair(1, 2, 10)
+    processor = Omegle.KeyedUpdateProcessor(Omegle.MAX_CONCURRENT_UPDATES)
+    finished = []
+
+    async def handler(user_id: int, index: int, seconds: float):
+        await asyncio.sleep(seconds)
+        finished.append((user_id, index))
+
+    async def main():
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(
+            processor.process_update(Update.de_json(command_update(index, user_id, "start"), None), handler(user_id, index, seconds))
+            for index, (user_id, seconds) in enumerate(updates)
+        ))
+        return asyncio.get_running_loop().time() - started
+
+    elapsed = asyncio.run(main())
+    return finished, elapsed, processor._locks
+
+def test_updates_from_one_user_run_in_arrival_order(bot_files):
+    finished, elapsed, locks = run_updates([(3, 0.03), (3, 0.02), (3, 0.01)])
+    assert finished == [(3, 0), (3, 1), (3, 2)]
+    assert elapsed >= 0.06
+    assert locks == {}
+
+def test_both_sides_of_a_chat_run_one_at_a_time(bot_files):
+    finished, _, _ = run_updates([(1, 0.03), (2, 0.01)])
+    assert finished == [(1, 0), (2, 1)]
+
+def test_unrelated_users_run_in_parallel(bot_files):
+    finished, elapsed, _ = run_updates([(3, 0.05), (4, 0.05), (1, 0.05), (5, 0.01)])
+    assert finished[0] == (5, 3)
+    assert elapsed < 0.1
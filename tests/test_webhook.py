@@ -0,0 +1,54 @@
+import asyncio
+import socket
+
+import pytest
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update
+from webhook_harness import post_json, wait_until_idle
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_webhook_mode_needs_a_secret_token(monkeypatch):
+    monkeypatch.setattr(Omegle, "WEBHOOK_SECRET_TOKEN", "")
+    with pytest.raises(ValueError):
+        Omegle.webhook_settings()
+
+async def post_to_webhook() -> tuple:
+    application = Omegle.build_application(request=FakeBotRequest())
+    await application.initialize()
+    await Omegle.on_startup(application)
+    await application.updater.start_webhook(**Omegle.webhook_settings())
+    await application.start()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", Omegle.WEBHOOK_PORT)
+        rejected = await post_json(reader, writer, command_update(1, 7, "connect"), "wrong-secret")
+        writer.close()
+        reader, writer = await asyncio.open_connection("127.0.0.1", Omegle.WEBHOOK_PORT)
+        accepted = await post_json(reader, writer, command_update(2, 8, "connect"), Omegle.WEBHOOK_SECRET_TOKEN)
+        writer.close()
+        await wait_until_idle(application)
+        return rejected, accepted, await Omegle.state.counts()
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await Omegle.on_stop(application)
+        await application.shutdown()
+        await Omegle.on_shutdown(application)
+
+def test_webhook_accepts_only_updates_with_the_secret_token(bot_files, monkeypatch):
+    port = free_port()
+    monkeypatch.setattr(Omegle, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(Omegle, "WEBHOOK_PORT", port)
+    monkeypatch.setattr(Omegle, "WEBHOOK_URL", f"http://127.0.0.1:{port}/{Omegle.WEBHOOK_URL_PATH}")
+    monkeypatch.setattr(Omegle, "WEBHOOK_SECRET_TOKEN", "test-secret")
+    Omegle.init_database()
+
+    rejected, accepted, (waiting, _) = asyncio.run(post_to_webhook())
+    assert (rejected, accepted) == (403, 200)
+    # Only user 8's /connect got through
+    assert waiting == 1
+    assert Omegle.state.matchmaker.entries()[0][0] == 8
@@ -0,0 +1,145 @@
+"""Local webhook load harness.
+
+Runs the bot in webhook mode against a fake Bot API and POSTs synthetic updates to it, so the
+webhook path can be benchmarked without reaching Telegram:
+
+    python webhook_harness.py --users 2000 --messages 5 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import Omegle
+from fake_bot_api import FakeBotRequest, command_update, lift_send_limits, text_update
+
+async def wait_until_idle(application):
+    """Waits until every received update has been handled."""
+    processor = application.update_processor
+    while application.update_queue.qsize() or processor.current_concurrent_updates:
+        await asyncio.sleep(0.01)
+
+async def post_json(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, update: dict, secret_token: str) -> int:
+    """Sends one webhook POST over a keep-alive connection and returns the HTTP status code.
+
+    A bare HTTP/1.1 client keeps the harness's own overhead well below the bot's.
+    """
+    body = json.dumps(update).encode()
+    writer.write(
+        f"POST /{Omegle.WEBHOOK_URL_PATH} HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{Omegle.WEBHOOK_PORT}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret_token}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            content_length = int(value)
+    await reader.readexactly(content_length)
+    return status
+
+async def post_updates(updates: list[dict], concurrency: int) -> list[float]:
+    """POSTs the updates over `concurrency` connections and returns each request's latency in seconds."""
+    latencies = []
+    pending = iter(updates)
+
+    async def connection():
+        reader, writer = await asyncio.open_connection("127.0.0.1", Omegle.WEBHOOK_PORT)
+        try:
+            for update in pending:
+                started = time.perf_counter()
+                status = await post_json(reader, writer, update, Omegle.WEBHOOK_SECRET_TOKEN)
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    raise RuntimeError(f"Webhook answered HTTP {status}")
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(connection() for _ in range(concurrency)))
+    return latencies
+
+def percentile(values: list[float], fraction: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+async def run(args):
+    request = FakeBotRequest(latency=args.api_latency)
+    application = Omegle.build_application(request=request)
+
+    # Same startup/shutdown order as Application.run_webhook
+    await application.initialize()
+    await Omegle.on_startup(application)
+    await application.updater.start_webhook(**Omegle.webhook_settings())
+    await application.start()
+
+    users = list(range(1, args.users + 1))
+    update_ids = iter(range(1, 10**9))
+    phases = [
+        ("connect", [command_update(next(update_ids), user, "connect") for user in users]),
+        ("chat", [text_update(next(update_ids), user, f"message {i}") for i in range(args.messages) for user in users]),
+        ("disconnect", [command_update(next(update_ids), user, "disconnect") for user in users]),
+    ]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", Omegle.WEBHOOK_PORT)
+    status = await post_json(reader, writer, phases[0][1][0], "wrong-secret")
+    writer.close()
+    print(f"Request with a wrong secret token: HTTP {status} (expected 403)")
+
+    all_latencies = []
+    for name, updates in phases:
+        started = time.perf_counter()
+        latencies = await post_updates(updates, args.concurrency)
+        accepted = time.perf_counter() - started
+        await wait_until_idle(application)
+        handled = time.perf_counter() - started
+        all_latencies += latencies
+        print(
+            f"{name:>10}: {len(updates)} updates, accepted {len(updates) / accepted:.0f}/s, "
+            f"handled {len(updates) / handled:.0f}/s, POST p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms"
+        )
+
+    print(f"Overall POST latency: mean {statistics.mean(all_latencies) * 1000:.1f} ms, p99 {percentile(all_latencies, 0.99) * 1000:.1f} ms")
+    print(f"Bot API calls: {dict(request.calls)}")
+
+    await application.updater.stop()
+    await application.stop()
+    await Omegle.on_stop(application)
+    await application.shutdown()
+    await Omegle.on_shutdown(application)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000, help="simulated users (paired two by two)")
+    parser.add_argument("--messages", type=int, default=5, help="text messages sent by every user")
+    parser.add_argument("--concurrency", type=int, default=50, help="simultaneous webhook requests")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="artificial Bot API round trip in seconds")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep Telegram's send rate limits instead of lifting them")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="omegle-webhook-")
+    Omegle.DB_FILE = os.path.join(workdir, "omegle_bot.db")
+    Omegle.STATE_SNAPSHOT_FILE = os.path.join(workdir, "omegle_state.json")
+    Omegle.WEBHOOK_LISTEN = "127.0.0.1"
+    Omegle.WEBHOOK_PORT = args.port
+    Omegle.WEBHOOK_URL = f"http://127.0.0.1:{args.port}/{Omegle.WEBHOOK_URL_PATH}"
+    Omegle.WEBHOOK_SECRET_TOKEN = "harness-secret"
+    if not args.telegram_limits:
+        lift_send_limits()
+
+    Omegle.init_database()
+    try:
+        asyncio.run(run(args))
+    finally:
+        Omegle.db.close()
+
+if __name__ == "__main__":
+    main()